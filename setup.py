@@ -13,9 +13,13 @@ setup(
     author = 'Jeff Kistler',
     author_email = 'jeff@jeffkistler.com',
     url = 'https://github.com/jeffkistler/django-fancy-autocomplete',
-    packages = ['fancy_autocomplete'],
+    packages = [
+        'fancy_autocomplete',
+        'fancy_autocomplete.management',
+        'fancy_autocomplete.management.commands',
+    ],
     package_dir = {'': 'src'},
-    package_data = {'fancy_autocomplete': ['fixtures/*',]},
+    package_data = {'fancy_autocomplete': ['fixtures/*', 'static/fancy_autocomplete/*']},
     classifiers = [
         'Development Status :: 3 - Alpha',
         'Framework :: Django',
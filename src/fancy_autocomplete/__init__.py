@@ -0,0 +1,8 @@
+def autodiscover():
+    """
+    Have the default ``AutocompleteSite``, ``fancy_autocomplete.views.site``,
+    import the ``autocompletes`` module of each installed app when it is first
+    used, so the modules may register their autocompletes with it.
+    """
+    from fancy_autocomplete.views import site
+    site.autodiscover()
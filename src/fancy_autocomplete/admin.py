@@ -0,0 +1,186 @@
+"""
+Autocomplete widgets for foreign keys and many-to-many fields in the admin.
+
+Add ``AutocompleteAdminMixin`` to a ``ModelAdmin`` and list fields in its
+``autocomplete_fields`` to replace their select boxes with autocompletes
+searching the related model admin's ``search_fields``.
+"""
+from django.core.exceptions import ImproperlyConfigured
+from django.core.urlresolvers import reverse
+from django.utils.functional import update_wrapper
+
+from fancy_autocomplete.forms import (
+    AutocompleteInput, AutocompleteModelChoiceField,
+    AutocompleteModelMultipleChoiceField, AutocompleteSelectMultiple
+)
+from fancy_autocomplete.views import AutocompleteSite, LabeledAutocomplete
+
+ADMIN_LOOKUPS = {
+    '^': 'istartswith',
+    '=': 'iexact',
+    '@': 'search',
+}
+
+
+class AdminAutocompleteInput(AutocompleteInput):
+    class Media:
+        js = ('fancy_autocomplete/autocomplete.js',)
+
+
+class AdminAutocompleteSelectMultiple(AutocompleteSelectMultiple):
+    class Media:
+        js = ('fancy_autocomplete/autocomplete.js',)
+
+
+class AdminAutocomplete(LabeledAutocomplete):
+    """
+    An autocomplete for the related objects of a model admin's field. Search
+    fields are given in the admin's ``search_fields`` syntax, and requests
+    are authorized by the model admin's add and change permissions.
+    """
+    def __init__(self, **kwargs):
+        self._load_config_values(kwargs,
+            model_admin=None,
+            related_admin=None,
+            limit_choices_to=None
+        )
+        super(AdminAutocomplete, self).__init__(**kwargs)
+
+    def get_search_fields(self):
+        search_fields = super(AdminAutocomplete, self).get_search_fields()
+        return [field.lstrip(''.join(ADMIN_LOOKUPS.keys())) for field in search_fields]
+
+    def get_lookup(self, field):
+        for search_field in self.search_fields:
+            if search_field[1:] == field and search_field[0] in ADMIN_LOOKUPS:
+                return ADMIN_LOOKUPS[search_field[0]]
+        return 'icontains'
+
+    def get_queryset(self):
+        if self.related_admin is not None and getattr(self, 'request', None) is not None:
+            queryset = self.related_admin.queryset(self.request)
+        else:
+            queryset = super(AdminAutocomplete, self).get_queryset()
+        if self.limit_choices_to:
+            queryset = queryset.complex_filter(self.limit_choices_to)
+        return queryset
+
+    def is_authorized(self):
+        user = self.request.user
+        if not (user.is_active and user.is_staff):
+            return False
+        if self.model_admin is None:
+            return True
+        return (self.model_admin.has_add_permission(self.request) or
+                self.model_admin.has_change_permission(self.request))
+
+
+class AutocompleteAdminMixin(object):
+    """
+    A ``ModelAdmin`` mixin replacing the widgets of the foreign keys and
+    many-to-many fields named in ``autocomplete_fields`` with autocompletes.
+    The related models must be registered with the same admin site with
+    ``search_fields`` set.
+    """
+    autocomplete_fields = ()
+    autocomplete_limit = 20
+    autocomplete_class = AdminAutocomplete
+
+    def get_autocomplete_site(self):
+        """
+        Get the ``AutocompleteSite`` with an autocomplete registered for each
+        field in ``autocomplete_fields``, keyed by field name.
+        """
+        site = getattr(self, '_autocomplete_site', None)
+        if site is None:
+            site = AutocompleteSite(name='%s:%s.%s' % (
+                self.admin_site.name, self.model._meta.app_label, self.model._meta.module_name
+            ))
+            for name in self.autocomplete_fields:
+                db_field = self.model._meta.get_field(name)
+                site.register(name, **self.get_autocomplete_options(db_field))
+            self._autocomplete_site = site
+        return site
+
+    def get_autocomplete_options(self, db_field):
+        """
+        Get the options to register the autocomplete for ``db_field`` with.
+        """
+        related_model = db_field.rel.to
+        related_admin = self.admin_site._registry.get(related_model)
+        if related_admin is None or not related_admin.search_fields:
+            raise ImproperlyConfigured(
+                "'%s' is in %s.autocomplete_fields, but %s is not registered "
+                "with search_fields on the admin site." % (
+                    db_field.name,
+                    self.__class__.__name__,
+                    related_model.__name__
+                )
+            )
+        return {
+            'autocomplete': self.autocomplete_class,
+            'model': related_model,
+            'model_admin': self,
+            'related_admin': related_admin,
+            'search_fields': related_admin.search_fields,
+            'limit_choices_to': db_field.rel.limit_choices_to,
+            'limit': self.autocomplete_limit,
+        }
+
+    def get_autocomplete_url(self, db_field):
+        """
+        Get the URL of the autocomplete view for ``db_field``.
+        """
+        info = self.admin_site.name, self.model._meta.app_label, self.model._meta.module_name
+        return reverse('%s:%s_%s_autocomplete' % info, args=[db_field.name])
+
+    def autocomplete_view(self, request, key):
+        """
+        Dispatch an autocomplete request for the field named ``key``.
+        """
+        return self.get_autocomplete_site()(request, key)
+
+    def get_urls(self):
+        from django.conf.urls.defaults import patterns, url
+
+        def wrap(view):
+            def wrapper(*args, **kwargs):
+                return self.admin_site.admin_view(view)(*args, **kwargs)
+            return update_wrapper(wrapper, view)
+
+        info = self.model._meta.app_label, self.model._meta.module_name
+        urlpatterns = patterns('',
+            url(r'^autocomplete/([\w-]+)/$',
+                wrap(self.autocomplete_view),
+                name='%s_%s_autocomplete' % info),
+        )
+        return urlpatterns + super(AutocompleteAdminMixin, self).get_urls()
+
+    def formfield_for_foreignkey(self, db_field, request=None, **kwargs):
+        if db_field.name in self.autocomplete_fields:
+            url = self.get_autocomplete_url(db_field)
+            kwargs.update({
+                'form_class': AutocompleteModelChoiceField,
+                'site': self.get_autocomplete_site(),
+                'key': db_field.name,
+                'widget': AdminAutocompleteInput(url=url),
+            })
+            return db_field.formfield(**kwargs)
+        return super(AutocompleteAdminMixin, self).formfield_for_foreignkey(
+            db_field, request, **kwargs
+        )
+
+    def formfield_for_manytomany(self, db_field, request=None, **kwargs):
+        if (db_field.name in self.autocomplete_fields and
+            db_field.rel.through._meta.auto_created):
+            url = self.get_autocomplete_url(db_field)
+            kwargs.update({
+                'form_class': AutocompleteModelMultipleChoiceField,
+                'site': self.get_autocomplete_site(),
+                'key': db_field.name,
+                'widget': AdminAutocompleteSelectMultiple(url=url),
+            })
+            return db_field.formfield(**kwargs)
+        return super(AutocompleteAdminMixin, self).formfield_for_manytomany(
+            db_field, request, **kwargs
+        )
@@ -0,0 +1,142 @@
+"""
+Time budgets and circuit breakers for autocomplete searches.
+
+A suggestion that arrives after a couple of seconds is useless, and slow
+searches piling up can exhaust a site's worker pool. Autocompletes with a
+``time_budget`` run their searches under a statement timeout where the
+database supports one, and stop searching a database for a while with a
+``CircuitBreaker`` when searches keep failing or running over budget.
+"""
+from contextlib import contextmanager
+import threading
+import time
+
+from django.db import transaction
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+@contextmanager
+def statement_timeout(connection, seconds):
+    """
+    Abort statements run on ``connection`` in the block after ``seconds``.
+    PostgreSQL and MySQL are given a statement timeout, and SQLite a progress
+    handler interrupting statements past the deadline. Statements on other
+    databases are not aborted.
+    """
+    vendor = getattr(connection, 'vendor', None)
+    milliseconds = max(int(seconds * 1000), 1)
+    if vendor == 'sqlite':
+        connection.cursor()
+        deadline = time.time() + seconds
+
+        def progress():
+            return time.time() > deadline
+        connection.connection.set_progress_handler(progress, 1000)
+        try:
+            yield
+        finally:
+            connection.connection.set_progress_handler(None, 1000)
+    elif vendor in ('postgresql', 'mysql'):
+        if vendor == 'postgresql':
+            setting, show = 'statement_timeout', 'SHOW statement_timeout'
+        else:
+            setting, show = 'max_execution_time', 'SELECT @@max_execution_time'
+        cursor = connection.cursor()
+        cursor.execute(show)
+        previous = cursor.fetchone()[0]
+        # A savepoint lets the transaction continue after an aborted
+        # statement on PostgreSQL, and rolling it back undoes the SET.
+        sid = transaction.savepoint(using=connection.alias)
+        cursor.execute('SET %s = %d' % (setting, milliseconds))
+        try:
+            yield
+        except:
+            transaction.savepoint_rollback(sid, using=connection.alias)
+            if vendor == 'mysql':
+                connection.cursor().execute('SET %s = %%s' % setting, [previous])
+            raise
+        else:
+            transaction.savepoint_commit(sid, using=connection.alias)
+            connection.cursor().execute('SET %s = %%s' % setting, [previous])
+    else:
+        yield
+
+
+class CircuitBreaker(object):
+    """
+    Counts consecutive failures of a backend. After ``threshold`` failures
+    the breaker opens and refuses requests for ``cooldown`` seconds, after
+    which one request at a time is let through to try the backend again.
+    """
+    def __init__(self, threshold=5, cooldown=30):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """
+        Whether a request may be sent to the backend.
+        """
+        self.lock.acquire()
+        try:
+            if self.opened is None:
+                return True
+            if time.time() - self.opened >= self.cooldown:
+                # Let this request try the backend, holding back the others
+                # for another cool-down period.
+                self.opened = time.time()
+                return True
+            return False
+        finally:
+            self.lock.release()
+
+    def is_open(self):
+        """
+        Whether the breaker is refusing requests.
+        """
+        return self.opened is not None
+
+    def record_success(self):
+        """
+        Close the breaker after a successful request.
+        """
+        self.lock.acquire()
+        try:
+            self.failures = 0
+            self.opened = None
+        finally:
+            self.lock.release()
+
+    def record_failure(self):
+        """
+        Count a failed request, opening the breaker at the threshold.
+        """
+        self.lock.acquire()
+        try:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened = time.time()
+        finally:
+            self.lock.release()
+
+
+def get_breaker(name, alias, threshold=5, cooldown=30):
+    """
+    Get the process-wide ``CircuitBreaker`` for the autocomplete with the
+    qualified ``name`` searching the database ``alias``.
+    """
+    key = (name, alias)
+    _breakers_lock.acquire()
+    try:
+        breaker = _breakers.get(key)
+        if breaker is None:
+            breaker = _breakers[key] = CircuitBreaker(threshold, cooldown)
+        breaker.threshold = threshold
+        breaker.cooldown = cooldown
+        return breaker
+    finally:
+        _breakers_lock.release()
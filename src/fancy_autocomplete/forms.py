@@ -1,4 +1,255 @@
+from django import forms
+from django.core.exceptions import ValidationError
 from django.forms import models
+from django.forms.util import flatatt
+from django.utils.datastructures import MergeDict, MultiValueDict
+from django.utils.encoding import force_unicode
+from django.utils.html import conditional_escape
+from django.utils.safestring import mark_safe
+
+from fancy_autocomplete.views import LabeledAutocomplete
 
 class ModelChoiceField(models.ModelChoiceField):
     pass
+
+
+class AutocompleteInput(forms.TextInput):
+    """
+    A text input for choosing a model object through an autocomplete. The
+    chosen object's key is submitted in a hidden input, and only the chosen
+    object is looked up to render its label.
+    """
+    def __init__(self, url=None, attrs=None):
+        super(AutocompleteInput, self).__init__(attrs)
+        self.url = url
+
+    def get_labels(self, values):
+        """
+        Get a dictionary mapping each of the given key ``values`` to the label
+        of its object. Fields choosing from an autocomplete give the labels
+        the autocomplete shows, and other fields the labels of their
+        ``label_from_instance``. Values that are not valid keys are skipped.
+        """
+        field = self.choices.field
+        if hasattr(field, 'get_labels'):
+            return field.get_labels(values)
+        return get_instance_labels(field, values)
+
+    def render_text(self, attrs, label):
+        """
+        Render the text input showing the ``label`` of the chosen object.
+        """
+        text_attrs = dict(attrs, type='text')
+        if self.url:
+            text_attrs['data-autocomplete-url'] = self.url
+        if label:
+            text_attrs['value'] = force_unicode(label)
+        return u'<input%s />' % flatatt(text_attrs)
+
+    def render(self, name, value, attrs=None):
+        final_attrs = self.build_attrs(attrs)
+        id_ = final_attrs.get('id', None)
+        hidden_attrs = {'type': 'hidden', 'name': name}
+        label = u''
+        if value not in (None, ''):
+            value = force_unicode(value)
+            hidden_attrs['value'] = value
+            label = self.get_labels([value]).get(value, u'')
+        if id_:
+            hidden_attrs['id'] = '%s_value' % id_
+        return mark_safe(u'%s%s' % (
+            self.render_text(final_attrs, label),
+            u'<input%s />' % flatatt(hidden_attrs)
+        ))
+
+
+class AutocompleteSelectMultiple(AutocompleteInput):
+    """
+    A text input for choosing several model objects through an autocomplete.
+    The chosen objects' keys are submitted in hidden inputs, and their labels
+    are looked up together in one query.
+    """
+    def render(self, name, value, attrs=None):
+        if value is None:
+            value = []
+        value = [force_unicode(v) for v in value]
+        final_attrs = self.build_attrs(attrs)
+        id_ = final_attrs.get('id', None)
+        labels = value and self.get_labels(value) or {}
+        output = [self.render_text(dict(final_attrs, **{'data-autocomplete-name': name}), None)]
+        items = []
+        for i, v in enumerate(value):
+            hidden_attrs = {'type': 'hidden', 'name': name, 'value': v}
+            if id_:
+                hidden_attrs['id'] = '%s_value_%s' % (id_, i)
+            items.append(u'<li>%s<input%s /></li>' % (
+                conditional_escape(labels.get(v, u'')),
+                flatatt(hidden_attrs)
+            ))
+        list_attrs = {}
+        if id_:
+            list_attrs['id'] = '%s_values' % id_
+        output.append(u'<ul%s>%s</ul>' % (flatatt(list_attrs), u''.join(items)))
+        return mark_safe(u''.join(output))
+
+    def value_from_datadict(self, data, files, name):
+        if isinstance(data, (MultiValueDict, MergeDict)):
+            return data.getlist(name)
+        return data.get(name, None)
+
+    def _has_changed(self, initial, data):
+        if initial is None:
+            initial = []
+        if data is None:
+            data = []
+        return (set([force_unicode(v) for v in initial]) !=
+                set([force_unicode(v) for v in data]))
+
+
+def get_key_field(field):
+    """
+    Get the model field holding the keys of a model choice ``field``.
+    """
+    opts = field.queryset.model._meta
+    if field.to_field_name:
+        return opts.get_field(field.to_field_name)
+    return opts.pk
+
+
+def to_keys(key_field, values):
+    """
+    Convert key ``values`` with ``key_field``, skipping those that are not
+    valid keys, as submitted values of a bound form may not be.
+    """
+    keys = []
+    for value in values:
+        try:
+            keys.append(key_field.to_python(value))
+        except (ValueError, ValidationError):
+            continue
+    return keys
+
+
+def get_instance_labels(field, values):
+    """
+    Get a dictionary mapping each of the given key ``values`` to the label
+    the model choice ``field`` gives its object, looking them all up in a
+    single query.
+    """
+    key_field = get_key_field(field)
+    keys = to_keys(key_field, values)
+    if not keys:
+        return {}
+    objects = field.queryset.filter(**{'%s__in' % key_field.name: keys})
+    return dict(
+        (force_unicode(key_field.value_from_object(obj)), field.label_from_instance(obj))
+        for obj in objects
+    )
+
+
+class AutocompleteChoiceIterator(models.ModelChoiceIterator):
+    """
+    Iterates over the choices of an autocomplete field, only getting the
+    field's queryset when iterated.
+    """
+    def __init__(self, field):
+        self.field = field
+
+    @property
+    def queryset(self):
+        return self.field.queryset
+
+
+class AutocompleteFieldMixin(object):
+    """
+    Gets the queryset of a field choosing from the autocomplete registered as
+    ``key`` with ``site`` each time it is used, rather than when the field is
+    defined. The autocomplete is given the field's ``request``, which a form
+    may set on its copy of the field for autocompletes whose queryset depends
+    on the requesting user.
+    """
+    request = None
+
+    def get_autocomplete(self):
+        """
+        Get the autocomplete the field chooses from, for the field's request.
+        """
+        autocomplete = self.site.get_autocomplete(self.key)
+        autocomplete.request = self.request
+        return autocomplete
+
+    def _get_queryset(self):
+        if self._queryset is not None:
+            return self._queryset
+        return self.get_autocomplete().get_queryset()
+
+    def _set_queryset(self, queryset):
+        self._queryset = queryset
+        self.widget.choices = self.choices
+
+    queryset = property(_get_queryset, _set_queryset)
+
+    def _get_choices(self):
+        if hasattr(self, '_choices'):
+            return self._choices
+        return AutocompleteChoiceIterator(self)
+
+    choices = property(_get_choices, forms.ChoiceField._set_choices)
+
+    def __deepcopy__(self, memo):
+        # Unlike ModelChoiceField, leave the queryset to be got when used.
+        result = forms.Field.__deepcopy__(self, memo)
+        result.widget.choices = result.choices
+        return result
+
+    def get_labels(self, values):
+        """
+        Get a dictionary mapping each of the given key ``values`` to the label
+        the autocomplete gives its object, resolving them in one query. Keys
+        the autocomplete does not resolve, or autocompletes without labels,
+        get the labels of ``label_from_instance``.
+        """
+        autocomplete = self.get_autocomplete()
+        key_field = get_key_field(self)
+        keys = to_keys(key_field, values)
+        labels = {}
+        if keys and isinstance(autocomplete, LabeledAutocomplete):
+            queryset = autocomplete.get_queryset()
+            if autocomplete.get_key_field(queryset) == key_field.attname:
+                for key, label in autocomplete.resolve(keys):
+                    labels[force_unicode(key)] = label
+        missing = [key for key in keys if force_unicode(key) not in labels]
+        if missing:
+            labels.update(get_instance_labels(self, missing))
+        return labels
+
+
+class AutocompleteModelChoiceField(AutocompleteFieldMixin, models.ModelChoiceField):
+    """
+    A ``ModelChoiceField`` for choosing from the results of the autocomplete
+    registered as ``key`` with ``site``, requested from ``url``. Unless a
+    queryset is given, the choices are the autocomplete's queryset.
+    """
+    widget = AutocompleteInput
+
+    def __init__(self, site, key, url=None, queryset=None, *args, **kwargs):
+        self.site = site
+        self.key = key
+        if kwargs.get('widget') is None:
+            kwargs['widget'] = self.widget(url=url)
+        super(AutocompleteModelChoiceField, self).__init__(queryset, *args, **kwargs)
+
+
+class AutocompleteModelMultipleChoiceField(AutocompleteFieldMixin, models.ModelMultipleChoiceField):
+    """
+    A ``ModelMultipleChoiceField`` for choosing from the results of the
+    autocomplete registered as ``key`` with ``site``, requested from ``url``.
+    """
+    widget = AutocompleteSelectMultiple
+
+    def __init__(self, site, key, url=None, queryset=None, *args, **kwargs):
+        self.site = site
+        self.key = key
+        if kwargs.get('widget') is None:
+            kwargs['widget'] = self.widget(url=url)
+        super(AutocompleteModelMultipleChoiceField, self).__init__(queryset, *args, **kwargs)
@@ -0,0 +1,203 @@
+"""
+Memory-mapped prefix indexes of autocomplete results.
+
+An index file holds the search field values of an autocomplete's queryset in
+sorted order, each with the rank of its object in the queryset and its
+serialized result, so that prefix queries are answered by a binary search
+without touching the database. The matches of a prefix are ordered by rank,
+as the queryset would order them. Index
+files are mapped into memory read-only, so every process on a host serving
+the same file shares one copy of it in the page cache. Rebuilt files are
+swapped in by renaming them over the old file, and processes reopen the file
+once they notice it has been replaced.
+
+An index file is a header, the autocomplete's name, an array of ``count + 1``
+little-endian unsigned 64-bit offsets into the entries, and the ``count``
+entries, each being a UTF-8 encoded term, a NUL byte, a little-endian
+unsigned 32-bit rank and a JSON encoded result.
+"""
+import heapq
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import simplejson
+from django.utils.encoding import force_unicode
+
+MAGIC = 'FAIX'
+VERSION = 2
+# The magic, version, build time, entry count and name length.
+HEADER = struct.Struct('<4sHdIH')
+OFFSET = struct.Struct('<Q')
+RANK = struct.Struct('<I')
+PREFIX_LOOKUPS = ('startswith', 'istartswith')
+
+_open_indexes = {}
+
+
+class PrefixIndex(object):
+    """
+    A read-only, memory-mapped index file.
+    """
+    def __init__(self, path):
+        self.path = path
+        f = open(path, 'rb')
+        try:
+            stat = os.fstat(f.fileno())
+            self.identity = (stat.st_ino, stat.st_mtime)
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        magic, version, self.built, self.count, name_length = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("'%s' is not an autocomplete index file." % path)
+        start = HEADER.size
+        self.name = self.map[start:start + name_length].decode('utf-8')
+        self.offsets_start = start + name_length
+        self.entries_start = self.offsets_start + OFFSET.size * (self.count + 1)
+
+    def _offset(self, i):
+        position = self.offsets_start + OFFSET.size * i
+        return self.entries_start + OFFSET.unpack_from(self.map, position)[0]
+
+    def _term(self, i):
+        start = self._offset(i)
+        return self.map[start:self.map.find('\0', start, self._offset(i + 1))]
+
+    def search(self, prefix, limit=None):
+        """
+        Get the JSON encoded results of the entries whose terms start with
+        ``prefix`` in order of rank, each result at most once, up to
+        ``limit`` results.
+        """
+        prefix = prefix.encode('utf-8')
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._term(middle) < prefix:
+                low = middle + 1
+            else:
+                high = middle
+        # The entries of an object share its rank, so the first entry found
+        # for each rank stands for the object.
+        matches = {}
+        i = low
+        while i < self.count:
+            start = self._offset(i)
+            end = self.map.find('\0', start, self._offset(i + 1))
+            if not self.map[start:end].startswith(prefix):
+                break
+            rank = RANK.unpack_from(self.map, end + 1)[0]
+            matches.setdefault(rank, i)
+            i += 1
+        ranks = sorted(matches) if limit is None else heapq.nsmallest(limit, matches)
+        results = []
+        for rank in ranks:
+            i = matches[rank]
+            start = self.map.find('\0', self._offset(i), self._offset(i + 1)) + 1 + RANK.size
+            results.append(self.map[start:self._offset(i + 1)])
+        return results
+
+
+def get_index(path):
+    """
+    Get the ``PrefixIndex`` for the file at ``path``, reopening it if the file
+    has been replaced since it was opened. Returns ``None`` if there is no
+    usable index file.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    index = _open_indexes.get(path)
+    if index is None or index.identity != (stat.st_ino, stat.st_mtime):
+        # Earlier mappings are left for the garbage collector to close, as
+        # other threads may still be reading from them.
+        try:
+            index = PrefixIndex(path)
+        except (EnvironmentError, ValueError, struct.error):
+            return None
+        _open_indexes[path] = index
+    return index
+
+
+def get_entries(autocomplete):
+    """
+    Get the sorted list of (term, rank, result) entries for the objects in
+    the autocomplete's queryset, with a term for each search field value and
+    the position of the object in the queryset as its rank.
+    """
+    lookups = [autocomplete.get_lookup(field) for field in autocomplete.get_search_fields()]
+    if [lookup for lookup in lookups if lookup not in PREFIX_LOOKUPS]:
+        raise ImproperlyConfigured(
+            "Only autocompletes using the %s lookups can be indexed." % ' or '.join(PREFIX_LOOKUPS)
+        )
+    queryset = autocomplete.get_queryset()
+    using = autocomplete.get_using()
+    if using is not None:
+        queryset = queryset.using(using)
+    autocomplete.result_order = None
+    results = {}
+    for key, result in autocomplete.prepare_keyed_results(queryset):
+        results[force_unicode(key)] = simplejson.dumps(result, cls=DjangoJSONEncoder)
+    key_field = autocomplete.get_key_field(queryset)
+    rows = queryset.values_list(key_field, *autocomplete.get_search_fields())
+    entries = []
+    for rank, row in enumerate(rows.iterator()):
+        result = results.get(force_unicode(row[0]))
+        if result is None:
+            continue
+        for value in row[1:]:
+            if not value:
+                continue
+            term = autocomplete.get_prefix(unicode(value)).encode('utf-8').replace('\0', '')
+            entries.append((term, rank, result))
+    entries.sort()
+    return entries
+
+
+def build_index(autocomplete, path=None):
+    """
+    Write the index file for ``autocomplete`` to ``path``, which defaults to
+    its ``index_path``. The file is written beside ``path`` and renamed over
+    it, so processes serving the old file are never shown a partial one.
+    Returns the number of entries written.
+    """
+    if path is None:
+        path = autocomplete.get_index_path()
+    if path is None:
+        raise ImproperlyConfigured("An index_path must be specified.")
+    entries = get_entries(autocomplete)
+    name = (autocomplete.name or u'').encode('utf-8')
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(prefix='.%s.' % os.path.basename(path), dir=directory)
+    try:
+        f = os.fdopen(fd, 'wb')
+        try:
+            f.write(HEADER.pack(MAGIC, VERSION, time.time(), len(entries), len(name)))
+            f.write(name)
+            offset = 0
+            for term, rank, result in entries:
+                f.write(OFFSET.pack(offset))
+                offset += len(term) + 1 + RANK.size + len(result)
+            f.write(OFFSET.pack(offset))
+            for term, rank, result in entries:
+                f.write(term)
+                f.write('\0')
+                f.write(RANK.pack(rank))
+                f.write(result)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.chmod(temp_path, 0o644)
+        os.rename(temp_path, path)
+    except:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+    return len(entries)
@@ -0,0 +1,265 @@
+"""
+Load testing of autocompletes with replayed typing traces.
+
+A trace is the list of requests one user makes while typing into
+autocompletes, as ``(delay, key, query)`` events where ``delay`` is the
+number of seconds since the previous keystroke. Traces may be recorded from
+production logs, or made up with ``make_traces`` from the values of the
+autocompletes' search fields, with typos corrected by backspacing and words
+abandoned part way through.
+
+``run`` replays traces with a number of concurrent users against a target:
+a ``ClientTarget`` requesting the site's URLs through Django's test client,
+counting each request's database queries, or an ``HttpTarget`` requesting a
+running server. It reports the throughput, latency percentiles, database
+queries and how many requests were answered without querying the database.
+"""
+import Queue
+import math
+import random
+import string
+import threading
+import time
+import urllib
+import urllib2
+
+from django.db import connections
+from django.test.client import Client
+from django.utils import simplejson
+
+
+def type_word(word, rng, delay=0.15, typo_rate=0.05, abandon_rate=0.1):
+    """
+    Get the list of ``(delay, query)`` events of typing ``word``, with a mean
+    of ``delay`` seconds between keystrokes. Each keystroke is a typo that is
+    backspaced away with probability ``typo_rate``, and the word is abandoned
+    part way through with probability ``abandon_rate``.
+    """
+    length = len(word)
+    if length > 1 and rng.random() < abandon_rate:
+        length = rng.randint(1, length - 1)
+    events = []
+    typed = u''
+
+    def keystroke(query):
+        events.append((max(rng.gauss(delay, delay / 3), 0.01), query))
+    for char in word[:length]:
+        if rng.random() < typo_rate:
+            keystroke(typed + rng.choice(string.ascii_lowercase))
+            if typed:
+                keystroke(typed)
+        typed += char
+        keystroke(typed)
+    return events
+
+
+def get_words(autocomplete, limit=1000):
+    """
+    Get up to ``limit`` of the autocomplete's search field values to type.
+    """
+    fields = autocomplete.get_search_fields()
+    rows = autocomplete.get_queryset().values_list(*fields)[:limit]
+    return [unicode(value) for row in rows for value in row if value]
+
+
+def make_traces(site, keys=None, users=20, words_per_user=3, seed=None, **typing):
+    """
+    Make up a trace for each of ``users`` users typing ``words_per_user``
+    search field values into the autocompletes registered with ``site``
+    under ``keys``. Further keyword arguments are passed to ``type_word``.
+    """
+    rng = random.Random(seed)
+    if keys is None:
+        keys = site.get_keys()
+    words = {}
+    for key in keys:
+        words[key] = get_words(site.get_autocomplete(key))
+    keys = [key for key in keys if words[key]]
+    traces = []
+    for i in range(users):
+        trace = []
+        for j in range(words_per_user if keys else 0):
+            key = rng.choice(keys)
+            for delay, query in type_word(rng.choice(words[key]), rng, **typing):
+                trace.append((delay, key, query))
+        traces.append(trace)
+    return traces
+
+
+def read_traces(path):
+    """
+    Read traces from a UTF-8 file holding each trace as a JSON list of
+    ``[delay, key, query]`` events on its own line.
+    """
+    f = open(path)
+    try:
+        return [
+            [tuple(event) for event in simplejson.loads(line)]
+            for line in f if line.strip()
+        ]
+    finally:
+        f.close()
+
+
+def write_traces(traces, path):
+    """
+    Write traces to a file in the format read by ``read_traces``.
+    """
+    f = open(path, 'w')
+    try:
+        for trace in traces:
+            f.write(simplejson.dumps([list(event) for event in trace]) + '\n')
+    finally:
+        f.close()
+
+
+class ClientTarget(object):
+    """
+    Requests autocompletes through Django's test client from the URL made by
+    formatting ``url`` with the key. The database queries of each request are
+    counted.
+    """
+    def __init__(self, url='/autocomplete/%s/', query_param='q'):
+        self.url = url
+        self.query_param = query_param
+        self.local = threading.local()
+
+    def request(self, key, query):
+        """
+        Request ``query`` from the autocomplete registered as ``key``.
+        Returns the response status code and the number of queries made.
+        """
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = Client()
+        for connection in connections.all():
+            connection.use_debug_cursor = True
+        # The query logs are reset when each request starts.
+        response = client.get(self.url % key, {self.query_param: query})
+        queries = 0
+        for connection in connections.all():
+            queries += len(connection.queries)
+        return response.status_code, queries
+
+    def close(self):
+        """
+        Clean up after the requests of a thread.
+        """
+        for connection in connections.all():
+            connection.use_debug_cursor = None
+            connection.close()
+
+
+class HttpTarget(ClientTarget):
+    """
+    Requests autocompletes from a running server at ``base_url``, such as a
+    local development server. Database queries are not counted.
+    """
+    def __init__(self, base_url, url='/autocomplete/%s/', query_param='q'):
+        super(HttpTarget, self).__init__(url, query_param)
+        self.base_url = base_url.rstrip('/')
+
+    def request(self, key, query):
+        url = '%s%s?%s' % (
+            self.base_url,
+            self.url % key,
+            urllib.urlencode({self.query_param: query.encode('utf-8')})
+        )
+        try:
+            response = urllib2.urlopen(url)
+        except urllib2.HTTPError as e:
+            return e.code, None
+        try:
+            response.read()
+        finally:
+            response.close()
+        return response.getcode(), None
+
+    def close(self):
+        pass
+
+
+def percentile(values, fraction):
+    """
+    Get the nearest-rank percentile of sorted ``values``.
+    """
+    if not values:
+        return None
+    index = int(math.ceil(fraction * len(values))) - 1
+    return values[max(index, 0)]
+
+
+def summarize(samples, elapsed):
+    """
+    Summarize a list of ``(latency, status, queries)`` samples taken over
+    ``elapsed`` seconds.
+    """
+    latencies = sorted(latency for latency, status, queries in samples)
+    counted = [
+        queries for latency, status, queries in samples
+        if status == 200 and queries is not None
+    ]
+    report = {
+        'requests': len(samples),
+        'errors': len([status for latency, status, queries in samples if status != 200]),
+        'elapsed': elapsed,
+        'throughput': elapsed and len(samples) / elapsed or None,
+        'latency': dict(
+            (name, percentile(latencies, fraction))
+            for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0))
+        ),
+        'queries': None,
+        'queries_per_request': None,
+        'cached_ratio': None,
+    }
+    if counted:
+        # Successful requests answered without a query were served from the
+        # cache, precomputed results or an index.
+        report['queries'] = sum(counted)
+        report['queries_per_request'] = float(sum(counted)) / len(counted)
+        report['cached_ratio'] = float(len([q for q in counted if q == 0])) / len(counted)
+    return report
+
+
+def run(target, traces, concurrency=1, speed=1.0):
+    """
+    Replay ``traces`` against ``target`` with ``concurrency`` users at a
+    time, waiting between keystrokes as the traces do divided by ``speed``,
+    or not at all if ``speed`` is 0. Returns the summary of the requests.
+    """
+    queue = Queue.Queue()
+    for trace in traces:
+        queue.put(trace)
+    samples = []
+    lock = threading.Lock()
+
+    def user():
+        try:
+            while True:
+                try:
+                    trace = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                for delay, key, query in trace:
+                    if speed:
+                        time.sleep(delay / speed)
+                    started = time.time()
+                    status, queries = target.request(key, query)
+                    latency = time.time() - started
+                    lock.acquire()
+                    try:
+                        samples.append((latency, status, queries))
+                    finally:
+                        lock.release()
+        finally:
+            target.close()
+    started = time.time()
+    if concurrency <= 1:
+        user()
+    else:
+        threads = [threading.Thread(target=user) for i in range(min(concurrency, len(traces)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return summarize(samples, time.time() - started)
@@ -0,0 +1,453 @@
+"""
+Incremental maintenance of precomputed results, caches and prefix indexes.
+
+``precompute.connect_signals`` refreshes precomputed results within every
+save, which is too slow for tables written to often. A ``Maintainer``
+instead records the rows changed by saves, deletes and many-to-many changes
+in a bounded buffer, where repeated changes to a row are coalesced, and
+applies them in batches: the precomputed results for the prefixes of the
+rows' old and new values are refreshed. Invalidating an autocomplete's cached
+results drops all of them, so the caches changed by batches are invalidated
+at most every ``invalidate_interval``. Prefix indexes are rebuilt from the
+whole queryset, so those changed by batches are rebuilt at most every
+``index_interval``.
+
+The buffer is flushed when it is full, and when a request finishes or the
+maintainer's thread wakes up with changes older than ``flush_interval``.
+Changes that signals do not see, such as bulk updates or edits to related
+rows, are repaired by a full reconciliation every ``reconcile_interval``.
+Errors while applying changes are counted in the metrics and logged to the
+``fancy_autocomplete.maintenance`` logger.
+"""
+import logging
+import threading
+import time
+
+from django.core import signals as request_signals
+from django.db import connections
+from django.db.models import signals
+from django.db.models.sql.constants import LOOKUP_SEP
+
+from fancy_autocomplete.precompute import (
+    check_lookups, get_primary, get_queryset_prefixes, get_row_prefixes, precompute
+)
+from fancy_autocomplete.utils import make_request
+
+logger = logging.getLogger('fancy_autocomplete.maintenance')
+
+
+class Maintainer(object):
+    """
+    Keeps the precomputed results, cached results and prefix indexes of the
+    autocompletes registered with ``site`` under ``keys`` (or all of them)
+    up to date as rows of their models change. At most ``max_size`` changed
+    rows are buffered.
+    """
+    def __init__(self, site, keys=None, max_size=1000, flush_interval=1.0,
+                 index_interval=300, invalidate_interval=60, reconcile_interval=None):
+        self.site = site
+        self.keys = keys
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.index_interval = index_interval
+        self.invalidate_interval = invalidate_interval
+        self.reconcile_interval = reconcile_interval
+        self.stale_indexes = set()
+        self.last_index_build = time.time()
+        self.stale_caches = set()
+        self.last_invalidation = time.time()
+        self.pending = {}
+        self.oldest = None
+        self.models = {}
+        self.stashed = set()
+        self.lock = threading.Lock()
+        self.apply_lock = threading.Lock()
+        self.thread = None
+        self.stopped = threading.Event()
+        self.last_reconcile = time.time()
+        self.stats = {
+            'changes': 0,
+            'coalesced': 0,
+            'flushes': 0,
+            'full_flushes': 0,
+            'flushed_rows': 0,
+            'last_flush': None,
+            'last_lag': None,
+            'max_lag': 0.0,
+            'index_builds': 0,
+            'invalidations': 0,
+            'reconciliations': 0,
+            'errors': 0,
+        }
+
+    def get_keys(self):
+        """
+        Get the keys of the autocompletes with precomputed results, cached
+        results or a prefix index to maintain.
+        """
+        keys = []
+        for key in self.keys or self.site.get_keys():
+            autocomplete = self.site.get_autocomplete(key)
+            cached = autocomplete.get_cache_timeout() is not None
+            if (autocomplete.get_precompute_length() > 0 or cached or
+                    autocomplete.get_index_path() is not None):
+                keys.append(key)
+        return keys
+
+    def get_autocomplete(self, key):
+        """
+        Get the autocomplete registered as ``key``, with a request made as an
+        anonymous user.
+        """
+        autocomplete = self.site.get_autocomplete(key)
+        autocomplete.request = make_request(autocomplete.query_param, u'')
+        return autocomplete
+
+    def get_model(self, key):
+        """
+        Get the model searched by the autocomplete registered as ``key``.
+        """
+        autocomplete = self.get_autocomplete(key)
+        if autocomplete.model is not None:
+            return autocomplete.model
+        return autocomplete.get_queryset().model
+
+    def connect(self):
+        """
+        Connect the signal handlers recording changes to the models of the
+        maintained autocompletes, and flush at the end of each request.
+        """
+        self.models = {}
+        self.stashed = set()
+        for key in self.get_keys():
+            self.models.setdefault(self.get_model(key), []).append(key)
+            autocomplete = self.get_autocomplete(key)
+            if autocomplete.get_precompute_length() > 0:
+                check_lookups(autocomplete)
+                self.stashed.add(key)
+        for model in self.models:
+            uid = self.get_uid(model)
+            for signal, handler in ((signals.pre_save, self.before_change),
+                                    (signals.post_save, self.after_change),
+                                    (signals.pre_delete, self.before_change),
+                                    (signals.post_delete, self.after_change)):
+                signal.connect(handler, sender=model, weak=False, dispatch_uid=uid)
+            for field in self.get_relations(model):
+                signals.m2m_changed.connect(
+                    self.m2m_changed, sender=field.rel.through, weak=False, dispatch_uid=uid
+                )
+        request_signals.request_finished.connect(
+            self.request_finished, weak=False, dispatch_uid=self.get_uid(None)
+        )
+
+    def disconnect(self):
+        """
+        Disconnect the signal handlers.
+        """
+        for model in self.models:
+            uid = self.get_uid(model)
+            for signal in (signals.pre_save, signals.post_save,
+                           signals.pre_delete, signals.post_delete):
+                signal.disconnect(sender=model, dispatch_uid=uid)
+            for field in self.get_relations(model):
+                signals.m2m_changed.disconnect(sender=field.rel.through, dispatch_uid=uid)
+        request_signals.request_finished.disconnect(dispatch_uid=self.get_uid(None))
+        self.models = {}
+
+    def get_relations(self, model):
+        """
+        Get the many-to-many fields of ``model`` spanned by the search fields
+        of its maintained autocompletes.
+        """
+        names = set()
+        for key in self.models.get(model, ()):
+            for field in self.site.get_autocomplete(key).get_search_fields():
+                names.add(field.split(LOOKUP_SEP)[0])
+        return [field for field in model._meta.many_to_many if field.name in names]
+
+    def get_uid(self, model):
+        if model is None:
+            return 'fancy_autocomplete.maintenance.%s' % id(self)
+        return 'fancy_autocomplete.maintenance.%s.%s.%s' % (
+            id(self), model._meta.app_label, model._meta.object_name
+        )
+
+    def before_change(self, sender, instance, **kwargs):
+        if instance.pk is not None:
+            self.record(sender, [instance.pk])
+
+    def after_change(self, sender, instance, **kwargs):
+        if instance.pk is not None:
+            self.record(sender, [instance.pk], True)
+
+    def m2m_changed(self, sender, instance, action, reverse, model, pk_set, **kwargs):
+        if not reverse:
+            self.record(type(instance), [instance.pk], action.startswith('post_'))
+            return
+        # The instance is on the other side of the relation, and the changed
+        # rows of the maintained model are in pk_set, or all of the rows
+        # related to the instance when it is cleared.
+        if model not in self.models:
+            return
+        if pk_set is None:
+            pk_set = []
+            for field in self.get_relations(model):
+                if field.rel.through is sender:
+                    pk_set = model._default_manager.filter(
+                        **{field.name: instance.pk}
+                    ).values_list('pk', flat=True)
+                    break
+        self.record(model, list(pk_set), action.startswith('post_'))
+
+    def record(self, model, pks, changed=False):
+        """
+        Record a change to the rows of ``model`` with primary keys ``pks``.
+        Before the change (``changed`` false) the prefixes of the rows'
+        current values are stashed, once for each buffered row, so that the
+        precomputed results which no longer include them are refreshed too.
+        """
+        keys = self.models.get(model)
+        if not keys or not pks:
+            return
+        full = False
+        for key in keys:
+            autocomplete = None
+            for pk in pks:
+                prefixes = set()
+                if not changed and key in self.stashed and (key, pk) not in self.pending:
+                    if autocomplete is None:
+                        autocomplete = self.get_autocomplete(key)
+                    prefixes = get_row_prefixes(autocomplete, model, pk)
+                self.lock.acquire()
+                try:
+                    if (key, pk) in self.pending:
+                        self.pending[(key, pk)] |= prefixes
+                        if not changed:
+                            self.stats['coalesced'] += 1
+                    else:
+                        self.pending[(key, pk)] = prefixes
+                        if self.oldest is None:
+                            self.oldest = time.time()
+                    if changed:
+                        self.stats['changes'] += 1
+                    # Flush after changes, so that no row is flushed
+                    # between its stash and its change.
+                    full = changed and len(self.pending) >= self.max_size
+                finally:
+                    self.lock.release()
+        if full:
+            self.stats['full_flushes'] += 1
+            self.flush()
+
+    def get_lag(self):
+        """
+        Get the number of seconds the oldest buffered change has waited.
+        """
+        oldest = self.oldest
+        if oldest is None:
+            return 0.0
+        return time.time() - oldest
+
+    def get_metrics(self):
+        """
+        Get a dictionary of the maintainer's metrics: the size of the buffer
+        and its capacity, the current lag, and the counts and lags of the
+        changes and flushes so far.
+        """
+        self.lock.acquire()
+        try:
+            metrics = dict(self.stats)
+            metrics['buffered'] = len(self.pending)
+            metrics['max_size'] = self.max_size
+            metrics['lag'] = self.get_lag()
+            metrics['stale_indexes'] = len(self.stale_indexes)
+            metrics['last_index_build'] = self.last_index_build
+            metrics['stale_caches'] = len(self.stale_caches)
+            metrics['last_invalidation'] = self.last_invalidation
+            metrics['last_reconcile'] = self.last_reconcile
+        finally:
+            self.lock.release()
+        return metrics
+
+    def flush(self):
+        """
+        Apply the buffered changes. Returns the number of rows applied.
+        """
+        self.apply_lock.acquire()
+        try:
+            self.lock.acquire()
+            try:
+                pending, oldest = self.pending, self.oldest
+                self.pending, self.oldest = {}, None
+            finally:
+                self.lock.release()
+            if not pending:
+                return 0
+            batches = {}
+            for (key, pk), prefixes in pending.items():
+                batches.setdefault(key, {})[pk] = prefixes
+            for key, rows in batches.items():
+                try:
+                    self.apply(key, rows)
+                except Exception:
+                    self.stats['errors'] += 1
+                    logger.exception("Applying changes to '%s' failed", key)
+            lag = time.time() - oldest
+            self.stats['flushes'] += 1
+            self.stats['flushed_rows'] += len(pending)
+            self.stats['last_flush'] = time.time()
+            self.stats['last_lag'] = lag
+            self.stats['max_lag'] = max(self.stats['max_lag'], lag)
+            return len(pending)
+        finally:
+            self.apply_lock.release()
+
+    def apply(self, key, rows):
+        """
+        Apply changes to ``rows``, a dictionary of the prefixes stashed for
+        each changed primary key, to the autocomplete registered as ``key``.
+        """
+        autocomplete = self.get_autocomplete(key)
+        if autocomplete.get_precompute_length() > 0:
+            prefixes = set()
+            for stashed in rows.values():
+                prefixes |= stashed
+            model = self.get_model(key)
+            queryset = model._default_manager.using(get_primary(autocomplete))
+            queryset = queryset.filter(pk__in=rows.keys())
+            prefixes |= get_queryset_prefixes(autocomplete, queryset)
+            if prefixes:
+                precompute(autocomplete, prefixes)
+        if autocomplete.get_cache_timeout() is not None and autocomplete.name:
+            self.stale_caches.add(key)
+        if autocomplete.get_index_path() is not None:
+            self.stale_indexes.add(key)
+
+    def invalidate_caches(self, keys=None):
+        """
+        Invalidate the cached results of the autocompletes registered under
+        ``keys``, or of those changed since their last invalidation.
+        """
+        if keys is None:
+            keys = list(self.stale_caches)
+        for key in keys:
+            self.stale_caches.discard(key)
+            autocomplete = self.get_autocomplete(key)
+            if autocomplete.get_cache_timeout() is None or not autocomplete.name:
+                continue
+            try:
+                autocomplete.invalidate_cache()
+                self.stats['invalidations'] += 1
+            except Exception:
+                self.stats['errors'] += 1
+                logger.exception("Invalidating the cache of '%s' failed", key)
+        self.last_invalidation = time.time()
+
+    def rebuild_indexes(self, keys=None):
+        """
+        Rebuild the prefix indexes of the autocompletes registered under
+        ``keys``, or of those changed since their last rebuild.
+        """
+        from fancy_autocomplete.index import build_index
+        if keys is None:
+            keys = list(self.stale_indexes)
+        for key in keys:
+            self.stale_indexes.discard(key)
+            autocomplete = self.get_autocomplete(key)
+            if autocomplete.get_index_path() is None:
+                continue
+            try:
+                build_index(autocomplete)
+                self.stats['index_builds'] += 1
+            except Exception:
+                self.stats['errors'] += 1
+                logger.exception("Building the index of '%s' failed", key)
+        self.last_index_build = time.time()
+
+    def reconcile(self):
+        """
+        Precompute every prefix, invalidate the cached results and rebuild
+        the index of each maintained autocomplete, repairing changes that
+        the signals did not see.
+        """
+        self.apply_lock.acquire()
+        try:
+            keys = self.get_keys()
+            for key in keys:
+                autocomplete = self.get_autocomplete(key)
+                try:
+                    if autocomplete.get_precompute_length() > 0:
+                        precompute(autocomplete)
+                except Exception:
+                    self.stats['errors'] += 1
+                    logger.exception("Reconciling '%s' failed", key)
+            self.invalidate_caches(keys)
+            self.rebuild_indexes(keys)
+            self.stats['reconciliations'] += 1
+            self.last_reconcile = time.time()
+        finally:
+            self.apply_lock.release()
+
+    def maybe_flush(self):
+        """
+        Flush the buffer if its oldest change is older than the flush
+        interval, invalidate the changed caches and rebuild the changed
+        indexes if their intervals have passed, and reconcile if the
+        reconcile interval has passed.
+        """
+        if self.pending and self.get_lag() >= self.flush_interval:
+            self.flush()
+        if (self.stale_caches and
+                time.time() - self.last_invalidation >= self.invalidate_interval):
+            self.invalidate_caches()
+        if self.stale_indexes and time.time() - self.last_index_build >= self.index_interval:
+            self.apply_lock.acquire()
+            try:
+                self.rebuild_indexes()
+            finally:
+                self.apply_lock.release()
+        if (self.reconcile_interval is not None and
+                time.time() - self.last_reconcile >= self.reconcile_interval):
+            self.reconcile()
+
+    def request_finished(self, **kwargs):
+        self.maybe_flush()
+
+    def start(self):
+        """
+        Start a daemon thread flushing and reconciling in the background,
+        for processes that do not serve requests or serve few of them.
+        """
+        if self.thread is not None:
+            return
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the background thread, applying the buffered changes,
+        invalidating the changed caches and rebuilding the changed indexes.
+        """
+        if self.thread is None:
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+
+    def run(self):
+        try:
+            while not self.stopped.isSet():
+                self.stopped.wait(self.flush_interval)
+                try:
+                    self.maybe_flush()
+                except Exception:
+                    self.stats['errors'] += 1
+                    logger.exception("Maintenance failed")
+            self.flush()
+            self.invalidate_caches()
+            self.rebuild_indexes()
+        finally:
+            for connection in connections.all():
+                connection.close()
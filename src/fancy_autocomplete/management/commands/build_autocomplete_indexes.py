@@ -0,0 +1,38 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from fancy_autocomplete.index import build_index
+from fancy_autocomplete.utils import get_site
+from fancy_autocomplete.views import NotRegistered
+
+
+class Command(BaseCommand):
+    help = ('Builds the prefix index files of the autocompletes registered with a '
+            'site with an index_path. Run it periodically to refresh the indexes.')
+    args = '<site> [key key ...]'
+
+    def handle(self, site_path=None, *keys, **options):
+        if site_path is None:
+            raise CommandError('Enter the dotted path of an autocomplete site.')
+        try:
+            site = get_site(site_path)
+        except ImproperlyConfigured as e:
+            raise CommandError(str(e))
+        if not keys:
+            keys = site.get_keys()
+        verbosity = int(options.get('verbosity', 1))
+        for key in keys:
+            try:
+                autocomplete = site.get_autocomplete(key)
+            except NotRegistered as e:
+                raise CommandError(str(e))
+            if autocomplete.get_index_path() is None:
+                if verbosity > 1:
+                    self.stdout.write("Skipping '%s'\n" % key)
+                continue
+            try:
+                count = build_index(autocomplete)
+            except ImproperlyConfigured as e:
+                raise CommandError(str(e))
+            if verbosity > 0:
+                self.stdout.write("Indexed %d terms for '%s'\n" % (count, key))
@@ -0,0 +1,76 @@
+from optparse import make_option
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from fancy_autocomplete.loadtest import ClientTarget, HttpTarget, make_traces, read_traces, run, write_traces
+from fancy_autocomplete.utils import get_site
+from fancy_autocomplete.views import NotRegistered
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--url', action='store', dest='url', default='/autocomplete/%s/',
+            help='The URL of the autocompletes, with %s standing for the key. Defaults to /autocomplete/%s/.'),
+        make_option('--server', action='store', dest='server', default=None,
+            help='The base URL of a running server to request. By default requests are made through the test client.'),
+        make_option('--traces', action='store', dest='traces', default=None,
+            help='A file of recorded traces to replay. By default traces are made up from the data.'),
+        make_option('--save-traces', action='store', dest='save_traces', default=None,
+            help='Write the replayed traces to this file.'),
+        make_option('--users', action='store', dest='users', type='int', default=20,
+            help='The number of traces to make up. Defaults to 20.'),
+        make_option('--concurrency', action='store', dest='concurrency', type='int', default=4,
+            help='The number of users typing at once. Defaults to 4.'),
+        make_option('--speed', action='store', dest='speed', type='float', default=1.0,
+            help='How many times faster than the traces to type, or 0 not to wait between keystrokes. Defaults to 1.'),
+        make_option('--seed', action='store', dest='seed', type='int', default=None,
+            help='The random seed for making up traces.'),
+    )
+    help = 'Replays typing traces against the autocompletes registered with a site.'
+    args = '<site> [key key ...]'
+
+    def handle(self, site_path=None, *keys, **options):
+        if site_path is None:
+            raise CommandError('Enter the dotted path of an autocomplete site.')
+        try:
+            site = get_site(site_path)
+        except ImproperlyConfigured as e:
+            raise CommandError(str(e))
+        try:
+            if options.get('traces'):
+                traces = read_traces(options['traces'])
+            else:
+                traces = make_traces(site, keys or None, options['users'], seed=options.get('seed'))
+            if options.get('save_traces'):
+                write_traces(traces, options['save_traces'])
+        except (IOError, ValueError, NotRegistered) as e:
+            raise CommandError(str(e))
+        if options.get('server'):
+            target = HttpTarget(options['server'], options['url'])
+        else:
+            target = ClientTarget(options['url'])
+        report = run(target, traces, options['concurrency'], options['speed'])
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write(format_report(report))
+
+
+def format_report(report):
+    """
+    Format the report returned by ``run`` as lines of text.
+    """
+    lines = [
+        'Requests: %d (%d errors)' % (report['requests'], report['errors']),
+        'Elapsed: %.2fs' % report['elapsed'],
+    ]
+    if report['throughput'] is not None:
+        lines.append('Throughput: %.1f requests/s' % report['throughput'])
+    latency = report['latency']
+    if latency['max'] is not None:
+        lines.append('Latency: p50 %.1fms, p90 %.1fms, p99 %.1fms, max %.1fms' % tuple(
+            latency[name] * 1000 for name in ('p50', 'p90', 'p99', 'max')
+        ))
+    if report['queries'] is not None:
+        lines.append('Queries: %d (%.2f per request)' % (report['queries'], report['queries_per_request']))
+        lines.append('Answered without queries: %.1f%%' % (report['cached_ratio'] * 100))
+    return '\n'.join(lines) + '\n'
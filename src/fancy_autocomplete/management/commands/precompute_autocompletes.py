@@ -0,0 +1,48 @@
+from optparse import make_option
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from fancy_autocomplete.precompute import precompute
+from fancy_autocomplete.utils import get_site
+from fancy_autocomplete.views import NotRegistered
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--length', action='store', dest='length', type='int', default=None,
+            help='Precompute prefixes up to this length, overriding the autocompletes\' precompute_length.'),
+    )
+    help = ('Precomputes the results for short query prefixes of the autocompletes '
+            'registered with a site. Run it periodically to refresh the results.')
+    args = '<site> [key key ...]'
+
+    def handle(self, site_path=None, *keys, **options):
+        if site_path is None:
+            raise CommandError('Enter the dotted path of an autocomplete site.')
+        try:
+            site = get_site(site_path)
+        except ImproperlyConfigured as e:
+            raise CommandError(str(e))
+        if not keys:
+            keys = site.get_keys()
+        length = options.get('length')
+        verbosity = int(options.get('verbosity', 1))
+        for key in keys:
+            try:
+                autocomplete = site.get_autocomplete(key)
+            except NotRegistered as e:
+                raise CommandError(str(e))
+            if length is not None:
+                autocomplete.precompute_length = length
+            if autocomplete.get_precompute_length() <= 0:
+                if verbosity > 1:
+                    self.stdout.write("Skipping '%s'\n" % key)
+                continue
+            try:
+                count = transaction.commit_on_success(precompute)(autocomplete)
+            except ImproperlyConfigured as e:
+                raise CommandError(str(e))
+            if verbosity > 0:
+                self.stdout.write("Precomputed %d prefixes for '%s'\n" % (count, key))
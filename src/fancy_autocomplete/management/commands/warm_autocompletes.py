@@ -0,0 +1,55 @@
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from fancy_autocomplete.utils import get_site
+from fancy_autocomplete.views import NotRegistered
+from fancy_autocomplete.warming import get_tasks, read_corpus, warm
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--prefixes', action='store', dest='prefixes', default=None,
+            help='A file of query prefixes to warm, one per line. By default the prefixes are taken from the data.'),
+        make_option('--length', action='store', dest='length', type='int', default=2,
+            help='The maximum length of prefixes taken from the data. Defaults to 2.'),
+        make_option('--workers', action='store', dest='workers', type='int', default=4,
+            help='The number of concurrent requests to make. Defaults to 4.'),
+        make_option('--user', action='store', dest='username', default=None,
+            help='Make the requests as the user with this username.'),
+    )
+    help = 'Fills the response cache of the autocompletes registered with a site.'
+    args = '<site> [key key ...]'
+
+    def handle(self, site_path=None, *keys, **options):
+        if site_path is None:
+            raise CommandError('Enter the dotted path of an autocomplete site.')
+        try:
+            site = get_site(site_path)
+        except ImproperlyConfigured as e:
+            raise CommandError(str(e))
+        prefixes = None
+        if options.get('prefixes'):
+            try:
+                prefixes = read_corpus(options['prefixes'])
+            except IOError as e:
+                raise CommandError(str(e))
+        user = None
+        if options.get('username'):
+            try:
+                user = User.objects.get(username=options['username'])
+            except User.DoesNotExist:
+                raise CommandError("User '%s' does not exist." % options['username'])
+        try:
+            tasks = get_tasks(site, keys or None, prefixes, options['length'])
+        except NotRegistered as e:
+            raise CommandError(str(e))
+        count, failures = warm(site, tasks, options['workers'], user)
+        verbosity = int(options.get('verbosity', 1))
+        if verbosity > 1:
+            for key, prefix, error in failures:
+                self.stderr.write("Failed to warm '%s' for %r: %s\n" % (key, prefix, error))
+        if verbosity > 0:
+            self.stdout.write("Warmed %d of %d queries.\n" % (count, len(tasks)))
@@ -0,0 +1,44 @@
+import hashlib
+
+from django.db import models
+
+
+class PrecomputedResult(models.Model):
+    """
+    The serialized response of a named autocomplete for a short query prefix.
+    Names are qualified by the autocomplete's site.
+    """
+    key = models.CharField(max_length=40, primary_key=True)
+    name = models.CharField(max_length=100, db_index=True)
+    prefix = models.CharField(max_length=100)
+    content = models.TextField()
+    updated = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.name, self.prefix)
+
+    @staticmethod
+    def make_key(name, prefix):
+        """
+        Get the primary key for an autocomplete's qualified ``name`` and query
+        ``prefix``.
+        """
+        value = u'%s\x00%s' % (name, prefix)
+        return hashlib.sha1(value.encode('utf-8')).hexdigest()
+
+
+class Selection(models.Model):
+    """
+    The number of times users chose an object from the results of a named
+    autocomplete for a query. Names are qualified by the autocomplete's site.
+    """
+    name = models.CharField(max_length=100)
+    query = models.CharField(max_length=100)
+    object_key = models.CharField(max_length=100)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = (('name', 'query', 'object_key'),)
+
+    def __unicode__(self):
+        return u'%s: %s -> %s' % (self.name, self.query, self.object_key)
@@ -0,0 +1,105 @@
+"""
+Compiled search statements.
+
+Only the query changes from one autocomplete request to the next, yet each
+request builds the ``Q`` objects, clones the ``QuerySet`` and compiles its SQL
+again. A ``QueryPlan`` holds the SQL compiled once for a probe query, and
+runs it for other queries by substituting them for the probe in its
+parameters.
+"""
+from django.db import connections
+
+# A query that LIKE escaping leaves alone, so that it is found in parameters
+# whatever the lookup.
+PROBE = u'fancyautocompleteprobe'
+# Lookups whose parameters are the query escaped for LIKE, and those whose
+# parameters are the query itself. The parameters of ``iexact`` are prepared
+# as each backend's ``prep_for_iexact_query`` does, which escapes for LIKE on
+# some backends only.
+LIKE_LOOKUPS = ('contains', 'icontains', 'startswith', 'istartswith',
+                'endswith', 'iendswith')
+IEXACT_LOOKUPS = ('iexact',)
+RAW_LOOKUPS = ('exact',)
+MAX_PLANS = 1000
+
+_plans = {}
+
+
+class QueryPlan(object):
+    """
+    The SQL of a ``QuerySet`` compiled for the probe query, to be run for any
+    query on the database ``alias``. Queries are prepared with the function
+    ``prep``, as the lookups prepare them, before substitution.
+    """
+    def __init__(self, queryset, alias, prep):
+        self.query = queryset.query
+        self.alias = alias
+        self.prep = prep
+        self.sql, self.params = self.query.get_compiler(using=alias).as_sql()
+        self.params = tuple(self.params)
+        if not [param for param in self.params if self.is_probe(param)]:
+            raise ValueError("The probe query was not found in the parameters.")
+
+    def is_probe(self, param):
+        return isinstance(param, basestring) and PROBE in param
+
+    def get_params(self, query):
+        """
+        Get the statement parameters for ``query``.
+        """
+        query = self.prep(query)
+        return [
+            param.replace(PROBE, query) if self.is_probe(param) else param
+            for param in self.params
+        ]
+
+    def execute(self, query):
+        """
+        Run the statement for ``query``, returning the list of result rows as
+        the ``QuerySet`` would produce them.
+        """
+        compiler = self.query.get_compiler(using=self.alias)
+        sql, params = self.sql, self.get_params(query)
+        compiler.as_sql = lambda with_limits=True, with_col_aliases=False: (sql, params)
+        return [tuple(row) for row in compiler.results_iter()]
+
+
+def _raw(query):
+    return query
+
+
+def get_prep(lookups, alias):
+    """
+    Get the function preparing queries as the given lookups do on the
+    database ``alias``. Returns ``None`` if the lookups prepare queries
+    differently, and so cannot share a plan, or are not supported.
+    """
+    ops = connections[alias].ops
+    preps = set()
+    for lookup in lookups:
+        if lookup in LIKE_LOOKUPS:
+            preps.add(ops.prep_for_like_query)
+        elif lookup in IEXACT_LOOKUPS:
+            preps.add(ops.prep_for_iexact_query)
+        elif lookup in RAW_LOOKUPS:
+            preps.add(_raw)
+        else:
+            return None
+    if len(preps) != 1:
+        return None
+    return preps.pop()
+
+
+def get_plan(key, source, build):
+    """
+    Get the plan cached under ``key`` for the queryset or model ``source``,
+    calling ``build`` to make it if there is none. The source is kept with
+    the plan, so its ``id`` used in keys is not reused while the plan is
+    cached.
+    """
+    entry = _plans.get(key)
+    if entry is None or entry[0] is not source:
+        if len(_plans) >= MAX_PLANS:
+            _plans.popitem()
+        entry = _plans[key] = (source, build())
+    return entry[1]
@@ -0,0 +1,135 @@
+"""
+Ranking of autocomplete results by how often users choose them.
+
+Selections are counted in memory by a ``SelectionCounter`` and flushed to the
+``Selection`` table in aggregated form after requests finish and when the
+process exits. Autocompletes with
+``ordering = 'popularity'`` list the objects most often chosen for the
+current query first.
+"""
+import atexit
+import threading
+import time
+
+from django.core.signals import request_finished
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from fancy_autocomplete.models import Selection
+
+MAX_QUERY_LENGTH = Selection._meta.get_field('query').max_length
+
+
+def normalize_query(query):
+    """
+    Normalize a query for counting selections.
+    """
+    return query.strip().lower()[:MAX_QUERY_LENGTH]
+
+
+class SelectionCounter(object):
+    """
+    Aggregates selection counts in memory. Once connected, the counts are
+    written to the database after a request finishes when ``max_size``
+    distinct counts are held or ``flush_interval`` seconds have passed since
+    the last write, and when the process exits.
+    """
+    def __init__(self, max_size=1000, flush_interval=60):
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.counts = {}
+        self.last_flush = time.time()
+        self.lock = threading.Lock()
+
+    def record(self, name, query, key):
+        """
+        Count a selection of the object with primary key ``key`` for ``query``
+        and each of its prefixes.
+        """
+        query = normalize_query(query)
+        key = unicode(key)
+        self.lock.acquire()
+        try:
+            for i in range(1, len(query) + 1):
+                entry = (name, query[:i], key)
+                self.counts[entry] = self.counts.get(entry, 0) + 1
+        finally:
+            self.lock.release()
+
+    def is_due(self):
+        """
+        Should the counts held in memory be written to the database?
+        """
+        return self.counts and (
+            len(self.counts) >= self.max_size or
+            time.time() - self.last_flush >= self.flush_interval
+        )
+
+    def maybe_flush(self, **kwargs):
+        """
+        Flush the counts if they are due. Connected to ``request_finished``,
+        so counts are written once the response has been sent rather than
+        while the user waits for it.
+        """
+        if self.is_due():
+            self.flush()
+
+    def connect(self):
+        """
+        Flush the counts when they are due after each request and when the
+        process exits.
+        """
+        request_finished.connect(
+            self.maybe_flush, weak=False, dispatch_uid=('selection-counter', id(self))
+        )
+        atexit.register(self.flush)
+
+    def disconnect(self):
+        """
+        Stop flushing the counts after each request.
+        """
+        request_finished.disconnect(dispatch_uid=('selection-counter', id(self)))
+
+    def flush(self):
+        """
+        Add the counts held in memory to the database.
+        """
+        self.lock.acquire()
+        try:
+            counts, self.counts = self.counts, {}
+            self.last_flush = time.time()
+        finally:
+            self.lock.release()
+        if not counts:
+            return
+        for (name, query, key), count in counts.iteritems():
+            selections = Selection.objects.filter(name=name, query=query, object_key=key)
+            if selections.update(count=F('count') + count):
+                continue
+            sid = transaction.savepoint()
+            try:
+                Selection.objects.create(name=name, query=query, object_key=key, count=count)
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+                selections.update(count=F('count') + count)
+            else:
+                transaction.savepoint_commit(sid)
+        transaction.commit_unless_managed()
+
+counter = SelectionCounter()
+counter.connect()
+
+
+def get_popular_keys(name, query, model, limit=None, using=None):
+    """
+    Get the primary keys of the ``model`` objects most often chosen from the
+    results of the autocomplete ``name`` for ``query``, most popular first.
+    """
+    selections = Selection.objects.using(using).filter(
+        name=name,
+        query=normalize_query(query)
+    ).order_by('-count')
+    if limit is not None:
+        selections = selections[:limit]
+    to_python = model._meta.pk.to_python
+    return [to_python(key) for key in selections.values_list('object_key', flat=True)]
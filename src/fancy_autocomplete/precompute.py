@@ -0,0 +1,168 @@
+"""
+Precomputation of autocomplete responses for short query prefixes.
+
+Short prefixes match the most rows and make the most expensive queries, but
+their results rarely change. Autocompletes with a ``precompute_length`` serve
+queries up to that length from the ``PrecomputedResult`` table, which is
+filled by the ``precompute_autocompletes`` management command and may be kept
+current by connecting the model signal handlers with ``connect_signals``.
+"""
+from datetime import datetime
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import router
+from django.db.models import signals
+
+from fancy_autocomplete.index import PREFIX_LOOKUPS
+from fancy_autocomplete.models import PrecomputedResult
+from fancy_autocomplete.utils import make_request
+
+
+def check_lookups(autocomplete):
+    """
+    Raise ``ImproperlyConfigured`` unless every search field of
+    ``autocomplete`` uses a prefix lookup. With other lookups a change to a
+    row changes the results of prefixes of any part of its values, which
+    cannot be refreshed row by row.
+    """
+    lookups = [autocomplete.get_lookup(field) for field in autocomplete.get_search_fields()]
+    if [lookup for lookup in lookups if lookup not in PREFIX_LOOKUPS]:
+        raise ImproperlyConfigured(
+            "Only autocompletes using the %s lookups can be precomputed." % ' or '.join(PREFIX_LOOKUPS)
+        )
+
+
+def get_primary(autocomplete):
+    """
+    Get the alias of the database rows of the autocomplete's model are
+    written to, which sees changes before any replica does.
+    """
+    return router.db_for_write(autocomplete.get_queryset().model)
+
+
+def get_prefixes(autocomplete, values, length=None):
+    """
+    Get the set of normalized prefixes of the given search field ``values``
+    up to ``length``, which defaults to the autocomplete's precompute length.
+    """
+    if length is None:
+        length = autocomplete.get_precompute_length()
+    prefixes = set()
+    for value in values:
+        if not value:
+            continue
+        value = autocomplete.get_prefix(unicode(value))
+        for i in range(1, min(len(value), length) + 1):
+            prefixes.add(value[:i])
+    return prefixes
+
+
+def get_queryset_prefixes(autocomplete, queryset=None, length=None):
+    """
+    Get the set of prefixes of the search field values of every row in
+    ``queryset``, which defaults to the autocomplete's queryset.
+    """
+    if queryset is None:
+        queryset = autocomplete.get_queryset().using(get_primary(autocomplete))
+    fields = autocomplete.get_search_fields()
+    values = (value for row in queryset.values_list(*fields).iterator() for value in row)
+    return get_prefixes(autocomplete, values, length)
+
+
+def precompute(autocomplete, prefixes=None):
+    """
+    Store the serialized results of ``autocomplete`` for each of the given
+    ``prefixes``. If no prefixes are given, results are computed for every
+    prefix found in the autocomplete's queryset and results for prefixes
+    that no longer occur are removed. Returns the number of stored results.
+    Searches are run on the primary database, so that results refreshed
+    after a change include it.
+    """
+    check_lookups(autocomplete)
+    full = prefixes is None
+    started = datetime.now()
+    if full:
+        prefixes = get_queryset_prefixes(autocomplete)
+    name = autocomplete.get_qualified_name()
+    using = autocomplete.using
+    autocomplete.using = get_primary(autocomplete)
+    count = 0
+    try:
+        for prefix in prefixes:
+            autocomplete.request = make_request(autocomplete.query_param, prefix)
+            results = autocomplete.get_result_queryset()
+            PrecomputedResult(
+                key=PrecomputedResult.make_key(name, prefix),
+                name=name,
+                prefix=prefix,
+                content=autocomplete.serialize_results(results)
+            ).save()
+            count += 1
+    finally:
+        autocomplete.using = using
+    if full:
+        stale = PrecomputedResult.objects.filter(
+            name=name,
+            updated__lt=started
+        )
+        stale.delete()
+    return count
+
+
+def get_row_prefixes(autocomplete, model, pk):
+    """
+    Get the set of prefixes of the current search field values of the row
+    with primary key ``pk``, whether or not it is in the autocomplete's
+    queryset.
+    """
+    queryset = model._default_manager.using(get_primary(autocomplete)).filter(pk=pk)
+    return get_queryset_prefixes(autocomplete, queryset)
+
+
+def connect_signals(site, keys=None):
+    """
+    Refresh the precomputed results of the autocompletes registered with
+    ``site`` under ``keys`` (or all precomputed autocompletes) whenever an
+    instance of their model is saved or deleted.
+    """
+    if keys is None:
+        keys = site.get_keys()
+    for key in keys:
+        autocomplete = site.get_autocomplete(key)
+        if autocomplete.get_precompute_length() <= 0:
+            continue
+        check_lookups(autocomplete)
+        model = autocomplete.get_queryset().model
+        handlers = _make_handlers(site, key, model)
+        uid = 'fancy_autocomplete.precompute.%s.%s' % (id(site), key)
+        signals.pre_save.connect(handlers[0], sender=model, weak=False, dispatch_uid=uid)
+        signals.post_save.connect(handlers[1], sender=model, weak=False, dispatch_uid=uid)
+        signals.pre_delete.connect(handlers[0], sender=model, weak=False, dispatch_uid=uid)
+        signals.post_delete.connect(handlers[1], sender=model, weak=False, dispatch_uid=uid)
+
+
+def _make_handlers(site, key, model):
+    """
+    Build the signal handlers refreshing the autocomplete registered as
+    ``key``. Prefixes of the values a row had before the change are stashed on
+    the instance so that results which no longer include the row are updated.
+    """
+    attname = '_fancy_autocomplete_prefixes'
+
+    def before_change(sender, instance, **kwargs):
+        prefixes = getattr(instance, attname, None)
+        if prefixes is None:
+            prefixes = {}
+            setattr(instance, attname, prefixes)
+        if instance.pk is not None:
+            autocomplete = site.get_autocomplete(key)
+            prefixes[key] = get_row_prefixes(autocomplete, model, instance.pk)
+
+    def after_change(sender, instance, **kwargs):
+        autocomplete = site.get_autocomplete(key)
+        prefixes = getattr(instance, attname, {}).pop(key, set())
+        prefixes |= get_row_prefixes(autocomplete, model, instance.pk)
+        if prefixes:
+            precompute(autocomplete, prefixes)
+
+    return before_change, after_change
@@ -0,0 +1,96 @@
+"""
+Sampled profiling of autocomplete requests.
+
+Set ``profiler`` on an ``AutocompleteSite`` to a ``SamplingProfiler`` to
+profile a random sample of its requests with ``cProfile``. Statistics are
+aggregated in memory for each key, per process, and may be read through the
+site's ``profile_stats`` view.
+"""
+from StringIO import StringIO
+import cProfile
+import pstats
+import random
+import threading
+
+
+class SamplingProfiler(object):
+    """
+    Profiles about ``sample_rate`` of the requests passed to it, keeping the
+    aggregated statistics of the profiled requests of each key.
+    """
+    def __init__(self, sample_rate=0.01):
+        self.sample_rate = sample_rate
+        self.stats = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def should_profile(self):
+        """
+        Whether to profile the next request.
+        """
+        return random.random() < self.sample_rate
+
+    def profile(self, key, func, *args, **kwargs):
+        """
+        Call ``func``, adding its profile to the statistics for ``key``.
+        """
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            self.add(key, profile)
+
+    def add(self, key, profile):
+        """
+        Add a profile to the statistics for ``key``.
+        """
+        self.lock.acquire()
+        try:
+            if key in self.stats:
+                self.stats[key].add(profile)
+            else:
+                self.stats[key] = pstats.Stats(profile, stream=StringIO())
+            self.counts[key] = self.counts.get(key, 0) + 1
+        finally:
+            self.lock.release()
+
+    def get_keys(self):
+        """
+        Get the sorted list of keys with profiled requests.
+        """
+        return sorted(self.stats.keys())
+
+    def report(self, key, sort='cumulative', limit=30):
+        """
+        Get a text report of the statistics for ``key``, sorted by ``sort``
+        and showing the top ``limit`` functions.
+        """
+        stream = StringIO()
+        self.lock.acquire()
+        try:
+            stats = self.stats.get(key)
+            stream.write('%d requests profiled for %s\n' % (self.counts.get(key, 0), key))
+            if stats is not None:
+                stats.stream = stream
+                try:
+                    stats.sort_stats(sort).print_stats(limit)
+                finally:
+                    stats.stream = StringIO()
+        finally:
+            self.lock.release()
+        return stream.getvalue()
+
+    def reset(self, key=None):
+        """
+        Discard the statistics for ``key``, or for every key.
+        """
+        self.lock.acquire()
+        try:
+            if key is None:
+                self.stats.clear()
+                self.counts.clear()
+            else:
+                self.stats.pop(key, None)
+                self.counts.pop(key, None)
+        finally:
+            self.lock.release()
@@ -0,0 +1,86 @@
+/*
+ * Binds the text inputs rendered by AutocompleteInput and
+ * AutocompleteSelectMultiple to their autocomplete views.
+ */
+(function($) {
+    function bind(input) {
+        var $input = $(input),
+            url = $input.attr('data-autocomplete-url'),
+            name = $input.attr('data-autocomplete-name'),
+            id = $input.attr('id'),
+            $values = $('#' + id + '_values'),
+            $menu = $('<ul class="fancy-autocomplete-menu"></ul>'),
+            timer = null,
+            last = null;
+
+        $menu.css({
+            position: 'absolute',
+            listStyle: 'none',
+            margin: 0,
+            padding: 0,
+            background: '#fff',
+            border: '1px solid #ccc',
+            zIndex: 1000
+        }).hide().insertAfter($input);
+        $input.attr('autocomplete', 'off');
+
+        function search() {
+            var term = $input.val();
+            if (term === last) {
+                return;
+            }
+            last = term;
+            if (!name) {
+                $('#' + id + '_value').val('');
+            }
+            if (!term) {
+                $menu.hide();
+                return;
+            }
+            $.getJSON(url, {q: term}, function(data) {
+                if (term !== last) {
+                    return;
+                }
+                $menu.empty();
+                $.each(data, function(i, item) {
+                    $('<li></li>').text(item[1]).data('item', item).css({
+                        padding: '2px 4px',
+                        cursor: 'pointer'
+                    }).appendTo($menu);
+                });
+                $menu.toggle(data.length > 0);
+            });
+        }
+
+        $input.keyup(function() {
+            clearTimeout(timer);
+            timer = setTimeout(search, 150);
+        });
+        $input.blur(function() {
+            setTimeout(function() { $menu.hide(); }, 200);
+        });
+        $menu.delegate('li', 'click', function() {
+            var item = $(this).data('item');
+            if (name) {
+                var $item = $('<li></li>').text(item[1]);
+                $('<input type="hidden">').attr('name', name).val(item[0]).appendTo($item);
+                $values.append($item);
+                $input.val('');
+            } else {
+                $('#' + id + '_value').val(item[0]);
+                $input.val(item[1]);
+            }
+            last = $input.val();
+            $menu.hide();
+        });
+        $values.delegate('li', 'click', function() {
+            $(this).remove();
+        });
+    }
+
+    $(function() {
+        $('input[data-autocomplete-url]').each(function() {
+            bind(this);
+        });
+    });
+})(django.jQuery);
@@ -0,0 +1,183 @@
+"""
+Autocomplete sessions over a single long-lived connection.
+
+Every keystroke sent as its own request passes through the middleware,
+session and authentication lookups before reaching an autocomplete. An
+``AutocompleteSession`` authorizes its client once and then answers a stream
+of query messages, each a JSON object with the ``key`` of an autocomplete, the
+query ``q`` and a client sequence number ``seq``. Each answer is a line of
+JSON with the same ``key`` and ``seq``, the ``status`` code and the
+``results``, with a ``status`` of 500 for a query whose search failed. Queries for a key that are superseded by a newer query before
+they are searched are dropped unanswered.
+
+``AutocompleteSite.stream`` serves sessions over a WebSocket provided by the
+server as ``wsgi.websocket``. Without one, a ``POST`` request is answered as a
+single batch: Django reads the whole request body before any of it can be
+answered, so the messages of a request cannot be answered as they arrive.
+"""
+from Queue import Queue, Empty
+import threading
+
+from django.db import transaction
+from django.utils import simplejson
+
+from fancy_autocomplete.utils import make_request
+from fancy_autocomplete.views import NotRegistered
+
+_END = object()
+
+
+class AutocompleteSession(object):
+    """
+    Answers the query messages of one client of ``site``. The client's
+    ``request`` must have been authorized by the site.
+    """
+    def __init__(self, site, request):
+        self.site = site
+        self.request = request
+        self.authorized = {}
+        self.last_seq = {}
+
+    def is_authorized(self, key):
+        """
+        Is the client authorized to use the autocomplete registered as
+        ``key``? Each autocomplete is asked once per session.
+        """
+        if key not in self.authorized:
+            autocomplete = self.site.get_autocomplete(key)
+            autocomplete.request = self.request
+            self.authorized[key] = autocomplete.is_authorized()
+        return self.authorized[key]
+
+    def parse(self, data):
+        """
+        Parse a raw message, returning ``None`` if it is not a valid query.
+        """
+        try:
+            message = simplejson.loads(data)
+        except ValueError:
+            return None
+        if not isinstance(message, dict) or not isinstance(message.get('key'), basestring):
+            return None
+        message.setdefault('q', u'')
+        message.setdefault('seq', None)
+        return message
+
+    def get_latest(self, messages):
+        """
+        Drop the messages superseded by a later message for the same key, or
+        with a sequence number lower than one already answered.
+        """
+        latest = {}
+        for message in messages:
+            latest[message['key']] = message
+        current = []
+        for message in messages:
+            key, seq = message['key'], message['seq']
+            if latest[key] is not message:
+                continue
+            if seq is not None and self.last_seq.get(key) is not None and seq < self.last_seq[key]:
+                continue
+            current.append(message)
+        return current
+
+    def answer(self, message):
+        """
+        Search for a query message, returning the line of JSON answering it.
+        """
+        key, seq = message['key'], message['seq']
+        self.last_seq[key] = seq
+        try:
+            authorized = self.is_authorized(key)
+        except NotRegistered:
+            return self.format(key, seq, 404)
+        if not authorized:
+            return self.format(key, seq, 403)
+        autocomplete = self.site.get_autocomplete(key)
+        autocomplete.request = make_request(
+            autocomplete.query_param, unicode(message['q']), base=self.request
+        )
+        try:
+            response = autocomplete.respond()
+        except Exception:
+            # A failed search, such as a database error, answers this query
+            # with an error without ending the rest of the session.
+            transaction.rollback_unless_managed(using=autocomplete.get_using())
+            return self.format(key, seq, 500)
+        if response.status_code != 200:
+            return self.format(key, seq, response.status_code)
+        return self.format(key, seq, 200, response.content)
+
+    def format(self, key, seq, status, content='null'):
+        """
+        Format an answer. The response ``content`` is already serialized.
+        """
+        return '{"key": %s, "seq": %s, "status": %d, "results": %s}\n' % (
+            simplejson.dumps(key), simplejson.dumps(seq), status, content
+        )
+
+    def run(self, source):
+        """
+        Answer the raw messages from the iterable ``source``, yielding lines
+        of JSON. Messages are read in a separate thread, so that those
+        arriving while a query is searched can supersede each other.
+        """
+        queue = Queue()
+
+        def read():
+            try:
+                for data in source:
+                    queue.put(data)
+            finally:
+                queue.put(_END)
+        reader = threading.Thread(target=read)
+        reader.setDaemon(True)
+        reader.start()
+        ended = False
+        while not ended:
+            batch = [queue.get()]
+            while True:
+                try:
+                    batch.append(queue.get_nowait())
+                except Empty:
+                    break
+            ended = _END in batch
+            for line in self.answer_batch([data for data in batch if data is not _END]):
+                yield line
+
+    def answer_batch(self, batch):
+        """
+        Answer a list of raw messages, yielding lines of JSON. Invalid
+        messages are answered first, and messages superseded by a later one
+        in the batch are dropped.
+        """
+        messages = []
+        for data in batch:
+            if not data.strip():
+                continue
+            message = self.parse(data)
+            if message is None:
+                yield self.format(None, None, 400)
+            else:
+                messages.append(message)
+        for message in self.get_latest(messages):
+            yield self.answer(message)
+
+
+def serve(site, request):
+    """
+    Serve an autocomplete session over ``request``, which has been authorized
+    by ``site``. Returns the response object. A ``POST`` request's body is
+    answered as one batch of messages.
+    """
+    from django.http import HttpResponse, HttpResponseNotAllowed
+    session = AutocompleteSession(site, request)
+    websocket = request.META.get('wsgi.websocket')
+    if websocket is not None:
+        for line in session.run(iter(websocket.receive, None)):
+            websocket.send(line)
+        return HttpResponse()
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    batch = request.raw_post_data.splitlines()
+    return HttpResponse(session.answer_batch(batch), mimetype='application/x-ndjson')
@@ -1,14 +1,60 @@
+from StringIO import StringIO
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
 from django.test import TestCase, TransactionTestCase
-from django.contrib.auth.models import User, AnonymousUser
+from django.contrib.auth.models import User, AnonymousUser, Group
+from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import request_finished
 from django.http import HttpRequest, Http404
 from django.test import Client
 from django.core.handlers.wsgi import WSGIRequest
+from django.db import DatabaseError, connection
+from django.db.models import Q
 from django.utils import simplejson
+from django.utils.datastructures import MultiValueDict
+
+from django import forms
+from django.conf.urls.defaults import patterns, url, include
+from django.contrib import admin
+from django.contrib.admin.models import LogEntry
+from django.contrib.auth.admin import GroupAdmin, UserAdmin
+
+from fancy_autocomplete.admin import (
+    AdminAutocomplete, AdminAutocompleteInput, AdminAutocompleteSelectMultiple,
+    AutocompleteAdminMixin
+)
 
+from fancy_autocomplete.forms import (
+    AutocompleteInput, AutocompleteModelChoiceField,
+    AutocompleteModelMultipleChoiceField, AutocompleteSelectMultiple
+)
+from fancy_autocomplete.budget import CircuitBreaker, get_breaker, statement_timeout
+from fancy_autocomplete.index import build_index, get_index
+from fancy_autocomplete.loadtest import (
+    ClientTarget, make_traces, percentile, read_traces, run, type_word, write_traces
+)
+from fancy_autocomplete.maintenance import Maintainer
+from fancy_autocomplete.models import PrecomputedResult, Selection
+from fancy_autocomplete.popularity import SelectionCounter, get_popular_keys
+from fancy_autocomplete.precompute import (
+    connect_signals, get_prefixes, get_queryset_prefixes, precompute
+)
+from fancy_autocomplete import plans
+from fancy_autocomplete.profiling import SamplingProfiler
+from fancy_autocomplete.streaming import AutocompleteSession
+from fancy_autocomplete import warming
+from fancy_autocomplete.warming import get_tasks, read_corpus, warm
 from fancy_autocomplete.views import (
     BaseAutocomplete, LabeledAutocomplete, ObjectAutocomplete, AutocompleteSite,
-    AlreadyRegistered, NotRegistered
+    FederatedAutocomplete, AlreadyRegistered, NotRegistered
 )
 
 
@@ -112,6 +158,37 @@ class BaseAutocompleteTest(TestCase):
         autocomplete = TestAutocomplete()
         self.assertEquals(130, autocomplete.get_limit())
 
+    def test_get_using(self):
+        autocomplete = BaseAutocomplete()
+        self.assertEquals(None, autocomplete.get_using())
+        autocomplete = BaseAutocomplete(using='default')
+        self.assertEquals('default', autocomplete.get_using())
+        autocomplete = BaseAutocomplete(using='nonexistent')
+        self.assertRaises(ImproperlyConfigured, autocomplete.get_using)
+
+    def test_get_using_round_robin(self):
+        aliases = ['default', 'default']
+        autocomplete = BaseAutocomplete(using=aliases)
+        self.assertEquals('default', autocomplete.get_using())
+        self.assertEquals('default', autocomplete.get_using())
+        class PoolAutocomplete(BaseAutocomplete):
+            using = ('default', 'replica')
+        from django.db import connections
+        connections.databases['replica'] = connections.databases['default']
+        try:
+            first = PoolAutocomplete().get_using()
+            second = PoolAutocomplete().get_using()
+            self.assertEquals(set(['default', 'replica']), set([first, second]))
+            self.assertEquals(first, PoolAutocomplete().get_using())
+            autocomplete = PoolAutocomplete()
+            autocomplete.request = request_factory.get('/', {'q': 'a'})
+            alias = autocomplete.get_using()
+            self.assertEquals(alias, autocomplete.get_using())
+            autocomplete.request = request_factory.get('/', {'q': 'ab'})
+            self.assertNotEquals(alias, autocomplete.get_using())
+        finally:
+            del connections.databases['replica']
+
     def test_get_search_fields(self):
         autocomplete = BaseAutocomplete()
         self.assertRaises(ImproperlyConfigured, autocomplete.get_search_fields)
@@ -148,6 +225,11 @@ class BaseAutocompleteTest(TestCase):
             unicode(qs.query),
             unicode(autocomplete.get_result_queryset().query)
         )
+
+        autocomplete = BaseAutocomplete(model=User, search_fields=['username'], using='default')
+        request = request_factory.get('/', {'q': 'foo'})
+        autocomplete.request = request
+        self.assertEquals('default', autocomplete.get_result_queryset().db)
     
     def test_get_mimetype(self):
         autocomplete = BaseAutocomplete()
@@ -326,6 +408,46 @@ class ObjectAutocompleteBasicTest(TestCase):
 class ObjectAutocompleteResponseTest(TransactionTestCase):
     fixtures = ['fancy_autocomplete_test_data.json']
 
+    def test_related_search_fields(self):
+        user = User.objects.get(username='jgibson')
+        other = User.objects.get(username='jblack')
+        for name in ('alpha', 'alps', 'beta'):
+            group = Group.objects.create(name=name)
+            user.groups.add(group)
+            if name != 'beta':
+                other.groups.add(group)
+        request = request_factory.get("/", {'q': 'al'})
+        autocomplete = ObjectAutocomplete(
+            model=User, search_fields=['username', 'groups__name'],
+            response_fields=['username'], limit=3
+        )
+        autocomplete.request = request
+        results = autocomplete.get_result_queryset()
+        self.assertFalse('DISTINCT' in unicode(results.query))
+        self.assertEquals(
+            [{'username': u'alyons'}, {'username': u'jblack'}, {'username': u'jgibson'}],
+            sorted(autocomplete.prepare_results(results))
+        )
+
+        autocomplete = ObjectAutocomplete(
+            model=User, search_fields=['groups__name'],
+            response_fields=['username']
+        )
+        autocomplete.request = request
+        results = autocomplete.prepare_results(autocomplete.get_result_queryset())
+        self.assertEquals(
+            [{'username': u'jblack'}, {'username': u'jgibson'}],
+            sorted(results)
+        )
+
+        autocomplete = LabeledAutocomplete(
+            model=Group, search_fields=['name', 'user__username'],
+            label='name'
+        )
+        autocomplete.request = request_factory.get("/", {'q': 'j'})
+        results = autocomplete.prepare_results(autocomplete.get_result_queryset())
+        self.assertEquals([u'alpha', u'alps', u'beta'], sorted(r[1] for r in results))
+
     def test_get_response(self):
         request = request_factory.get("/", {'q': 'c'})
         autocomplete = ObjectAutocomplete(
@@ -375,10 +497,70 @@ class AutocompleteSiteTest(TestCase):
         self.assertEquals(0, len(site._registry))
         self.assertRaises(NotRegistered, site.unregister, 'user')
 
+    def test_get_autocomplete(self):
+        site = AutocompleteSite(limit=1)
+        site.register('user', model=User)
+        autocomplete = site.get_autocomplete('user')
+        self.assertTrue(isinstance(autocomplete, LabeledAutocomplete))
+        self.assertEquals('user', autocomplete.name)
+        self.assertEquals(1, autocomplete.limit)
+        self.assertEquals({'model': User, 'limit': 1}, site._registry['user'][1])
+        self.assertRaises(NotRegistered, site.get_autocomplete, 'group')
+
     def test_unregistered_view(self):
         site = AutocompleteSite()
         self.assertRaises(Http404, site, None, 'user')
 
+    def test_lazy_registration(self):
+        calls = []
+
+        def get_queryset():
+            calls.append(True)
+            return User.objects.filter(is_active=True)
+        site = AutocompleteSite()
+        site.register('user', 'fancy_autocomplete.views.ObjectAutocomplete',
+            queryset=get_queryset, response_fields=['username'])
+        self.assertEquals([], calls)
+        autocomplete = site.get_autocomplete('user')
+        self.assertTrue(isinstance(autocomplete, ObjectAutocomplete))
+        self.assertEquals(User, autocomplete.get_queryset().model)
+        site.get_autocomplete('user')
+        self.assertEquals(1, len(calls))
+        site.unregister('user')
+        site.register('user', 'fancy_autocomplete.views.MissingAutocomplete')
+        self.assertRaises(ImproperlyConfigured, site.get_autocomplete, 'user')
+
+    def test_autodiscover(self):
+        from django.conf import settings
+        directory = tempfile.mkdtemp()
+        os.mkdir(os.path.join(directory, 'discovered_app'))
+        open(os.path.join(directory, 'discovered_app', '__init__.py'), 'w').close()
+        module = open(os.path.join(directory, 'discovered_app', 'autocompletes.py'), 'w')
+        module.write(
+            "from fancy_autocomplete.tests import discovery_site\n"
+            "discovery_site.register('discovered', 'fancy_autocomplete.views.LabeledAutocomplete')\n"
+        )
+        module.close()
+        installed_apps = settings.INSTALLED_APPS
+        settings.INSTALLED_APPS = list(installed_apps) + ['discovered_app']
+        sys.path.insert(0, directory)
+        try:
+            discovery_site.autodiscover()
+            self.assertEquals({}, discovery_site._registry)
+            self.assertEquals(['discovered'], discovery_site.get_keys())
+            self.assertTrue('discovered_app.autocompletes' in sys.modules)
+        finally:
+            settings.INSTALLED_APPS = installed_apps
+            sys.path.remove(directory)
+            shutil.rmtree(directory)
+            for name in ('discovered_app.autocompletes', 'discovered_app'):
+                sys.modules.pop(name, None)
+            discovery_site.unregister('discovered')
+
+
+discovery_site = AutocompleteSite()
+
+
 class AutocompleteSiteResponseTest(TransactionTestCase):
     fixtures = ['fancy_autocomplete_test_data.json']
 
@@ -409,3 +591,1703 @@ class AutocompleteSiteResponseTest(TransactionTestCase):
         response = site(request, 'user')
         self.assertEquals(1, len(simplejson.loads(response.content)))
 
+
+
+class PrecomputeTest(TransactionTestCase):
+    fixtures = ['fancy_autocomplete_test_data.json']
+
+    def get_autocomplete(self, **kwargs):
+        options = dict(
+            name='user',
+            model=User,
+            search_fields=['username'],
+            precompute_length=2,
+            limit=5
+        )
+        options.update(kwargs)
+        return LabeledAutocomplete(**options)
+
+    def test_get_prefixes(self):
+        autocomplete = self.get_autocomplete()
+        self.assertEquals(
+            set([u'a', u'an', u'b']),
+            get_prefixes(autocomplete, [u'anna', u'b', None, u''])
+        )
+        autocomplete = self.get_autocomplete(lookup='istartswith')
+        self.assertEquals(set([u'a', u'an']), get_prefixes(autocomplete, [u'Anna']))
+
+    def test_get_prefix(self):
+        autocomplete = self.get_autocomplete()
+        self.assertEquals(u'An', autocomplete.get_prefix(u'An'))
+        autocomplete = self.get_autocomplete(lookup='istartswith')
+        self.assertEquals(u'an', autocomplete.get_prefix(u'An'))
+
+    def test_precompute(self):
+        autocomplete = self.get_autocomplete()
+        count = precompute(autocomplete)
+        prefixes = get_queryset_prefixes(autocomplete)
+        self.assertEquals(len(prefixes), count)
+        self.assertEquals(count, PrecomputedResult.objects.filter(name='user').count())
+        stored = PrecomputedResult.objects.get(
+            pk=PrecomputedResult.make_key('user', u'ah')
+        )
+        qs = User.objects.filter(username__startswith='ah')[:5]
+        compare = simplejson.dumps(list((u.id, unicode(u)) for u in qs))
+        self.assertEquals(compare, stored.content)
+
+    def test_precompute_lookups(self):
+        autocomplete = self.get_autocomplete(lookup='icontains')
+        self.assertRaises(ImproperlyConfigured, precompute, autocomplete)
+        self.assertRaises(ImproperlyConfigured, precompute, autocomplete, [u'a'])
+        site = AutocompleteSite()
+        site.register('user', model=User, search_fields=['username'],
+            lookup='endswith', precompute_length=2)
+        self.assertRaises(ImproperlyConfigured, connect_signals, site)
+
+    def test_precompute_primary(self):
+        autocomplete = self.get_autocomplete(using='replica')
+        self.assertRaises(ImproperlyConfigured, autocomplete.get_using)
+        self.assertEquals(1, precompute(autocomplete, [u'ah']))
+        self.assertEquals('replica', autocomplete.using)
+
+    def test_precompute_removes_stale(self):
+        PrecomputedResult.objects.create(
+            key=PrecomputedResult.make_key('user', u'zz'),
+            name='user',
+            prefix=u'zz',
+            content='[]',
+        )
+        autocomplete = self.get_autocomplete()
+        precompute(autocomplete)
+        self.assertEquals(0, PrecomputedResult.objects.filter(prefix=u'zz').count())
+
+    def test_serve_precomputed(self):
+        PrecomputedResult.objects.create(
+            key=PrecomputedResult.make_key('user', u'an'),
+            name='user',
+            prefix=u'an',
+            content='["precomputed"]'
+        )
+        autocomplete = self.get_autocomplete()
+        response = autocomplete(request_factory.get('/', {'q': 'an'}))
+        self.assertEquals('["precomputed"]', response.content)
+        self.assertEquals('text/javascript', response['Content-Type'])
+
+        autocomplete = self.get_autocomplete(precompute_length=1)
+        response = autocomplete(request_factory.get('/', {'q': 'an'}))
+        self.assertNotEquals('["precomputed"]', response.content)
+
+        autocomplete = self.get_autocomplete(name=None)
+        response = autocomplete(request_factory.get('/', {'q': 'an'}))
+        self.assertNotEquals('["precomputed"]', response.content)
+
+        site = AutocompleteSite()
+        site.register('user', model=User, search_fields=['username'], precompute_length=2)
+        response = site(request_factory.get('/', {'q': 'an'}), 'user')
+        self.assertNotEquals('["precomputed"]', response.content)
+        precompute(site.get_autocomplete('user'), [u'an'])
+        response = site(request_factory.get('/', {'q': 'an'}), 'user')
+        qs = User.objects.filter(username__startswith='an')
+        self.assertEquals(simplejson.dumps(list(qs.values_list('id', 'username'))), response.content)
+        autocomplete = self.get_autocomplete()
+        response = autocomplete(request_factory.get('/', {'q': 'an'}))
+        self.assertEquals('["precomputed"]', response.content)
+
+    def test_connect_signals(self):
+        site = AutocompleteSite()
+        site.register(
+            'user',
+            model=User,
+            search_fields=['username'],
+            precompute_length=2
+        )
+        connect_signals(site)
+        name = site.get_autocomplete('user').get_qualified_name()
+        try:
+            user = User.objects.create(username='zq')
+            stored = PrecomputedResult.objects.get(
+                pk=PrecomputedResult.make_key(name, u'zq')
+            )
+            self.assertEquals(simplejson.dumps([[user.id, u'zq']]), stored.content)
+            user.username = 'yq'
+            user.save()
+            stored = PrecomputedResult.objects.get(
+                pk=PrecomputedResult.make_key(name, u'zq')
+            )
+            self.assertEquals('[]', stored.content)
+            user.delete()
+            stored = PrecomputedResult.objects.get(
+                pk=PrecomputedResult.make_key(name, u'yq')
+            )
+            self.assertEquals('[]', stored.content)
+        finally:
+            from django.db.models import signals
+            for signal in (signals.pre_save, signals.post_save,
+                           signals.pre_delete, signals.post_delete):
+                signal.disconnect(
+                    sender=User,
+                    dispatch_uid='fancy_autocomplete.precompute.%s.user' % id(site)
+                )
+
+
+class PopularityTest(TransactionTestCase):
+    fixtures = ['fancy_autocomplete_test_data.json']
+
+    def test_counter(self):
+        counter = SelectionCounter(max_size=100, flush_interval=3600)
+        counter.record('user', u' Ah', 1)
+        counter.record('user', u'ah', 1)
+        counter.record('user', u'ah', 2)
+        self.assertEquals(0, Selection.objects.count())
+        self.assertEquals(2, counter.counts[('user', u'ah', u'1')])
+        self.assertEquals(2, counter.counts[('user', u'a', u'1')])
+        counter.flush()
+        self.assertEquals({}, counter.counts)
+        self.assertEquals(
+            2, Selection.objects.get(name='user', query=u'ah', object_key=u'1').count
+        )
+        counter.record('user', u'ah', 1)
+        counter.flush()
+        self.assertEquals(
+            3, Selection.objects.get(name='user', query=u'ah', object_key=u'1').count
+        )
+
+    def test_counter_bounded(self):
+        counter = SelectionCounter(max_size=3, flush_interval=3600)
+        counter.record('user', u'ab', 1)
+        self.assertEquals(2, len(counter.counts))
+        counter.record('user', u'ab', 2)
+        self.assertEquals(4, len(counter.counts))
+        self.assertEquals(0, Selection.objects.count())
+        counter.maybe_flush()
+        self.assertEquals(0, len(counter.counts))
+        self.assertEquals(4, Selection.objects.count())
+
+    def test_counter_request_finished(self):
+        counter = SelectionCounter(max_size=100, flush_interval=3600)
+        counter.connect()
+        try:
+            counter.record('user', u'ab', 1)
+            request_finished.send(sender=self.__class__)
+            self.assertEquals(2, len(counter.counts))
+            counter.last_flush -= 3600
+            request_finished.send(sender=self.__class__)
+            self.assertEquals(0, len(counter.counts))
+            self.assertEquals(2, Selection.objects.count())
+        finally:
+            counter.disconnect()
+
+    def test_get_popular_keys(self):
+        Selection.objects.create(name='user', query=u'a', object_key=u'3', count=1)
+        Selection.objects.create(name='user', query=u'a', object_key=u'4', count=5)
+        Selection.objects.create(name='group', query=u'a', object_key=u'5', count=9)
+        self.assertEquals([4, 3], get_popular_keys('user', u'A', User))
+        self.assertEquals([4], get_popular_keys('user', u'a', User, limit=1))
+
+    def test_ordering(self):
+        users = list(User.objects.filter(username__startswith='c').order_by('-username'))
+        Selection.objects.create(
+            name='user', query=u'c', object_key=unicode(users[0].pk), count=1
+        )
+        Selection.objects.create(
+            name='user', query=u'c', object_key=unicode(users[1].pk), count=5
+        )
+        request = request_factory.get('/', {'q': 'c'})
+        autocomplete = LabeledAutocomplete(
+            name='user',
+            model=User,
+            search_fields=['username'],
+            label='username',
+            ordering='popularity',
+            limit=3
+        )
+        autocomplete.request = request
+        results = autocomplete.prepare_results(autocomplete.get_result_queryset())
+        self.assertEquals(3, len(results))
+        self.assertEquals(
+            [(users[1].pk, users[1].username), (users[0].pk, users[0].username)],
+            results[:2]
+        )
+
+        autocomplete = ObjectAutocomplete(
+            name='user',
+            model=User,
+            search_fields=['username'],
+            response_fields=['username'],
+            ordering='popularity',
+            limit=2
+        )
+        autocomplete.request = request
+        results = autocomplete.prepare_results(autocomplete.get_result_queryset())
+        self.assertEquals(
+            [{'username': users[1].username}, {'username': users[0].username}],
+            results
+        )
+
+    def test_ordering_per_site(self):
+        users = list(User.objects.filter(username__startswith='c').order_by('-username'))
+        sites = [AutocompleteSite(), AutocompleteSite()]
+        for site in sites:
+            site.register('user', model=User, search_fields=['username'],
+                label='username', ordering='popularity', limit=3)
+        Selection.objects.create(
+            name=sites[0].get_autocomplete('user').get_qualified_name(),
+            query=u'c', object_key=unicode(users[0].pk), count=5
+        )
+        request = request_factory.get('/', {'q': 'c'})
+        self.assertEquals(users[0].pk, simplejson.loads(sites[0](request, 'user').content)[0][0])
+        results = simplejson.loads(sites[1](request, 'user').content)
+        qs = User.objects.filter(username__startswith='c')[:3]
+        self.assertEquals(list(qs.values_list('pk', flat=True)), [result[0] for result in results])
+        self.assertNotEquals(users[0].pk, results[0][0])
+
+    def test_select(self):
+        counter = SelectionCounter(flush_interval=3600)
+        class TestSite(AutocompleteSite):
+            def get_selection_counter(self):
+                return counter
+        site = TestSite()
+        site.register('user', model=User, search_fields=['username'])
+        user = User.objects.all()[0]
+        response = site.select(request_factory.get('/', {'q': 'a', 'selected': user.pk}), 'user')
+        self.assertEquals(405, response.status_code)
+        response = site.select(request_factory.post('/', {'q': 'a', 'selected': 'x'}), 'user')
+        self.assertEquals(400, response.status_code)
+        response = site.select(request_factory.post('/', {'q': 'a', 'selected': 0}), 'user')
+        self.assertEquals(400, response.status_code)
+        response = site.select(request_factory.post('/', {'q': 'a', 'selected': user.pk}), 'user')
+        self.assertEquals(204, response.status_code)
+        name = u'%s:user' % site.name
+        self.assertEquals({(name, u'a', unicode(user.pk)): 1}, counter.counts)
+        self.assertRaises(Http404, site.select, None, 'group')
+
+
+class CacheTest(TransactionTestCase):
+    fixtures = ['fancy_autocomplete_test_data.json']
+
+    def setUp(self):
+        cache.clear()
+
+    def get_site(self):
+        site = AutocompleteSite()
+        site.register(
+            'user',
+            model=User,
+            search_fields=['username'],
+            label='username',
+            cache_timeout=60
+        )
+        site.register('uncached', model=User, search_fields=['username'])
+        return site
+
+    def test_get_cache_key(self):
+        autocomplete = BaseAutocomplete(name='user', search_fields=['username'])
+        autocomplete.request = request_factory.get('/', {'q': 'ah'})
+        self.assertEquals(None, autocomplete.get_cache_key())
+        autocomplete = BaseAutocomplete(search_fields=['username'], cache_timeout=60)
+        autocomplete.request = request_factory.get('/', {'q': 'ah'})
+        self.assertEquals(None, autocomplete.get_cache_key())
+        autocomplete = BaseAutocomplete(
+            name='user', search_fields=['username'], cache_timeout=60
+        )
+        autocomplete.request = request_factory.get('/', {'q': 'ah'})
+        key = autocomplete.get_cache_key()
+        self.assertTrue(key.startswith('fancy_autocomplete.'))
+        autocomplete.request = request_factory.get('/', {'q': 'AH'})
+        self.assertNotEquals(key, autocomplete.get_cache_key())
+        autocomplete.lookup = 'istartswith'
+        upper_key = autocomplete.get_cache_key()
+        autocomplete.request = request_factory.get('/', {'q': 'ah'})
+        self.assertEquals(upper_key, autocomplete.get_cache_key())
+
+    def test_cached_response(self):
+        site = self.get_site()
+        response = site(request_factory.get('/', {'q': 'ah'}), 'user')
+        autocomplete = site.get_autocomplete('user')
+        autocomplete.request = request_factory.get('/', {'q': 'ah'})
+        self.assertEquals(response.content, autocomplete.get_cached())
+        cache.set(autocomplete.get_cache_key(), '["cached"]')
+        response = site(request_factory.get('/', {'q': 'ah'}), 'user')
+        self.assertEquals('["cached"]', response.content)
+        self.assertEquals('text/javascript', response['Content-Type'])
+
+    def test_sites_sharing_name(self):
+        public = self.get_site()
+        private = AutocompleteSite(name='private')
+        private.register(
+            'user',
+            autocomplete=ObjectAutocomplete,
+            model=User,
+            search_fields=['username'],
+            response_fields=['email'],
+            cache_timeout=60
+        )
+        self.assertNotEquals(public.name, private.name)
+        self.assertNotEquals(public.name, AutocompleteSite().name)
+        # Without the site in the keys, the same generation would give both
+        # sites the same cache keys.
+        for site in (public, private):
+            cache.set(site.get_autocomplete('user').get_generation_key(), 1)
+        response = private(request_factory.get('/', {'q': 'ah'}), 'user')
+        self.assertTrue('@' in response.content)
+        response = public(request_factory.get('/', {'q': 'ah'}), 'user')
+        self.assertFalse('@' in response.content)
+        private.get_autocomplete('user').invalidate_cache()
+        autocomplete = public.get_autocomplete('user')
+        autocomplete.request = request_factory.get('/', {'q': 'ah'})
+        self.assertEquals(1, autocomplete.get_cache_generation())
+        self.assertEquals(response.content, autocomplete.get_cached())
+
+    def test_invalidate_cache(self):
+        site = self.get_site()
+        site(request_factory.get('/', {'q': 'ah'}), 'user')
+        autocomplete = site.get_autocomplete('user')
+        autocomplete.request = request_factory.get('/', {'q': 'ah'})
+        generation = autocomplete.get_cache_generation()
+        key = autocomplete.get_cache_key()
+        autocomplete.invalidate_cache()
+        self.assertNotEquals(generation, autocomplete.get_cache_generation())
+        self.assertNotEquals(key, autocomplete.get_cache_key())
+        self.assertEquals(None, autocomplete.get_cached())
+        cache.clear()
+        autocomplete.request = request_factory.get('/', {'q': 'ah'})
+        self.assertNotEquals(generation, autocomplete.get_cache_generation())
+
+    def test_get_tasks(self):
+        site = self.get_site()
+        self.assertEquals(
+            [('user', u'a'), ('user', u'b')],
+            get_tasks(site, prefixes=[u'a', u'b'])
+        )
+        tasks = get_tasks(site, length=1)
+        prefixes = set(u[0] for u in User.objects.values_list('username', flat=True))
+        self.assertEquals(sorted(('user', p) for p in prefixes), tasks)
+
+    def test_read_corpus(self):
+        import tempfile, os
+        fd, path = tempfile.mkstemp()
+        try:
+            os.write(fd, 'ah\n\n c \n\xc3\xa9\n')
+            os.close(fd)
+            self.assertEquals([u'ah', u'c', u'\xe9'], read_corpus(path))
+        finally:
+            os.remove(path)
+
+    def test_warm(self):
+        site = self.get_site()
+        count, failures = warm(site, [('user', u'ah'), ('user', u'c')], workers=1)
+        self.assertEquals(2, count)
+        self.assertEquals([], failures)
+        autocomplete = site.get_autocomplete('user')
+        autocomplete.request = request_factory.get('/', {'q': 'ah'})
+        qs = User.objects.filter(username__startswith='ah')
+        compare = simplejson.dumps(list(qs.values_list('id', 'username')))
+        self.assertEquals(compare, autocomplete.get_cached())
+
+        class ForbiddenAutocomplete(LabeledAutocomplete):
+            def is_authorized(self):
+                return self.request.user.is_authenticated()
+        site.register(
+            'forbidden',
+            autocomplete=ForbiddenAutocomplete,
+            model=User,
+            search_fields=['username'],
+            cache_timeout=60
+        )
+        count, failures = warm(site, [('forbidden', u'ah')], workers=1)
+        self.assertEquals(0, count)
+        self.assertEquals([('forbidden', u'ah', 'HTTP 403')], failures)
+
+    def test_warm_workers(self):
+        # The in-memory test database is not shared between threads, so the
+        # requests are stubbed out.
+        error = ValueError('failed')
+        threads = set()
+        lock = threading.Lock()
+        def warm_one(site, key, prefix, user=None):
+            lock.acquire()
+            try:
+                threads.add(threading.currentThread())
+            finally:
+                lock.release()
+            time.sleep(0.01)
+            if prefix == u'x':
+                raise error
+            return prefix == u'f' and 403 or 200
+        tasks = [('user', prefix) for prefix in u'abcdefghijx']
+        original = warming.warm_one
+        warming.warm_one = warm_one
+        try:
+            count, failures = warm(self.get_site(), tasks, workers=3)
+        finally:
+            warming.warm_one = original
+        self.assertEquals(9, count)
+        self.assertEquals(
+            {('user', u'f'): 'HTTP 403', ('user', u'x'): error},
+            dict(((key, prefix), e) for key, prefix, e in failures)
+        )
+        self.assertTrue(1 < len(threads) <= 3)
+        self.assertFalse(threading.currentThread() in threads)
+
+
+class CacheScopeTest(TransactionTestCase):
+    fixtures = ['fancy_autocomplete_test_data.json']
+
+    def setUp(self):
+        cache.clear()
+
+    def get_request(self, user, **data):
+        request = request_factory.get('/', data)
+        request.user = user
+        return request
+
+    def test_get_cache_scope(self):
+        self.assertEquals('global', LabeledAutocomplete(model=User).get_cache_scope())
+
+        class OwnAutocomplete(LabeledAutocomplete):
+            def get_queryset(self):
+                return User.objects.filter(pk=self.request.user.pk)
+        self.assertEquals('user', OwnAutocomplete(model=User).get_cache_scope())
+        self.assertEquals('global', OwnAutocomplete(cache_scope='global').get_cache_scope())
+        autocomplete = OwnAutocomplete(precompute_length=2, index_path='/tmp/index')
+        self.assertEquals(0, autocomplete.get_precompute_length())
+        self.assertEquals(None, autocomplete.get_index_path())
+
+        site = AutocompleteSite()
+        site.register('user', model=User, search_fields=['username'])
+        site.register('group', model=Group, search_fields=['name'], cache_scope='group')
+        site.register('own', autocomplete=OwnAutocomplete, search_fields=['username'])
+        for sources, scope in ((['user'], 'global'), (['user', 'group'], 'group'),
+                               (['group', 'own'], 'user')):
+            autocomplete = FederatedAutocomplete(site=site, sources=sources)
+            self.assertEquals(scope, autocomplete.get_cache_scope())
+
+    def test_get_cache_key(self):
+        users = list(User.objects.order_by('pk')[:3])
+        group = Group.objects.create(name='staff')
+        users[0].groups.add(group)
+        users[1].groups.add(group)
+
+        def get_keys(**kwargs):
+            autocomplete = LabeledAutocomplete(
+                name='user', search_fields=['username'], cache_timeout=60, **kwargs
+            )
+            keys = []
+            for user in users + [AnonymousUser(), AnonymousUser()]:
+                autocomplete.request = self.get_request(user, q='a')
+                keys.append((autocomplete.get_cache_key(), autocomplete.get_resolve_cache_key(1)))
+            return keys
+        keys = get_keys()
+        self.assertEquals(1, len(set(keys)))
+        keys = get_keys(cache_scope='user')
+        self.assertEquals(4, len(set(keys)))
+        self.assertEquals(keys[3], keys[4])
+        self.assertNotEquals(get_keys()[0], keys[0])
+        keys = get_keys(cache_scope='group')
+        self.assertEquals(keys[0], keys[1])
+        self.assertEquals(3, len(set(keys)))
+        users[0].is_staff = True
+        keys = get_keys(cache_scope=lambda request: request.user.is_staff and 'staff' or None)
+        self.assertNotEquals((None, None), keys[0])
+        self.assertEquals((None, None), keys[1])
+        self.assertEquals((None, None), keys[3])
+        self.assertRaises(ImproperlyConfigured, get_keys, cache_scope='tenant')
+
+    def test_scoped_response(self):
+        users = list(User.objects.order_by('pk')[:2])
+
+        class OwnAutocomplete(LabeledAutocomplete):
+            def get_queryset(self):
+                return User.objects.filter(pk=self.request.user.pk)
+        site = AutocompleteSite()
+        site.register(
+            'own', autocomplete=OwnAutocomplete, search_fields=['username'],
+            label='username', cache_timeout=60
+        )
+        site.register(
+            'user', model=User, search_fields=['username'],
+            label='username', cache_timeout=60
+        )
+        for user in users:
+            response = site(self.get_request(user, q=user.username[:1]), 'own')
+            self.assertEquals([[user.pk, user.username]], simplejson.loads(response.content))
+            self.assertEquals('Cookie', response['Vary'])
+            self.assertTrue('private' in response['Cache-Control'])
+        response = site(self.get_request(users[0], q=users[0].username[:1]), 'own')
+        self.assertEquals([[users[0].pk, users[0].username]], simplejson.loads(response.content))
+        response = site(self.get_request(users[0], resolve=users[1].pk), 'own')
+        self.assertEquals([], simplejson.loads(response.content))
+        self.assertEquals('Cookie', response['Vary'])
+        response = site(self.get_request(users[0], q='a'), 'user')
+        self.assertFalse(response.has_header('Vary'))
+        self.assertFalse(response.has_header('Cache-Control'))
+
+
+class OtherUserAutocomplete(LabeledAutocomplete):
+    def get_queryset(self):
+        return User.objects.exclude(pk=self.request.user.pk)
+
+
+class AutocompleteFieldTest(TransactionTestCase):
+    fixtures = ['fancy_autocomplete_test_data.json']
+
+    def setUp(self):
+        self.site = AutocompleteSite()
+        self.site.register(
+            'user',
+            queryset=User.objects.filter(is_active=True),
+            search_fields=['username']
+        )
+
+    def test_init(self):
+        field = AutocompleteModelChoiceField(self.site, 'user', url='/autocomplete/user/')
+        self.assertTrue(isinstance(field.widget, AutocompleteInput))
+        self.assertEquals('/autocomplete/user/', field.widget.url)
+        self.assertEquals(
+            unicode(User.objects.filter(is_active=True).query),
+            unicode(field.queryset.query)
+        )
+        field = AutocompleteModelChoiceField(self.site, 'user', queryset=User.objects.all())
+        self.assertEquals(unicode(User.objects.all().query), unicode(field.queryset.query))
+
+    def test_clean(self):
+        field = AutocompleteModelChoiceField(self.site, 'user')
+        user = User.objects.filter(is_active=True)[0]
+        self.assertEquals(user, field.clean(unicode(user.pk)))
+        inactive = User.objects.filter(is_active=False)[0]
+        self.assertRaises(forms.ValidationError, field.clean, unicode(inactive.pk))
+        self.assertRaises(forms.ValidationError, field.clean, u'x')
+
+    def test_clean_multiple(self):
+        field = AutocompleteModelMultipleChoiceField(self.site, 'user')
+        users = list(User.objects.filter(is_active=True)[:3])
+        pks = [unicode(u.pk) for u in users]
+        with self.assertNumQueries(1):
+            cleaned = field.clean(pks)
+            self.assertEquals(sorted(u.pk for u in users), sorted(u.pk for u in cleaned))
+        inactive = User.objects.filter(is_active=False)[0]
+        self.assertRaises(forms.ValidationError, field.clean, pks + [unicode(inactive.pk)])
+
+    def test_render(self):
+        field = AutocompleteModelChoiceField(self.site, 'user', url='/autocomplete/user/')
+        user = User.objects.filter(is_active=True)[0]
+        with self.assertNumQueries(1):
+            html = field.widget.render('user', user.pk, {'id': 'id_user'})
+        self.assertEquals(
+            u'<input data-autocomplete-url="/autocomplete/user/" type="text" '
+            u'id="id_user" value="%s" />'
+            u'<input type="hidden" name="user" value="%s" id="id_user_value" />'
+            % (user.username, user.pk),
+            html
+        )
+        html = field.widget.render('user', None)
+        self.assertEquals(-1, html.find('value='))
+
+    def test_render_multiple(self):
+        field = AutocompleteModelMultipleChoiceField(self.site, 'user')
+        self.assertTrue(isinstance(field.widget, AutocompleteSelectMultiple))
+        users = list(User.objects.filter(is_active=True)[:2])
+        with self.assertNumQueries(1):
+            html = field.widget.render('users', [u.pk for u in users], {'id': 'id_users'})
+        for i, user in enumerate(users):
+            self.assertTrue(
+                (u'<li>%s<input type="hidden" name="users" value="%s" id="id_users_value_%s" /></li>'
+                 % (user.username, user.pk, i)) in html
+            )
+        self.assertEquals(
+            [u'1', u'2'],
+            field.widget.value_from_datadict(
+                MultiValueDict({'users': [u'1', u'2']}), {}, 'users'
+            )
+        )
+
+    def test_render_invalid(self):
+        class UserForm(forms.Form):
+            user = AutocompleteModelChoiceField(self.site, 'user')
+            users = AutocompleteModelMultipleChoiceField(self.site, 'user')
+        form = UserForm({'user': 'abc', 'users': ['x', 'y']})
+        self.assertFalse(form.is_valid())
+        html = form.as_p()
+        self.assertTrue(u'name="user" value="abc"' in html)
+        self.assertTrue(u'name="users" value="x"' in html)
+
+    def test_lazy_queryset(self):
+        self.site.register('other', 'fancy_autocomplete.tests.OtherUserAutocomplete',
+            search_fields=['username'])
+        class UserForm(forms.Form):
+            user = AutocompleteModelChoiceField(self.site, 'other')
+            users = AutocompleteModelMultipleChoiceField(self.site, 'other', required=False)
+        self.assertFalse('other' in self.site._resolved)
+        users = list(User.objects.all()[:2])
+        request = request_factory.get('/')
+        request.user = users[0]
+        form = UserForm({'user': users[0].pk})
+        self.assertFalse('other' in self.site._resolved)
+        for field in form.fields.values():
+            field.request = request
+        self.assertFalse(form.is_valid())
+        form = UserForm({'user': users[1].pk, 'users': [users[1].pk]})
+        for field in form.fields.values():
+            field.request = request
+        self.assertTrue(form.is_valid())
+        self.assertEquals(users[1], form.cleaned_data['user'])
+        self.assertEquals([users[1]], list(form.cleaned_data['users']))
+
+    def test_render_autocomplete_label(self):
+        self.site.register('email', model=User, search_fields=['email'], label='email')
+        field = AutocompleteModelChoiceField(self.site, 'email')
+        user = User.objects.exclude(email='')[0]
+        with self.assertNumQueries(1):
+            html = field.widget.render('user', user.pk)
+        self.assertTrue(u'value="%s"' % user.email in html)
+        field = AutocompleteModelMultipleChoiceField(self.site, 'email')
+        html = field.widget.render('users', [user.pk])
+        self.assertTrue(u'<li>%s<input' % user.email in html)
+        # Objects the autocomplete does not resolve get their instance label.
+        self.site.register('active', queryset=User.objects.filter(is_active=True),
+            search_fields=['email'], label='email')
+        field = AutocompleteModelChoiceField(self.site, 'active', queryset=User.objects.all())
+        inactive = User.objects.filter(is_active=False)[0]
+        html = field.widget.render('user', inactive.pk)
+        self.assertTrue(u'value="%s"' % inactive.username in html)
+
+
+class ResolveTest(TransactionTestCase):
+    fixtures = ['fancy_autocomplete_test_data.json']
+
+    def setUp(self):
+        cache.clear()
+
+    def test_get_resolve_keys(self):
+        autocomplete = BaseAutocomplete()
+        autocomplete.request = request_factory.get('/', {'resolve': ['1', '2']})
+        self.assertEquals([u'1', u'2'], autocomplete.get_resolve_keys())
+        autocomplete = BaseAutocomplete(resolve_param='keys')
+        autocomplete.request = request_factory.get('/', {'keys': '3'})
+        self.assertEquals([u'3'], autocomplete.get_resolve_keys())
+
+    def test_resolve(self):
+        users = list(User.objects.all()[:3])
+        keys = [users[2].pk, users[0].pk, 0]
+        autocomplete = LabeledAutocomplete(model=User, label='username')
+        with self.assertNumQueries(1):
+            self.assertEquals(
+                [(users[2].pk, users[2].username), (users[0].pk, users[0].username)],
+                autocomplete.resolve(keys)
+            )
+        autocomplete = LabeledAutocomplete(
+            model=User, label='username', key_field='username'
+        )
+        self.assertEquals(
+            [(users[1].username, users[1].username)],
+            autocomplete.resolve([users[1].username])
+        )
+        autocomplete = ObjectAutocomplete(model=User, response_fields=['username'])
+        self.assertEquals(
+            [{'username': users[2].username}, {'username': users[0].username}],
+            autocomplete.resolve(keys)
+        )
+        autocomplete = ObjectAutocomplete(model=User, response_fields=['id', 'username'])
+        self.assertEquals(
+            [{'id': users[0].pk, 'username': users[0].username}],
+            autocomplete.resolve([users[0].pk])
+        )
+
+    def test_resolve_cached(self):
+        users = list(User.objects.all()[:2])
+        autocomplete = LabeledAutocomplete(
+            name='user', model=User, label='username', cache_timeout=60
+        )
+        autocomplete.resolve([users[0].pk])
+        with self.assertNumQueries(0):
+            self.assertEquals(
+                [(users[0].pk, users[0].username)],
+                autocomplete.resolve([users[0].pk])
+            )
+        with self.assertNumQueries(1):
+            self.assertEquals(
+                [(users[1].pk, users[1].username), (users[0].pk, users[0].username)],
+                autocomplete.resolve([users[1].pk, users[0].pk])
+            )
+
+    def test_resolve_cached_per_site(self):
+        user = User.objects.all()[0]
+        public = AutocompleteSite()
+        public.register('user', model=User, label='username', cache_timeout=60)
+        private = AutocompleteSite()
+        private.register('user', model=User, label='email', cache_timeout=60)
+        for site in (public, private):
+            cache.set(site.get_autocomplete('user').get_generation_key(), 1)
+        request = request_factory.get('/', {'resolve': user.pk})
+        self.assertEquals([[user.pk, user.email]], simplejson.loads(private(request, 'user').content))
+        self.assertEquals([[user.pk, user.username]], simplejson.loads(public(request, 'user').content))
+
+    def test_resolve_response(self):
+        site = AutocompleteSite()
+        site.register('user', model=User, label='username')
+        users = list(User.objects.all()[:2])
+        request = request_factory.get('/', {'resolve': [users[1].pk, users[0].pk]})
+        response = site(request, 'user')
+        compare = simplejson.dumps([[u.pk, u.username] for u in (users[1], users[0])])
+        self.assertEquals(compare, response.content)
+        response = site(request_factory.get('/', {'resolve': 'x'}), 'user')
+        self.assertEquals(400, response.status_code)
+
+
+class IndexTest(TransactionTestCase):
+    fixtures = ['fancy_autocomplete_test_data.json']
+
+    def setUp(self):
+        cache.clear()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'user.idx')
+        self.site = AutocompleteSite()
+        self.site.register('user', model=User, label='username',
+            search_fields=['username', 'last_name'], lookup='istartswith',
+            index_path=self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_build_index(self):
+        autocomplete = self.site.get_autocomplete('user')
+        count = build_index(autocomplete)
+        users = User.objects.all()
+        self.assertEquals(
+            len([u for u in users if u.username]) + len([u for u in users if u.last_name]),
+            count
+        )
+        self.assertEquals([], [f for f in os.listdir(self.directory) if f != 'user.idx'])
+        index = get_index(self.path)
+        self.assertEquals(u'user', index.name)
+        self.assertEquals(count, index.count)
+        user = User.objects.get(username='ahays')
+        self.assertEquals([simplejson.dumps([user.pk, user.username])], index.search(u'ahay'))
+        self.assertEquals([], index.search(u'zzzz'))
+        self.assertEquals(2, len(index.search(u'a', 2)))
+
+    def test_lookups(self):
+        autocomplete = self.site.get_autocomplete('user')
+        autocomplete.lookup = 'icontains'
+        self.assertRaises(ImproperlyConfigured, build_index, autocomplete)
+        self.assertFalse(os.path.exists(self.path))
+        autocomplete = LabeledAutocomplete(model=User, search_fields=['username'])
+        self.assertRaises(ImproperlyConfigured, build_index, autocomplete)
+
+    def test_response(self):
+        request = request_factory.get('/', {'q': 'AH'})
+        expected = simplejson.loads(self.site(request, 'user').content)
+        build_index(self.site.get_autocomplete('user'))
+        with self.assertNumQueries(0):
+            response = self.site(request, 'user')
+        self.assertEquals(sorted(expected), sorted(simplejson.loads(response.content)))
+
+    def test_rank_order(self):
+        self.site.unregister('user')
+        self.site.register('user', queryset=User.objects.order_by('-username'),
+            label='username', search_fields=['username', 'last_name'],
+            lookup='istartswith', limit=3, index_path=self.path)
+        request = request_factory.get('/', {'q': 'a'})
+        expected = self.site(request, 'user').content
+        build_index(self.site.get_autocomplete('user'))
+        with self.assertNumQueries(0):
+            response = self.site(request, 'user')
+        self.assertEquals(expected, response.content)
+
+    def test_fallback(self):
+        request = request_factory.get('/', {'q': 'ah'})
+        with self.assertNumQueries(1):
+            self.site(request, 'user')
+        build_index(self.site.get_autocomplete('user'))
+        self.site.unregister('user')
+        self.site.register('user', model=User, label='username',
+            search_fields=['username'], lookup='istartswith',
+            index_path=self.path, index_max_age=0)
+        with self.assertNumQueries(1):
+            self.site(request, 'user')
+        self.site.register('other', model=User, label='username',
+            search_fields=['username'], lookup='istartswith', index_path=self.path)
+        with self.assertNumQueries(1):
+            self.site(request, 'other')
+
+    def test_swap(self):
+        autocomplete = self.site.get_autocomplete('user')
+        build_index(autocomplete)
+        index = get_index(self.path)
+        self.assertTrue(index is get_index(self.path))
+        User.objects.create(username='ahoy')
+        build_index(autocomplete)
+        self.assertEquals([], index.search(u'ahoy'))
+        index = get_index(self.path)
+        self.assertEquals(1, len(index.search(u'ahoy')))
+
+
+class EnvelopeTest(TransactionTestCase):
+    fixtures = ['fancy_autocomplete_test_data.json']
+
+    def setUp(self):
+        cache.clear()
+
+    def test_get_fetch_limit(self):
+        self.assertEquals(None, BaseAutocomplete(envelope=True).get_fetch_limit())
+        self.assertEquals(5, BaseAutocomplete(limit=5).get_fetch_limit())
+        self.assertEquals(6, BaseAutocomplete(limit=5, envelope=True).get_fetch_limit())
+
+    def test_prepare_envelope(self):
+        autocomplete = BaseAutocomplete(limit=2, envelope=True)
+        self.assertEquals(
+            {'results': [1, 2], 'has_more': True},
+            autocomplete.prepare_envelope([1, 2, 3])
+        )
+        self.assertEquals(
+            {'results': [1, 2], 'has_more': False},
+            autocomplete.prepare_envelope([1, 2])
+        )
+        self.assertEquals(
+            {'results': [1, 2, 3], 'has_more': False},
+            autocomplete.prepare_envelope([1, 2, 3], has_more=False)
+        )
+
+    def test_labeled_response(self):
+        users = list(User.objects.filter(username__startswith='a').order_by('pk'))
+        self.assertTrue(len(users) > 2)
+        autocomplete = LabeledAutocomplete(queryset=User.objects.order_by('pk'), search_fields=['username'],
+            label='username', limit=2, envelope=True)
+        with self.assertNumQueries(1):
+            response = autocomplete(request_factory.get('/', {'q': 'a'}))
+        compare = {
+            'results': [[u.pk, u.username] for u in users[:2]],
+            'has_more': True,
+        }
+        self.assertEquals(compare, simplejson.loads(response.content))
+        autocomplete.limit = len(users)
+        response = autocomplete(request_factory.get('/', {'q': 'a'}))
+        self.assertFalse(simplejson.loads(response.content)['has_more'])
+
+    def test_object_response(self):
+        users = list(User.objects.filter(username__startswith='a').order_by('pk'))
+        autocomplete = ObjectAutocomplete(queryset=User.objects.order_by('pk'), search_fields=['username'],
+            response_fields=['username'], limit=len(users) - 1, envelope=True)
+        response = autocomplete(request_factory.get('/', {'q': 'a'}))
+        compare = {
+            'results': [{'username': u.username} for u in users[:-1]],
+            'has_more': True,
+        }
+        self.assertEquals(compare, simplejson.loads(response.content))
+        response = autocomplete(request_factory.get('/', {'resolve': [u.pk for u in users]}))
+        compare = {
+            'results': [{'username': u.username} for u in users],
+            'has_more': False,
+        }
+        self.assertEquals(compare, simplejson.loads(response.content))
+
+
+class HighlightTest(TransactionTestCase):
+    fixtures = ['fancy_autocomplete_test_data.json']
+
+    def test_matcher(self):
+        autocomplete = BaseAutocomplete(lookup='istartswith')
+        autocomplete.request = request_factory.get('/', {'q': 'a.b'})
+        matcher = autocomplete.get_matcher('username')
+        self.assertTrue(matcher is autocomplete.get_matcher('username'))
+        self.assertTrue(matcher.match(u'A.Bc'))
+        self.assertFalse(matcher.match(u'axbc'))
+        self.assertFalse(matcher.search(u'ca.b'))
+        autocomplete.lookup = 'contains'
+        self.assertFalse(autocomplete.get_matcher('username').search(u'cA.B'))
+        self.assertTrue(autocomplete.get_matcher('username').search(u'ca.b'))
+
+    def test_highlight_text(self):
+        autocomplete = BaseAutocomplete(lookup='icontains')
+        autocomplete.request = request_factory.get('/', {'q': 'an'})
+        self.assertEquals([[0, 2], [4, 6]], autocomplete.highlight_text('name', u'Ann Anders'))
+        autocomplete.lookup = 'istartswith'
+        autocomplete.request = request_factory.get('/', {'q': u'Jose'})
+        self.assertEquals([], autocomplete.highlight_text('name', u'Jos\xe9 Smith'))
+        autocomplete.highlight_fold = True
+        self.assertEquals([[0, 4]], autocomplete.highlight_text('name', u'Jos\xe9 Smith'))
+        self.assertEquals([[0, 5]], autocomplete.highlight_text('name', u'Jose\u0301 Smith'))
+        autocomplete.request = request_factory.get('/', {'q': u'\xc9l'})
+        self.assertEquals([[0, 2]], autocomplete.highlight_text('name', u'elise'))
+
+    def test_labeled_response(self):
+        users = list(User.objects.filter(username__startswith='ah').order_by('pk'))
+        autocomplete = LabeledAutocomplete(queryset=User.objects.order_by('pk'),
+            search_fields=['username'], label='username', lookup='istartswith',
+            highlight=True)
+        response = autocomplete(request_factory.get('/', {'q': 'AH'}))
+        compare = {
+            'results': [[u.pk, u.username] for u in users],
+            'has_more': False,
+            'highlights': [{'username': [[0, 2]]} for u in users],
+        }
+        self.assertEquals(compare, simplejson.loads(response.content))
+
+    def test_object_response(self):
+        user = User.objects.get(username='ahays')
+        autocomplete = ObjectAutocomplete(model=User, search_fields=['username'],
+            response_fields=['username', 'email', 'id'], highlight=True)
+        response = autocomplete(request_factory.get('/', {'q': 'ahay'}))
+        content = simplejson.loads(response.content)
+        self.assertEquals([{'username': [[0, 4]]}], content['highlights'])
+        self.assertEquals(user.pk, content['results'][0]['id'])
+
+
+class StreamingTest(TransactionTestCase):
+    fixtures = ['fancy_autocomplete_test_data.json']
+
+    def setUp(self):
+        self.site = AutocompleteSite()
+        self.site.register('user', model=User, label='username', search_fields=['username'])
+
+    def test_get_latest(self):
+        session = AutocompleteSession(self.site, request_factory.get('/'))
+        messages = [
+            {'key': 'user', 'q': 'a', 'seq': 1},
+            {'key': 'group', 'q': 'a', 'seq': 2},
+            {'key': 'user', 'q': 'ah', 'seq': 3},
+        ]
+        self.assertEquals(messages[1:], session.get_latest(messages))
+        session.last_seq['user'] = 4
+        self.assertEquals(messages[1:2], session.get_latest(messages))
+
+    def test_answer(self):
+        class PrivateAutocomplete(LabeledAutocomplete):
+            checks = []
+
+            def is_authorized(self):
+                self.checks.append(True)
+                return False
+        self.site.register('private', PrivateAutocomplete, model=User)
+        request = request_factory.get('/')
+        request.user = User.objects.get(username='ahays')
+        session = AutocompleteSession(self.site, request)
+        users = User.objects.filter(username__startswith='ah')
+        line = session.answer({'key': 'user', 'q': 'ah', 'seq': 7})
+        compare = {
+            'key': 'user',
+            'seq': 7,
+            'status': 200,
+            'results': [[u.pk, u.username] for u in users],
+        }
+        self.assertEquals(compare, simplejson.loads(line))
+        self.assertEquals(7, session.last_seq['user'])
+        for i in range(2):
+            line = session.answer({'key': 'private', 'q': 'ah', 'seq': i})
+            self.assertEquals(403, simplejson.loads(line)['status'])
+        self.assertEquals(1, len(PrivateAutocomplete.checks))
+        line = session.answer({'key': 'missing', 'q': 'ah', 'seq': 1})
+        self.assertEquals(404, simplejson.loads(line)['status'])
+
+    def test_answer_error(self):
+        class BrokenAutocomplete(LabeledAutocomplete):
+            def get_result_queryset(self):
+                raise DatabaseError('unavailable')
+        self.site.register('broken', BrokenAutocomplete, model=User, label='username')
+        session = AutocompleteSession(self.site, request_factory.get('/'))
+        line = session.answer({'key': 'broken', 'q': 'ah', 'seq': 1})
+        self.assertEquals(
+            {'key': 'broken', 'seq': 1, 'status': 500, 'results': None},
+            simplejson.loads(line)
+        )
+        line = session.answer({'key': 'user', 'q': 'ah', 'seq': 2})
+        self.assertEquals(200, simplejson.loads(line)['status'])
+
+    def test_stream(self):
+        body = '\n'.join([
+            simplejson.dumps({'key': 'user', 'q': 'a', 'seq': 1}),
+            simplejson.dumps({'key': 'user', 'q': 'ah', 'seq': 2}),
+            'not json',
+        ]) + '\n'
+        request = request_factory.post('/', body, content_type='application/x-ndjson',
+            **{'wsgi.input': StringIO(body)})
+        request.user = AnonymousUser()
+        response = self.site.stream(request)
+        self.assertEquals('application/x-ndjson', response['Content-Type'])
+        users = User.objects.filter(username__startswith='ah')
+        self.assertEquals([
+            {'key': None, 'seq': None, 'status': 400, 'results': None},
+            {'key': 'user', 'seq': 2, 'status': 200,
+             'results': [[u.pk, u.username] for u in users]},
+        ], [simplejson.loads(line) for line in response])
+        self.assertEquals(405, self.site.stream(request_factory.get('/')).status_code)
+
+    def test_websocket(self):
+        class WebSocket(object):
+            def __init__(self, messages):
+                self.messages = list(messages)
+                self.sent = []
+
+            def receive(self):
+                if self.messages:
+                    return self.messages.pop(0)
+                return None
+
+            def send(self, data):
+                self.sent.append(simplejson.loads(data))
+        websocket = WebSocket([simplejson.dumps({'key': 'user', 'q': 'ahay', 'seq': 1})])
+        request = request_factory.get('/', **{'wsgi.websocket': websocket})
+        request.user = AnonymousUser()
+        self.site.stream(request)
+        user = User.objects.get(username='ahays')
+        self.assertEquals([[user.pk, user.username]], websocket.sent[0]['results'])
+
+
+class ProfilingTest(TransactionTestCase):
+    fixtures = ['fancy_autocomplete_test_data.json']
+
+    def setUp(self):
+        self.site = AutocompleteSite()
+        self.site.register('user', model=User, label='username', search_fields=['username'])
+
+    def test_sampling(self):
+        profiler = SamplingProfiler(sample_rate=0)
+        self.assertFalse(profiler.should_profile())
+        profiler.sample_rate = 1
+        self.assertTrue(profiler.should_profile())
+
+    def test_profile(self):
+        self.site.profiler = SamplingProfiler(sample_rate=1)
+        request = request_factory.get('/', {'q': 'ah'})
+        for i in range(2):
+            response = self.site(request, 'user')
+            self.assertEquals(200, response.status_code)
+        self.assertEquals(['user'], self.site.profiler.get_keys())
+        report = self.site.profiler.report('user')
+        self.assertTrue(report.startswith('2 requests profiled for user'))
+        self.assertTrue('prepare_results' in report)
+        self.site.profiler.reset('user')
+        self.assertEquals([], self.site.profiler.get_keys())
+
+    def test_profile_stats_view(self):
+        request = request_factory.get('/')
+        request.user = AnonymousUser()
+        self.assertEquals(403, self.site.profile_stats(request).status_code)
+        request.user = User.objects.get(username='ahays')
+        request.user.is_staff = True
+        self.assertRaises(Http404, self.site.profile_stats, request)
+        self.site.profiler = SamplingProfiler(sample_rate=1)
+        self.site(request_factory.get('/', {'q': 'ah'}), 'user')
+        response = self.site.profile_stats(request)
+        self.assertEquals(200, response.status_code)
+        self.assertTrue('1 requests profiled for user' in response.content)
+        request = request_factory.get('/', {'sort': 'nonsense'})
+        request.user = User.objects.get(username='ahays')
+        request.user.is_staff = True
+        self.assertEquals(400, self.site.profile_stats(request).status_code)
+
+
+class CompiledQueryTest(TransactionTestCase):
+    fixtures = ['fancy_autocomplete_test_data.json']
+
+    def setUp(self):
+        cache.clear()
+        plans._plans.clear()
+
+    def compare(self, autocomplete, query):
+        request = request_factory.get('/', {'q': query})
+        autocomplete.compile_queries = False
+        expected = autocomplete(request).content
+        autocomplete.compile_queries = True
+        with self.assertNumQueries(1):
+            self.assertEquals(expected, autocomplete(request).content)
+
+    def test_labeled(self):
+        autocomplete = LabeledAutocomplete(queryset=User.objects.order_by('pk'),
+            search_fields=['username', 'last_name'], label='username',
+            lookup='istartswith', limit=3, name='user')
+        self.compare(autocomplete, 'a')
+        self.compare(autocomplete, 'AH')
+        self.assertTrue(autocomplete.get_plan() is not None)
+        self.assertEquals(1, len(plans._plans))
+
+    def test_object(self):
+        autocomplete = ObjectAutocomplete(queryset=User.objects.order_by('pk'),
+            search_fields=['username'], response_fields=['username', 'email'],
+            envelope=True, limit=2)
+        self.compare(autocomplete, 'a')
+        autocomplete = ObjectAutocomplete(model=User, search_fields=['username'],
+            response_fields=['username'], lookup='exact')
+        self.compare(autocomplete, 'ahays')
+        self.compare(autocomplete, 'ahay')
+
+    def test_escaping(self):
+        User.objects.create(username='a_b')
+        User.objects.create(username='a%b')
+        autocomplete = LabeledAutocomplete(model=User, search_fields=['username'],
+            label='username')
+        for query in ('a_', 'a%', 'a\\', 'a'):
+            self.compare(autocomplete, query)
+        autocomplete.compile_queries = True
+        response = autocomplete(request_factory.get('/', {'q': 'a_'}))
+        self.assertEquals([u'a_b'], [label for pk, label in simplejson.loads(response.content)])
+
+    def test_iexact_escaping(self):
+        User.objects.create(username='a_b%')
+        autocomplete = LabeledAutocomplete(model=User, search_fields=['username'],
+            label='username', lookup='iexact')
+        for query in ('A_B%', 'a_b', 'aXb%'):
+            self.compare(autocomplete, query)
+        ops = connection.ops
+        self.assertEquals(ops.prep_for_iexact_query, plans.get_prep(('iexact',), 'default'))
+        # Backends such as PostgreSQL match iexact without LIKE, leaving the
+        # query unescaped.
+        ops.prep_for_iexact_query = lambda x: x
+        plans._plans.clear()
+        try:
+            prep = plans.get_prep(('iexact',), 'default')
+            self.assertEquals(u'a_b%', prep(u'a_b%'))
+            self.assertEquals(None, plans.get_prep(('iexact', 'istartswith'), 'default'))
+            autocomplete.compile_queries = True
+            autocomplete.request = request_factory.get('/', {'q': 'a_b%'})
+            self.assertEquals([u'a_b%'], autocomplete.get_plan().get_params(u'a_b%'))
+        finally:
+            del ops.prep_for_iexact_query
+        self.assertEquals(
+            plans.get_prep(('istartswith',), 'default'),
+            plans.get_prep(('iexact', 'istartswith'), 'default')
+        )
+        self.assertEquals(None, plans.get_prep(('exact', 'istartswith'), 'default'))
+
+    def test_fallback(self):
+        class CustomAutocomplete(LabeledAutocomplete):
+            def get_queryset(self):
+                return User.objects.filter(is_active=True)
+        options = dict(model=User, search_fields=['username'], label='username',
+            compile_queries=True)
+        self.assertTrue(LabeledAutocomplete(**options).can_compile())
+        self.assertFalse(LabeledAutocomplete(**dict(options, compile_queries=False)).can_compile())
+        self.assertFalse(CustomAutocomplete(**options).can_compile())
+        self.assertFalse(LabeledAutocomplete(**dict(options, ordering='popularity')).can_compile())
+        autocomplete = LabeledAutocomplete(**dict(options, label=lambda o: o.username))
+        autocomplete.request = request_factory.get('/', {'q': 'a'})
+        self.assertFalse(autocomplete.can_compile())
+        self.assertEquals(None, autocomplete.get_plan())
+        for i in range(3):
+            autocomplete = LabeledAutocomplete(model=User, search_fields=['username'],
+                compile_queries=True, name='user')
+            autocomplete(request_factory.get('/', {'q': 'a'}))
+        self.assertEquals({}, plans._plans)
+        autocomplete = LabeledAutocomplete(**dict(options, lookup='search'))
+        self.assertEquals(None, autocomplete.get_plan())
+
+    def test_alias(self):
+        from django.db import connections
+        connections.databases['replica'] = connections.databases['default']
+        try:
+            autocomplete = LabeledAutocomplete(model=User, search_fields=['username'],
+                label='username', using=('default', 'replica'), compile_queries=True)
+            for query in ('a', 'ah'):
+                autocomplete.request = request_factory.get('/', {'q': query})
+                alias = autocomplete.get_plan().alias
+                self.assertEquals(alias, autocomplete.get_using())
+                self.assertEquals(alias, autocomplete.get_result_queryset().db)
+        finally:
+            del connections.databases['replica']
+
+
+class FailingAutocomplete(LabeledAutocomplete):
+    def get_result_queryset(self):
+        self.attempts = getattr(self, 'attempts', 0) + 1
+        raise DatabaseError('canceling statement due to statement timeout')
+
+
+class BudgetTest(TransactionTestCase):
+    fixtures = ['fancy_autocomplete_test_data.json']
+
+    def setUp(self):
+        cache.clear()
+
+    def test_statement_timeout(self):
+        cursor = connection.cursor()
+        sql = ('WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) '
+               'SELECT COUNT(*) FROM c')
+        start = time.time()
+        try:
+            with statement_timeout(connection, 0.05):
+                cursor.execute(sql)
+        except DatabaseError:
+            pass
+        else:
+            self.fail('The statement was not interrupted.')
+        self.assertTrue(time.time() - start < 1)
+        cursor.execute('SELECT COUNT(*) FROM auth_user')
+        self.assertEquals(User.objects.count(), cursor.fetchone()[0])
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(threshold=2, cooldown=0.1)
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertFalse(breaker.is_open())
+        breaker.record_failure()
+        self.assertTrue(breaker.is_open())
+        self.assertFalse(breaker.allow())
+        time.sleep(0.1)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertTrue(breaker.allow())
+        self.assertTrue(get_breaker('user', 'default') is get_breaker('user', 'default'))
+        self.assertFalse(get_breaker('user', 'default') is get_breaker('user', 'other'))
+
+    def test_budgeted_response(self):
+        site = AutocompleteSite()
+        site.register('user', model=User, label='username', search_fields=['username'],
+            time_budget=1, cache_timeout=60)
+        request = request_factory.get('/', {'q': 'ah'})
+        response = site(request, 'user')
+        self.assertFalse(response.has_header('X-Autocomplete-Degraded'))
+        users = User.objects.filter(username__startswith='ah')
+        self.assertEquals(simplejson.dumps([[u.pk, u.username] for u in users]), response.content)
+        breaker = site.get_autocomplete('user').get_breaker('default')
+        self.assertTrue(breaker is get_breaker('%s:user' % site.name, 'default'))
+        self.assertFalse(breaker.is_open())
+        other = AutocompleteSite()
+        other.register('user', model=User, search_fields=['username'])
+        self.assertFalse(breaker is other.get_autocomplete('user').get_breaker('default'))
+
+    def test_degraded_response(self):
+        autocomplete = FailingAutocomplete(model=User, search_fields=['username'],
+            name='failing', time_budget=1, breaker_threshold=2, cache_timeout=60)
+        get_breaker('failing', 'default').record_success()
+        response = autocomplete(request_factory.get('/', {'q': 'ahay'}))
+        self.assertEquals('empty', response['X-Autocomplete-Degraded'])
+        self.assertEquals('[]', response.content)
+        self.assertEquals(None, autocomplete.get_cached())
+        cache.set(autocomplete.get_cache_key(u'ah'), '["cached"]')
+        response = autocomplete(request_factory.get('/', {'q': 'ahay'}))
+        self.assertEquals('prefix', response['X-Autocomplete-Degraded'])
+        self.assertEquals('["cached"]', response.content)
+        self.assertEquals(2, autocomplete.attempts)
+        self.assertTrue(get_breaker('failing', 'default').is_open())
+        response = autocomplete(request_factory.get('/', {'q': 'ahay'}))
+        self.assertEquals('prefix', response['X-Autocomplete-Degraded'])
+        self.assertEquals(2, autocomplete.attempts)
+
+
+class SlowFederatedAutocomplete(FederatedAutocomplete):
+    def search_source(self, autocomplete):
+        if autocomplete.name == 'slow':
+            time.sleep(0.5)
+        return [autocomplete.name]
+
+
+class FederatedTest(TransactionTestCase):
+    fixtures = ['fancy_autocomplete_test_data.json']
+
+    def setUp(self):
+        cache.clear()
+        self.site = AutocompleteSite()
+        self.site.register('user', model=User, label='username',
+            search_fields=['username'], limit=2)
+        self.site.register('group', model=Group, label='name', search_fields=['name'])
+
+    def test_get_sources(self):
+        autocomplete = FederatedAutocomplete()
+        self.assertRaises(ImproperlyConfigured, autocomplete.get_sources)
+        autocomplete = FederatedAutocomplete(sources=('user',))
+        self.assertRaises(ImproperlyConfigured, autocomplete.get_sources)
+        self.site.register('all', FederatedAutocomplete, sources=('user',))
+        autocomplete = self.site.get_autocomplete('all')
+        self.assertEquals(self.site, autocomplete.site)
+        self.assertEquals(('user',), autocomplete.get_sources())
+
+    def test_grouped(self):
+        Group.objects.create(name='ahoy')
+        self.site.register('all', FederatedAutocomplete,
+            sources=('user', 'group'), parallel=False)
+        response = self.site(request_factory.get('/', {'q': 'ah'}), 'all')
+        users = User.objects.filter(username__istartswith='ah')[:2]
+        compare = {
+            'results': [
+                {'key': 'user', 'results': [[u.pk, u.username] for u in users]},
+                {'key': 'group', 'results': [[Group.objects.get().pk, 'ahoy']]},
+            ],
+            'incomplete': [],
+        }
+        self.assertEquals(compare, simplejson.loads(response.content))
+
+    def test_ranked(self):
+        self.site.register('all', SlowFederatedAutocomplete,
+            sources=('user', 'group'), merge='ranked')
+        response = self.site(request_factory.get('/', {'q': 'a'}), 'all')
+        compare = {
+            'results': [
+                {'key': 'user', 'result': 'user'},
+                {'key': 'group', 'result': 'group'},
+            ],
+            'incomplete': [],
+        }
+        self.assertEquals(compare, simplejson.loads(response.content))
+
+    def test_unauthorized_source(self):
+        class PrivateAutocomplete(LabeledAutocomplete):
+            def is_authorized(self):
+                return False
+        self.site.register('private', PrivateAutocomplete, model=User)
+        self.site.register('all', SlowFederatedAutocomplete,
+            sources=('private', 'group'))
+        response = self.site(request_factory.get('/', {'q': 'a'}), 'all')
+        compare = {'results': [{'key': 'group', 'results': ['group']}], 'incomplete': []}
+        self.assertEquals(compare, simplejson.loads(response.content))
+
+    def test_source_pipeline(self):
+        class DegradedAutocomplete(LabeledAutocomplete):
+            def get_query_response(self):
+                return self.get_degraded_response()
+        self.site.unregister('user')
+        self.site.register('user', model=User, label='username',
+            search_fields=['username'], cache_timeout=60)
+        self.site.register('degraded', DegradedAutocomplete, model=Group)
+        self.site.register('all', FederatedAutocomplete,
+            sources=('user', 'degraded'), parallel=False)
+        source = self.site.get_autocomplete('user')
+        source.request = request_factory.get('/', {'q': 'ah'})
+        source.set_cached(simplejson.dumps([[0, u'cached']]))
+        response = self.site(request_factory.get('/', {'q': 'ah'}), 'all')
+        compare = {
+            'results': [{'key': 'user', 'results': [[0, u'cached']]}],
+            'incomplete': ['degraded'],
+        }
+        self.assertEquals(compare, simplejson.loads(response.content))
+
+    def test_timeout(self):
+        self.site.register('slow', model=User)
+        self.site.register('all', SlowFederatedAutocomplete,
+            sources=('slow', 'group'), timeout=0.1, cache_timeout=60)
+        start = time.time()
+        response = self.site(request_factory.get('/', {'q': 'a'}), 'all')
+        self.assertTrue(time.time() - start < 0.4)
+        compare = {'results': [{'key': 'group', 'results': ['group']}], 'incomplete': ['slow']}
+        self.assertEquals(compare, simplejson.loads(response.content))
+        autocomplete = self.site.get_autocomplete('all')
+        autocomplete.request = request_factory.get('/', {'q': 'a'})
+        self.assertEquals(None, autocomplete.get_cached())
+
+    def test_max_in_flight(self):
+        searches = []
+
+        class CountingAutocomplete(SlowFederatedAutocomplete):
+            def search_source(self, autocomplete):
+                searches.append(autocomplete.name)
+                return super(CountingAutocomplete, self).search_source(autocomplete)
+        self.site.register('slow', model=User)
+        self.site.register('all', CountingAutocomplete,
+            sources=('slow', 'group'), timeout=0.05, max_in_flight=1)
+        compare = {'results': [{'key': 'group', 'results': ['group']}], 'incomplete': ['slow']}
+        for i in range(3):
+            response = self.site(request_factory.get('/', {'q': 'a'}), 'all')
+            self.assertEquals(compare, simplejson.loads(response.content))
+        self.assertEquals(1, searches.count('slow'))
+        self.assertEquals(3, searches.count('group'))
+        time.sleep(0.6)
+        self.site(request_factory.get('/', {'q': 'a'}), 'all')
+        self.assertEquals(2, searches.count('slow'))
+
+
+class MaintenanceTest(TransactionTestCase):
+    fixtures = ['fancy_autocomplete_test_data.json']
+
+    def setUp(self):
+        cache.clear()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'user.idx')
+        self.site = AutocompleteSite()
+        self.site.register(
+            'user', model=User, search_fields=['username'], label='username',
+            precompute_length=2, cache_timeout=60, index_path=self.path
+        )
+        self.site.register('plain', model=Group, search_fields=['name'])
+        self.maintainer = None
+
+    def tearDown(self):
+        if self.maintainer is not None:
+            self.maintainer.disconnect()
+        shutil.rmtree(self.directory)
+
+    def connect(self, **kwargs):
+        self.maintainer = Maintainer(self.site, **kwargs)
+        self.maintainer.connect()
+        return self.maintainer
+
+    def get_stored(self, prefix):
+        name = self.site.get_autocomplete('user').get_qualified_name()
+        key = PrecomputedResult.make_key(name, prefix)
+        return simplejson.loads(PrecomputedResult.objects.get(pk=key).content)
+
+    def test_flush(self):
+        maintainer = self.connect(flush_interval=60)
+        self.assertEquals(['user'], maintainer.get_keys())
+        self.assertEquals({User: ['user']}, maintainer.models)
+        cached = self.site(request_factory.get('/', {'q': 'ahar'}), 'user').content
+        user = User.objects.get(username='ahartman')
+        user.username = 'zqhartman'
+        user.save()
+        user.username = 'zxhartman'
+        user.save()
+        created = User.objects.create(username='zxy')
+        metrics = maintainer.get_metrics()
+        self.assertEquals(2, metrics['buffered'])
+        self.assertEquals(3, metrics['changes'])
+        self.assertEquals(1, metrics['coalesced'])
+        self.assertFalse(PrecomputedResult.objects.exists())
+        self.assertEquals(2, maintainer.flush())
+        self.assertEquals(
+            [[user.pk, u'zxhartman'], [created.pk, u'zxy']], self.get_stored(u'zx')
+        )
+        self.assertEquals([], [r for r in self.get_stored(u'ah') if r[0] == user.pk])
+        self.assertEquals(
+            cached, self.site(request_factory.get('/', {'q': 'ahar'}), 'user').content
+        )
+        self.assertEquals(None, get_index(self.path))
+        self.assertEquals(1, maintainer.get_metrics()['stale_indexes'])
+        self.assertEquals(1, maintainer.get_metrics()['stale_caches'])
+        maintainer.maybe_flush()
+        self.assertEquals(0, maintainer.get_metrics()['index_builds'])
+        self.assertEquals(0, maintainer.get_metrics()['invalidations'])
+        maintainer.invalidate_interval = 0
+        maintainer.maybe_flush()
+        self.assertEquals(1, maintainer.get_metrics()['invalidations'])
+        self.assertEquals(0, maintainer.get_metrics()['stale_caches'])
+        self.assertNotEquals(
+            cached, self.site(request_factory.get('/', {'q': 'ahar'}), 'user').content
+        )
+        maintainer.index_interval = 0
+        maintainer.maybe_flush()
+        self.assertEquals(1, maintainer.get_metrics()['index_builds'])
+        self.assertEquals(
+            [simplejson.dumps([user.pk, u'zxhartman'])], get_index(self.path).search(u'zxh')
+        )
+        metrics = maintainer.get_metrics()
+        self.assertEquals(0, metrics['buffered'])
+        self.assertEquals(1, metrics['flushes'])
+        self.assertEquals(2, metrics['flushed_rows'])
+        self.assertEquals(0.0, metrics['lag'])
+        self.assertTrue(metrics['last_lag'] >= 0)
+        created.delete()
+        maintainer.flush()
+        self.assertEquals([[user.pk, u'zxhartman']], self.get_stored(u'zx'))
+
+    def test_max_size(self):
+        maintainer = self.connect(max_size=2, flush_interval=60)
+        users = list(User.objects.order_by('pk')[:3])
+        for user in users:
+            user.save()
+        metrics = maintainer.get_metrics()
+        self.assertEquals(1, metrics['full_flushes'])
+        self.assertEquals(2, metrics['flushed_rows'])
+        self.assertEquals(1, metrics['buffered'])
+
+    def test_m2m_changed(self):
+        self.site.unregister('user')
+        self.site.register(
+            'user', model=User, search_fields=['groups__name'], label='username',
+            precompute_length=1
+        )
+        maintainer = self.connect(flush_interval=60)
+        self.assertEquals([User.groups.field], maintainer.get_relations(User))
+        user = User.objects.order_by('pk')[0]
+        group = Group.objects.create(name='zeta')
+        user.groups.add(group)
+        maintainer.flush()
+        self.assertEquals([[user.pk, user.username]], self.get_stored(u'z'))
+        group.user_set.clear()
+        self.assertEquals(1, maintainer.get_metrics()['buffered'])
+        maintainer.flush()
+        self.assertEquals([], self.get_stored(u'z'))
+
+    def test_maybe_flush(self):
+        maintainer = self.connect(flush_interval=0, reconcile_interval=3600)
+        user = User.objects.get(username='ahartman')
+        user.username = 'zqhartman'
+        user.save()
+        request_finished.send(sender=self.__class__)
+        self.assertEquals(0, maintainer.get_metrics()['buffered'])
+        self.assertEquals([[user.pk, u'zqhartman']], self.get_stored(u'zq'))
+        self.assertEquals(0, maintainer.get_metrics()['reconciliations'])
+        maintainer.reconcile_interval = 0
+        User.objects.filter(pk=user.pk).update(username='zwhartman')
+        maintainer.maybe_flush()
+        self.assertEquals(1, maintainer.get_metrics()['reconciliations'])
+        self.assertEquals([[user.pk, u'zwhartman']], self.get_stored(u'zw'))
+        self.assertFalse(PrecomputedResult.objects.filter(prefix=u'zq').exists())
+
+    def test_errors_logged(self):
+        maintainer = self.connect(flush_interval=60)
+        def apply(key, rows):
+            raise ValueError('broken')
+        maintainer.apply = apply
+        stream = StringIO()
+        handler = logging.StreamHandler(stream)
+        logger = logging.getLogger('fancy_autocomplete.maintenance')
+        logger.addHandler(handler)
+        try:
+            User.objects.order_by('pk')[0].save()
+            maintainer.flush()
+        finally:
+            logger.removeHandler(handler)
+        self.assertEquals(1, maintainer.get_metrics()['errors'])
+        self.assertTrue("Applying changes to 'user' failed" in stream.getvalue())
+        self.assertTrue('ValueError: broken' in stream.getvalue())
+
+
+class LoadTestTest(TransactionTestCase):
+    fixtures = ['fancy_autocomplete_test_data.json']
+    urls = 'fancy_autocomplete.tests'
+
+    def setUp(self):
+        cache.clear()
+
+    def test_type_word(self):
+        events = type_word(u'ahartman', random.Random(1), typo_rate=0, abandon_rate=0)
+        self.assertEquals(
+            [u'a', u'ah', u'aha', u'ahar', u'ahart', u'ahartm', u'ahartma', u'ahartman'],
+            [query for delay, query in events]
+        )
+        self.assertTrue(min([delay for delay, query in events]) > 0)
+        events = type_word(u'ahartman', random.Random(1), typo_rate=1, abandon_rate=0)
+        queries = [query for delay, query in events]
+        self.assertEquals(u'ahartman', queries[-1])
+        self.assertEquals([u'a', u'a', u'ah'], [queries[1], queries[3], queries[4]])
+        events = type_word(u'ahartman', random.Random(1), typo_rate=0, abandon_rate=1)
+        self.assertTrue(len(events) < 8)
+        self.assertTrue(u'ahartman'.startswith(events[-1][1]))
+
+    def test_make_traces(self):
+        traces = make_traces(loadtest_site, ['user'], users=5, seed=3)
+        self.assertEquals(5, len(traces))
+        self.assertEquals(traces, make_traces(loadtest_site, ['user'], users=5, seed=3))
+        for trace in traces:
+            for delay, key, query in trace:
+                self.assertEquals('user', key)
+                self.assertTrue(query)
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'traces')
+            write_traces(traces, path)
+            self.assertEquals(traces, read_traces(path))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_run(self):
+        traces = [
+            [(0.1, 'user', u'a'), (0.1, 'user', u'ah'), (0.1, 'user', u'a')],
+            [(0.1, 'user', u'ah'), (0.1, 'post', u'ah')],
+        ]
+        report = run(ClientTarget('/loadtest/%s/'), traces, speed=0)
+        self.assertEquals(5, report['requests'])
+        self.assertEquals(1, report['errors'])
+        self.assertEquals(2, report['queries'])
+        self.assertEquals(0.5, report['queries_per_request'])
+        self.assertEquals(0.5, report['cached_ratio'])
+        self.assertTrue(report['latency']['p50'] <= report['latency']['max'])
+        self.assertTrue(report['throughput'] > 0)
+
+    def test_percentile(self):
+        self.assertEquals(None, percentile([], 0.5))
+        values = range(1, 101)
+        self.assertEquals(50, percentile(values, 0.5))
+        self.assertEquals(99, percentile(values, 0.99))
+        self.assertEquals(100, percentile(values, 1.0))
+
+
+class LogEntryAdmin(AutocompleteAdminMixin, admin.ModelAdmin):
+    autocomplete_fields = ('user',)
+
+class AutocompleteUserAdmin(AutocompleteAdminMixin, UserAdmin):
+    autocomplete_fields = ('groups',)
+
+admin_site = admin.AdminSite(name='autocomplete_admin')
+admin_site.register(User, AutocompleteUserAdmin)
+admin_site.register(Group, GroupAdmin)
+admin_site.register(LogEntry, LogEntryAdmin)
+
+loadtest_site = AutocompleteSite()
+loadtest_site.register(
+    'user', model=User, search_fields=['username'], label='username', cache_timeout=60
+)
+loadtest_site.register(
+    'post', model=User, search_fields=['username'], allowed_methods=('POST',)
+)
+
+urlpatterns = patterns('',
+    url(r'^admin/', include(admin_site.urls)),
+    url(r'^loadtest/([\w-]+)/$', loadtest_site),
+)
+
+class AdminTest(TransactionTestCase):
+    fixtures = ['fancy_autocomplete_test_data.json']
+    urls = 'fancy_autocomplete.tests'
+
+    def setUp(self):
+        self.admin = User.objects.create_user('admin', 'admin@example.com', 'secret')
+        self.admin.is_staff = True
+        self.admin.is_superuser = True
+        self.admin.save()
+
+    def test_admin_autocomplete(self):
+        autocomplete = AdminAutocomplete(
+            model=User,
+            search_fields=('^username', '=email', 'first_name')
+        )
+        self.assertEquals(['username', 'email', 'first_name'], autocomplete.get_search_fields())
+        self.assertEquals('istartswith', autocomplete.get_lookup('username'))
+        self.assertEquals('iexact', autocomplete.get_lookup('email'))
+        self.assertEquals('icontains', autocomplete.get_lookup('first_name'))
+        autocomplete.request = request_factory.get('/')
+        autocomplete.request.user = self.admin
+        self.assertTrue(autocomplete.is_authorized())
+        autocomplete.request.user = User.objects.filter(is_staff=False)[0]
+        self.assertFalse(autocomplete.is_authorized())
+
+    def test_get_autocomplete_site(self):
+        model_admin = admin_site._registry[LogEntry]
+        site = model_admin.get_autocomplete_site()
+        self.assertEquals(site, model_admin.get_autocomplete_site())
+        autocomplete = site.get_autocomplete('user')
+        self.assertTrue(isinstance(autocomplete, AdminAutocomplete))
+        self.assertEquals(UserAdmin.search_fields, autocomplete.search_fields)
+        self.assertEquals(model_admin, autocomplete.model_admin)
+
+        class BrokenAdmin(AutocompleteAdminMixin, admin.ModelAdmin):
+            autocomplete_fields = ('content_type',)
+        broken = BrokenAdmin(LogEntry, admin_site)
+        self.assertRaises(ImproperlyConfigured, broken.get_autocomplete_site)
+
+    def test_formfields(self):
+        request = request_factory.get('/')
+        request.user = self.admin
+        model_admin = admin_site._registry[LogEntry]
+        field = model_admin.formfield_for_dbfield(
+            LogEntry._meta.get_field('user'), request=request
+        )
+        self.assertTrue(isinstance(field, AutocompleteModelChoiceField))
+        self.assertTrue(isinstance(field.widget.widget, AdminAutocompleteInput))
+        self.assertEquals('/admin/admin/logentry/autocomplete/user/', field.widget.widget.url)
+        field = model_admin.formfield_for_dbfield(
+            LogEntry._meta.get_field('content_type'), request=request
+        )
+        self.assertFalse(isinstance(field, AutocompleteModelChoiceField))
+
+        model_admin = admin_site._registry[User]
+        field = model_admin.formfield_for_dbfield(
+            User._meta.get_field('groups'), request=request
+        )
+        self.assertTrue(isinstance(field, AutocompleteModelMultipleChoiceField))
+        self.assertTrue(isinstance(field.widget.widget, AdminAutocompleteSelectMultiple))
+
+    def test_autocomplete_view(self):
+        client = Client()
+        client.login(username='admin', password='secret')
+        response = client.get('/admin/admin/logentry/autocomplete/user/', {'q': 'ah'})
+        self.assertEquals(200, response.status_code)
+        qs = User.objects.filter(
+            Q(username__icontains='ah') | Q(first_name__icontains='ah') |
+            Q(last_name__icontains='ah') | Q(email__icontains='ah')
+        )
+        self.assertEquals(
+            sorted([u.id, unicode(u)] for u in qs),
+            sorted(simplejson.loads(response.content))
+        )
+        model_admin = admin_site._registry[LogEntry]
+        self.assertRaises(Http404, model_admin.autocomplete_view, None, 'group')
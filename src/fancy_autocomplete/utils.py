@@ -0,0 +1,64 @@
+from StringIO import StringIO
+import urllib
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.handlers.wsgi import WSGIRequest
+from django.utils.importlib import import_module
+
+
+def import_attribute(path):
+    """
+    Get a module attribute, such as an autocomplete class, from its dotted
+    import path.
+    """
+    try:
+        module_name, attr = path.rsplit('.', 1)
+    except ValueError:
+        raise ImproperlyConfigured("'%s' is not a valid dotted path" % path)
+    try:
+        module = import_module(module_name)
+    except ImportError as e:
+        raise ImproperlyConfigured("Error importing module '%s': %s" % (module_name, e))
+    try:
+        return getattr(module, attr)
+    except AttributeError:
+        raise ImproperlyConfigured("Module '%s' has no attribute '%s'" % (module_name, attr))
+
+
+def get_site(path):
+    """
+    Get an ``AutocompleteSite`` instance from its dotted import path, such as
+    ``'myproject.urls.autocompletes'``.
+    """
+    return import_attribute(path)
+
+
+def make_request(query_param, query, user=None, base=None):
+    """
+    Build a GET request for an autocomplete ``query`` outside of the request
+    cycle, such as from a management command. If a ``base`` request is given,
+    its environment, user and session are carried over.
+    """
+    from django.contrib.auth.models import AnonymousUser
+    environ = {
+        'PATH_INFO': '/',
+        'SCRIPT_NAME': '',
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+    }
+    if base is not None:
+        environ.update(base.META)
+    environ.update({
+        'QUERY_STRING': urllib.urlencode({query_param: query.encode('utf-8')}),
+        'REQUEST_METHOD': 'GET',
+        'CONTENT_LENGTH': '0',
+        'wsgi.input': StringIO(),
+    })
+    request = WSGIRequest(environ)
+    if user is None:
+        user = getattr(base, 'user', None) or AnonymousUser()
+    request.user = user
+    if hasattr(base, 'session'):
+        request.session = base.session
+    return request
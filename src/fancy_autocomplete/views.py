@@ -1,14 +1,31 @@
 from copy import copy
+import hashlib
+import itertools
 import operator
+import re
+import threading
+import time
+import unicodedata
 
 from django.http import (
-    HttpResponse, HttpResponseForbidden, HttpResponseNotAllowed, Http404
+    HttpResponse, HttpResponseBadRequest, HttpResponseForbidden,
+    HttpResponseNotAllowed, Http404
 )
 from django.utils import simplejson
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.encoding import force_unicode
 from django.utils.functional import update_wrapper
-from django.core.exceptions import ImproperlyConfigured
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured, ValidationError
 from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DatabaseError, connections, close_connection
 from django.db.models import Q
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.sql.constants import LOOKUP_SEP
+from django.utils.importlib import import_module
+from django.utils.module_loading import module_has_submodule
+
+from fancy_autocomplete.utils import import_attribute
 
 class classonlymethod(classmethod):
     def __get__(self, instance, owner):
@@ -17,10 +34,128 @@ class classonlymethod(classmethod):
         return super(classonlymethod, self).__get__(instance, owner)
 
 
+def _is_multivalued(opts, path):
+    """
+    Does the field lookup ``path`` span a relation that may match more than
+    one row for each object, such as a many-to-many or reverse foreign key?
+    """
+    for name in path.split(LOOKUP_SEP)[:-1]:
+        try:
+            field, model, direct, m2m = opts.get_field_by_name(name)
+        except FieldDoesNotExist:
+            return False
+        if m2m or not direct:
+            return True
+        opts = field.rel.to._meta
+    return False
+
+
+def _is_overridden(cls, name):
+    """
+    Is the method ``name`` of an autocomplete class overridden outside this
+    module?
+    """
+    for klass in cls.__mro__:
+        if name in klass.__dict__:
+            return klass.__module__ != __name__
+    return False
+
+
+_alias_cycles = {}
+
+# The number of sites of each class created without a name, numbering the
+# names they are given.
+_unnamed_sites = {}
+_unnamed_sites_lock = threading.Lock()
+
+
+def _make_site_name(cls):
+    """
+    Make up a name for a site of class ``cls`` created without one: the
+    dotted path of the class, numbered from the second such site on. Sites
+    created in the same order in every process get the same names.
+    """
+    path = '%s.%s' % (cls.__module__, cls.__name__)
+    _unnamed_sites_lock.acquire()
+    try:
+        count = _unnamed_sites[path] = _unnamed_sites.get(path, 0) + 1
+    finally:
+        _unnamed_sites_lock.release()
+    if count == 1:
+        return path
+    return '%s-%d' % (path, count)
+
+# Searches of each federated source running in background threads, shared by
+# all requests in the process.
+_source_slots = {}
+_source_slots_lock = threading.Lock()
+
+def _get_source_slots(name, key, size):
+    """
+    Get the semaphore limiting the searches of the source ``key`` of the
+    federated autocomplete ``name`` in flight at once to ``size``.
+    """
+    _source_slots_lock.acquire()
+    try:
+        slots = _source_slots.get((name, key, size))
+        if slots is None:
+            slots = _source_slots[(name, key, size)] = threading.BoundedSemaphore(size)
+        return slots
+    finally:
+        _source_slots_lock.release()
+
+
+def _next_alias(aliases):
+    """
+    Get the next database alias from a round-robin pool of aliases. The pool
+    state is kept per process and shared by all autocompletes using it.
+    """
+    try:
+        cycle = _alias_cycles[aliases]
+    except KeyError:
+        cycle = _alias_cycles.setdefault(aliases, itertools.cycle(aliases))
+    return cycle.next()
+
+
+# Regular expressions matching a query the way each lookup does, for
+# highlighting. Other lookups are highlighted wherever the query occurs.
+HIGHLIGHT_PATTERNS = {
+    'exact': u'^%s$',
+    'iexact': u'^%s$',
+    'startswith': u'^%s',
+    'istartswith': u'^%s',
+    'endswith': u'%s$',
+    'iendswith': u'%s$',
+    'search': u'\\b%s',
+}
+CASE_INSENSITIVE_LOOKUPS = ('iexact', 'icontains', 'istartswith', 'iendswith', 'search')
+
+# How long cache generations are kept. Thirty days is the longest relative
+# timeout memcached accepts.
+GENERATION_TIMEOUT = 60 * 60 * 24 * 30
+
+
+def _fold(text):
+    """
+    Remove the accents from ``text``. Returns the folded text and a list
+    holding the position in ``text`` of each character of the folded text.
+    """
+    folded = []
+    positions = []
+    for i, char in enumerate(text):
+        for part in unicodedata.normalize('NFKD', char):
+            if not unicodedata.combining(part):
+                folded.append(part)
+                positions.append(i)
+    return u''.join(folded), positions
+
+
 class BaseAutocomplete(object):
     """
     Encapsulates the basic options for doing an autocomplete search for a ``Model``.
     """
+    result_order = None
+
     def __init__(self, **kwargs):
         self._load_config_values(kwargs,
             lookup='startswith',
@@ -30,10 +165,29 @@ class BaseAutocomplete(object):
             queryset=None,
             limit=None,
             search_fields=None,
-            allowed_methods=('GET',)
+            allowed_methods=('GET',),
+            using=None,
+            name=None,
+            precompute_length=0,
+            ordering=None,
+            cache_timeout=None,
+            cache_scope=None,
+            resolve_param='resolve',
+            site=None,
+            index_path=None,
+            index_max_age=None,
+            time_budget=None,
+            breaker_threshold=5,
+            breaker_cooldown=30,
+            envelope=False,
+            highlight=False,
+            highlight_fold=False,
+            compile_queries=False
         )
         if kwargs:
             raise TypeError("__init__() got an unexpected keyword argument '%s'" % iter(kwargs).next())
+        if self.highlight:
+            self.envelope = True
 
     def get_query_param(self):
         """
@@ -65,29 +219,504 @@ class BaseAutocomplete(object):
             raise ImproperlyConfigured("A queryset or model must be specified.")
         return self.model._default_manager.all()
 
+    def get_using(self):
+        """
+        Get the database alias to run the search query against. If ``using``
+        is a sequence of aliases, they are used in round-robin order, with
+        one alias chosen for each request.
+        """
+        using = self.using
+        if isinstance(using, (list, tuple)):
+            request = getattr(self, 'request', None)
+            chosen = getattr(self, '_chosen_using', None)
+            if chosen is None or chosen[0] is not request:
+                chosen = self._chosen_using = (request, _next_alias(tuple(using)))
+            using = chosen[1]
+        if using is not None and using not in connections.databases:
+            raise ImproperlyConfigured("The database '%s' does not exist." % using)
+        return using
+
     def get_limit(self):
         """
         Get the number of results to include in the response.
         """
         return self.limit
 
+    def get_fetch_limit(self):
+        """
+        Get the number of results to fetch. With the envelope format, one more
+        than the limit is fetched to find out whether there are more results.
+        """
+        limit = self.get_limit()
+        if self.envelope and limit is not None:
+            return limit + 1
+        return limit
+
+    def get_ordering(self):
+        """
+        Get the ordering of the results. If ``'popularity'``, the results most
+        often chosen for the current query are listed first.
+        """
+        return self.ordering
+
+    def get_key_field(self, results):
+        """
+        Get the name of the field identifying each result.
+        """
+        return results.model._meta.pk.attname
+
     def get_result_queryset(self):
         """
         Get the ``QuerySet`` of results for the current query.
         """
+        self.result_order = None
         query_param = self.get_query_param()
         queryset = self.get_queryset()
+        using = self.get_using()
+        if using is not None:
+            queryset = queryset.using(using)
         if not query_param:
             return queryset.none()
-        search_fields = self.get_search_fields()
-        query_parts = [Q(**{"%s__%s" % (field, self.get_lookup(field)): query_param}) for field in search_fields]
-        query = reduce(operator.or_, query_parts)
-        results = queryset.filter(query)
-        limit = self.get_limit()
+        results = self.filter_queryset(queryset, query_param)
+        limit = self.get_fetch_limit()
+        if self.get_ordering() == 'popularity':
+            return self.rank_results(queryset, results, limit)
         if limit is not None:
             results = results[:limit]
         return results
 
+    def filter_queryset(self, queryset, query):
+        """
+        Filter ``queryset`` to the objects matching ``query`` in any of the
+        search fields.
+        """
+        query_parts = []
+        for field in self.get_search_fields():
+            part = Q(**{"%s__%s" % (field, self.get_lookup(field)): query})
+            if _is_multivalued(queryset.model._meta, field):
+                # Search through a subquery so each object is returned once
+                # without a DISTINCT over all of the selected columns.
+                matches = queryset.model._base_manager.using(queryset.db).filter(part)
+                part = Q(pk__in=matches.values('pk'))
+            query_parts.append(part)
+        return queryset.filter(reduce(operator.or_, query_parts))
+
+    # Hooks the compiled search statement is built from. If any of them is
+    # overridden outside of this module, searches go through the ORM.
+    plan_hooks = (
+        'get_query_param', 'get_lookup', 'get_search_fields', 'get_queryset',
+        'get_limit', 'get_fetch_limit', 'get_key_field', 'get_result_queryset',
+        'filter_queryset', 'prepare_results', 'get_plan_queryset', 'get_plan_key',
+        'prepare_rows', 'get_label', 'get_response_fields',
+    )
+
+    def get_plan_queryset(self, results):
+        """
+        Get the ``QuerySet`` of the rows that ``prepare_rows`` prepares
+        results from, or ``None`` if searches cannot be compiled.
+        """
+        return None
+
+    def prepare_rows(self, rows):
+        """
+        Format the rows of the compiled search statement for serialization.
+        """
+        raise NotImplementedError
+
+    def can_compile(self):
+        """
+        Can searches be run with a compiled statement? They can unless
+        ``compile_queries`` is off, results are ranked by popularity, or the
+        hooks the statement is built from are overridden.
+        """
+        if not self.compile_queries or self.get_ordering() == 'popularity':
+            return False
+        for name in self.plan_hooks:
+            if _is_overridden(type(self), name):
+                return False
+        return True
+
+    def get_plan(self):
+        """
+        Get the compiled ``QueryPlan`` for this autocomplete's searches, or
+        ``None`` if they cannot be compiled. Plans are compiled once for each
+        autocomplete class, name, database and configuration.
+        """
+        from fancy_autocomplete import plans
+        if not self.can_compile():
+            return None
+        queryset = self.get_queryset()
+        alias = self.get_using() or queryset.db
+        fields = tuple(self.get_search_fields())
+        lookups = tuple([self.get_lookup(field) for field in fields])
+        prep = plans.get_prep(lookups, alias)
+        if prep is None:
+            return None
+        source = self.queryset if self.queryset is not None else self.model
+        key = (
+            type(self), self.name, alias, id(source), fields, lookups,
+            self.get_fetch_limit(), self.get_plan_key()
+        )
+
+        def build():
+            try:
+                results = self.filter_queryset(queryset.using(alias), plans.PROBE)
+                limit = self.get_fetch_limit()
+                if limit is not None:
+                    results = results[:limit]
+                results = self.get_plan_queryset(results)
+                if results is None:
+                    return None
+                return plans.QueryPlan(results, alias, prep)
+            except (TypeError, ValueError, ValidationError):
+                # The probe query is not valid for the search fields.
+                return None
+        return plans.get_plan(key, source, build)
+
+    def get_plan_key(self):
+        """
+        Get a hashable value of the configuration ``get_plan_queryset`` and
+        ``prepare_rows`` depend on, to key compiled statements by.
+        """
+        return None
+
+    def get_compiled_results(self):
+        """
+        Get the prepared results for the current query by running the
+        compiled search statement, or ``None`` if there is none.
+        """
+        query_param = self.get_query_param()
+        if not query_param:
+            return None
+        plan = self.get_plan()
+        if plan is None:
+            return None
+        self.result_order = None
+        return self.prepare_rows(plan.execute(query_param))
+
+    def get_search_response(self):
+        """
+        Get the response object for the current query, running the compiled
+        search statement if there is one and the ORM otherwise.
+        """
+        results = self.get_compiled_results()
+        if results is None:
+            return self.get_response(self.get_result_queryset())
+        if self.envelope:
+            results = self.prepare_envelope(results)
+        return HttpResponse(self.serialize_prepared(results), mimetype=self.get_mimetype())
+
+    def rank_results(self, queryset, results, limit):
+        """
+        Put the results most often chosen for the current query first. The
+        keys of the ranked results are stored in ``result_order`` for
+        ``prepare_results`` to order by.
+        """
+        from fancy_autocomplete.popularity import get_popular_keys
+        popular = get_popular_keys(
+            self.get_qualified_name(),
+            self.get_query_param(),
+            results.model,
+            limit,
+            using=results.db
+        )
+        if not popular:
+            if limit is not None:
+                results = results[:limit]
+            return results
+        key_field = self.get_key_field(results)
+        positions = dict((pk, i) for i, pk in enumerate(popular))
+        boosted = list(results.filter(pk__in=popular).values_list('pk', key_field))
+        boosted.sort(key=lambda row: positions[row[0]])
+        order = [key for pk, key in boosted]
+        if limit is None or len(order) < limit:
+            rest = results.exclude(pk__in=popular).values_list(key_field, flat=True)
+            if limit is not None:
+                rest = rest[:limit - len(order)]
+            order.extend(rest)
+        self.result_order = order
+        return queryset.filter(**{'%s__in' % key_field: order})
+
+    def get_precompute_length(self):
+        """
+        Get the maximum length of queries to serve from precomputed results.
+        Results that are not shared by all users are not precomputed.
+        """
+        if self.get_cache_scope() != 'global':
+            return 0
+        return self.precompute_length
+
+    def get_prefix(self, query):
+        """
+        Normalize a query for storing or looking up precomputed results.
+        Queries are lowercased when every search field uses a case-insensitive
+        lookup, as the results do not depend on the query's case.
+        """
+        lookups = [self.get_lookup(field) for field in self.get_search_fields()]
+        if all(lookup.startswith('i') for lookup in lookups):
+            return query.lower()
+        return query
+
+    def get_precomputed(self, query=None):
+        """
+        Get the precomputed response content for the current query, or the
+        given ``query``, or ``None`` if there is none.
+        """
+        query_param = query or self.get_query_param()
+        if not query_param or not self.name:
+            return None
+        if len(query_param) > self.get_precompute_length():
+            return None
+        from fancy_autocomplete.models import PrecomputedResult
+        key = PrecomputedResult.make_key(
+            self.get_qualified_name(), self.get_prefix(query_param)
+        )
+        contents = PrecomputedResult.objects.using(self.get_using()).filter(pk=key)
+        contents = list(contents.values_list('content', flat=True))
+        if not contents:
+            return None
+        return contents[0]
+
+    def get_index_path(self):
+        """
+        Get the path of the prefix index file to serve queries from, or
+        ``None`` if queries should not be served from an index. Results that
+        are not shared by all users are not indexed.
+        """
+        if self.get_cache_scope() != 'global':
+            return None
+        return self.index_path
+
+    def get_indexed(self):
+        """
+        Get the response content for the current query from the prefix index
+        file, or ``None`` if there is no current index for this autocomplete.
+        """
+        path = self.get_index_path()
+        query_param = self.get_query_param()
+        if path is None or not query_param or not self.name:
+            return None
+        if self.get_ordering() == 'popularity':
+            return None
+        from fancy_autocomplete.index import get_index
+        index = get_index(path)
+        if index is None or index.name != self.name:
+            return None
+        if self.index_max_age is not None and time.time() - index.built > self.index_max_age:
+            return None
+        results = index.search(self.get_prefix(query_param), self.get_fetch_limit())
+        results = [simplejson.loads(result) for result in results]
+        if self.envelope:
+            results = self.prepare_envelope(results)
+        return self.serialize_prepared(results)
+
+    def get_cache_timeout(self):
+        """
+        Get the number of seconds to cache responses for, or ``None`` if
+        responses should not be cached.
+        """
+        return self.cache_timeout
+
+    # Hooks that may make results depend on the requesting user. If any of
+    # them is overridden outside of this module, results are cached per user
+    # unless a cache scope is given.
+    scope_hooks = ('get_queryset',)
+
+    def get_cache_scope(self):
+        """
+        Get the scope of cached results: ``'global'`` if they are shared by
+        all users, ``'user'`` or ``'group'`` if they depend on the requesting
+        user or the user's groups, or a callable taking the request and
+        returning the part of cache keys that varies with it. Unless
+        ``cache_scope`` is set, results are cached per user when
+        ``get_queryset`` is overridden, and globally otherwise.
+        """
+        if self.cache_scope is not None:
+            return self.cache_scope
+        for name in self.scope_hooks:
+            if _is_overridden(type(self), name):
+                return 'user'
+        return 'global'
+
+    def get_cache_vary(self):
+        """
+        Get the part of cache keys that varies with the current request under
+        the cache scope, or ``None`` if results for the request should not be
+        cached. Anonymous users share their cached results.
+        """
+        scope = self.get_cache_scope()
+        if scope == 'global':
+            return u''
+        if callable(scope):
+            vary = scope(self.request)
+            if vary is None:
+                return None
+            return force_unicode(vary)
+        if scope not in ('user', 'group'):
+            raise ImproperlyConfigured("Unknown cache scope %r" % (scope,))
+        user = getattr(self.request, 'user', None)
+        if user is None or not user.is_authenticated():
+            return u'anonymous'
+        if scope == 'user':
+            return u'user:%s' % user.pk
+        groups = sorted(user.groups.values_list('pk', flat=True))
+        return u'group:%s' % u','.join([force_unicode(pk) for pk in groups])
+
+    def patch_cache_headers(self, response):
+        """
+        Mark a response whose results depend on the requesting user as
+        varying with the ``Cookie`` header and private to the user.
+        """
+        if self.get_cache_scope() != 'global':
+            patch_vary_headers(response, ('Cookie',))
+            patch_cache_control(response, private=True)
+        return response
+
+    def get_qualified_name(self):
+        """
+        Get the name of the autocomplete qualified by the name of its site, if
+        any, so that results stored for it are kept apart from those of
+        autocompletes registered under the same name with other sites.
+        """
+        if not self.name or self.site is None:
+            return self.name
+        return u'%s:%s' % (force_unicode(self.site.name), force_unicode(self.name))
+
+    def get_generation_key(self):
+        """
+        Get the cache key holding the generation of the cached results.
+        """
+        name = force_unicode(self.get_qualified_name()).encode('utf-8')
+        return 'fancy_autocomplete.generation.%s' % hashlib.md5(name).hexdigest()
+
+    def get_cache_generation(self):
+        """
+        Get the generation of the cached results, which is part of their cache
+        keys. Generations start from the current time, so that results cached
+        before a generation was evicted are not served again. The generation
+        is read once for each request.
+        """
+        request = getattr(self, 'request', None)
+        read = getattr(self, '_generation', None)
+        if read is not None and read[0] is request:
+            return read[1]
+        generation_key = self.get_generation_key()
+        generation = cache.get(generation_key)
+        if generation is None:
+            cache.add(generation_key, int(time.time() * 1000), GENERATION_TIMEOUT)
+            generation = cache.get(generation_key, 0)
+        self._generation = (request, generation)
+        return generation
+
+    def invalidate_cache(self):
+        """
+        Invalidate every cached result of this autocomplete by moving on to a
+        new generation.
+        """
+        self._generation = None
+        generation_key = self.get_generation_key()
+        try:
+            cache.incr(generation_key)
+        except ValueError:
+            cache.set(generation_key, int(time.time() * 1000), GENERATION_TIMEOUT)
+
+    def get_cache_key(self, query=None):
+        """
+        Get the cache key for the response content for the current query, or
+        the given ``query``, or ``None`` if it should not be cached.
+        """
+        if self.get_cache_timeout() is None or not self.name:
+            return None
+        query_param = query or self.get_query_param()
+        if not query_param:
+            return None
+        vary = self.get_cache_vary()
+        if vary is None:
+            return None
+        value = u'%s\x00%s\x00%s' % (
+            self.get_qualified_name(), self.get_cache_generation(), self.get_prefix(query_param)
+        )
+        if vary:
+            value = u'%s\x00%s' % (vary, value)
+        return 'fancy_autocomplete.%s' % hashlib.md5(value.encode('utf-8')).hexdigest()
+
+    def get_cached(self, query=None):
+        """
+        Get the cached response content for the current query, or the given
+        ``query``, or ``None`` if there is none.
+        """
+        cache_key = self.get_cache_key(query)
+        if cache_key is None:
+            return None
+        return cache.get(cache_key)
+
+    def set_cached(self, content):
+        """
+        Cache the response content for the current query.
+        """
+        cache_key = self.get_cache_key()
+        if cache_key is not None:
+            cache.set(cache_key, content, self.get_cache_timeout())
+
+    def get_resolve_keys(self):
+        """
+        Get the list of keys to resolve from the request.
+        """
+        return self.request.REQUEST.getlist(self.resolve_param)
+
+    def get_resolve_cache_key(self, key):
+        """
+        Get the cache key for the prepared result for ``key``, or ``None`` if
+        it should not be cached.
+        """
+        if self.get_cache_timeout() is None or not self.name:
+            return None
+        vary = self.get_cache_vary()
+        if vary is None:
+            return None
+        value = u'%s\x00%s\x00%s' % (self.get_qualified_name(), self.get_cache_generation(), key)
+        if vary:
+            value = u'%s\x00%s' % (vary, value)
+        return 'fancy_autocomplete.resolve.%s' % hashlib.md5(value.encode('utf-8')).hexdigest()
+
+    def resolve(self, keys):
+        """
+        Get the prepared results for the objects with the given ``keys``, in
+        the order of the keys. Keys of objects that are not found are skipped.
+        """
+        keys = [force_unicode(key) for key in keys]
+        cache_keys = {}
+        for key in keys:
+            cache_key = self.get_resolve_cache_key(key)
+            if cache_key is not None:
+                cache_keys[cache_key] = key
+        found = {}
+        if cache_keys:
+            for cache_key, result in cache.get_many(cache_keys.keys()).items():
+                found[cache_keys[cache_key]] = result
+        missing = [key for key in keys if key not in found]
+        if missing:
+            queryset = self.get_queryset()
+            using = self.get_using()
+            if using is not None:
+                queryset = queryset.using(using)
+            key_field = self.get_key_field(queryset)
+            self.result_order = None
+            results = queryset.filter(**{'%s__in' % key_field: missing})
+            fetched = {}
+            for key, result in self.prepare_keyed_results(results):
+                fetched[force_unicode(key)] = result
+            found.update(fetched)
+            timeout = self.get_cache_timeout()
+            to_cache = {}
+            for key, result in fetched.items():
+                cache_key = self.get_resolve_cache_key(key)
+                if cache_key is not None:
+                    to_cache[cache_key] = result
+            if to_cache:
+                cache.set_many(to_cache, timeout)
+        return [found[key] for key in keys if key in found]
+
     def is_authorized(self):
         """
         Is the requesting user authorized to use this autocomplete?
@@ -106,11 +735,116 @@ class BaseAutocomplete(object):
         """
         raise NotImplementedError
 
+    def prepare_keyed_results(self, results):
+        """
+        Format the results for serialization as a list of (key, result) pairs.
+        """
+        raise NotImplementedError
+
+    def order_results(self, results, key):
+        """
+        Sort prepared results into ``result_order``, if set, using ``key`` to
+        get the key of each result.
+        """
+        if self.result_order is None:
+            return results
+        positions = dict((k, i) for i, k in enumerate(self.result_order))
+        return sorted(results, key=lambda result: positions.get(key(result), len(positions)))
+
     def serialize_results(self, results):
         """
         Serialize the result ``QuerySet`` for use in the response.
         """
         results = self.prepare_results(results)
+        if self.envelope:
+            results = self.prepare_envelope(results)
+        return self.serialize_prepared(results)
+
+    def prepare_envelope(self, results, has_more=None):
+        """
+        Wrap prepared results in an object with a ``has_more`` flag. Unless
+        given, ``has_more`` is whether there are more results than the limit,
+        and the extra results are left out.
+        """
+        if has_more is None:
+            limit = self.get_limit()
+            has_more = limit is not None and len(results) > limit
+            if has_more:
+                results = results[:limit]
+        envelope = {'results': results, 'has_more': has_more}
+        if self.highlight:
+            envelope['highlights'] = self.get_highlights(results)
+        return envelope
+
+    def get_highlight_values(self, result):
+        """
+        Get a dictionary of the text to highlight in a prepared result, keyed
+        by field name.
+        """
+        raise NotImplementedError
+
+    def get_matcher(self, field):
+        """
+        Get a compiled regular expression matching the current query in values
+        of ``field`` the way its lookup does. An expression is compiled once
+        for each lookup and query.
+        """
+        lookup = self.get_lookup(field)
+        query_param = self.get_query_param()
+        matchers = self.__dict__.setdefault('_matchers', {})
+        matcher = matchers.get((lookup, query_param))
+        if matcher is None:
+            query = query_param
+            if self.highlight_fold:
+                query = _fold(query)[0]
+            flags = re.UNICODE
+            if lookup in CASE_INSENSITIVE_LOOKUPS:
+                flags |= re.IGNORECASE
+            pattern = HIGHLIGHT_PATTERNS.get(lookup, u'%s') % re.escape(query)
+            matcher = re.compile(pattern, flags)
+            matchers[(lookup, query_param)] = matcher
+        return matcher
+
+    def get_highlights(self, results):
+        """
+        Get a list holding for each prepared result a dictionary of the
+        [start, end) offsets of the matches of the query, keyed by field name.
+        Fields without matches are left out.
+        """
+        query_param = self.get_query_param()
+        highlights = []
+        for result in results:
+            spans = {}
+            if query_param:
+                for field, text in self.get_highlight_values(result).items():
+                    text_spans = self.highlight_text(field, text)
+                    if text_spans:
+                        spans[field] = text_spans
+            highlights.append(spans)
+        return highlights
+
+    def highlight_text(self, field, text):
+        """
+        Get the list of [start, end) offsets of the matches of the query in
+        the ``text`` of ``field``. With ``highlight_fold``, accents are
+        ignored and the offsets refer to the unfolded text.
+        """
+        matcher = self.get_matcher(field)
+        if not self.highlight_fold:
+            return [[m.start(), m.end()] for m in matcher.finditer(text) if m.end() > m.start()]
+        folded, positions = _fold(text)
+        # Matches end before the next folded character, taking in the
+        # accents following the last matched character.
+        positions.append(len(text))
+        return [
+            [positions[m.start()], max(positions[m.end() - 1] + 1, positions[m.end()])]
+            for m in matcher.finditer(folded) if m.end() > m.start()
+        ]
+
+    def serialize_prepared(self, results):
+        """
+        Serialize prepared results for use in the response.
+        """
         return simplejson.dumps(results, cls=DjangoJSONEncoder)
 
     def get_response(self, results):
@@ -121,6 +855,83 @@ class BaseAutocomplete(object):
         response.write(self.serialize_results(results))
         return response
 
+    def get_time_budget(self):
+        """
+        Get the number of seconds a search may take, or ``None`` if searches
+        are not limited.
+        """
+        return self.time_budget
+
+    def get_breaker(self, alias):
+        """
+        Get the circuit breaker for searches of the database ``alias``.
+        """
+        from fancy_autocomplete.budget import get_breaker
+        return get_breaker(
+            self.get_qualified_name(), alias, self.breaker_threshold, self.breaker_cooldown
+        )
+
+    def get_budgeted_response(self):
+        """
+        Get the response object for the query, searching within the time
+        budget. A degraded response is returned if the search fails or the
+        circuit breaker for the database is open. Searches that fail or run
+        over budget are counted against the breaker.
+        """
+        from fancy_autocomplete.budget import statement_timeout
+        budget = self.get_time_budget()
+        alias = self.get_using() or self.get_queryset().db
+        # Pin the database chosen for this request.
+        self.using = alias
+        breaker = self.get_breaker(alias)
+        if not breaker.allow():
+            return self.get_degraded_response()
+        started = time.time()
+        try:
+            with statement_timeout(connections[alias], budget):
+                response = self.get_search_response()
+        except DatabaseError:
+            breaker.record_failure()
+            return self.get_degraded_response()
+        if time.time() - started > budget:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        if response.status_code == 200:
+            self.set_cached(response.content)
+        return response
+
+    def get_degraded_response(self):
+        """
+        Get a response for a query that could not be searched: the cached or
+        precomputed response for the longest shorter prefix of the query, or
+        an empty result. The ``X-Autocomplete-Degraded`` header is set to
+        ``'prefix'`` or ``'empty'`` respectively.
+        """
+        query_param = self.get_query_param() or u''
+        content = None
+        for length in range(len(query_param) - 1, 0, -1):
+            prefix = query_param[:length]
+            content = self.get_cached(prefix)
+            if content is None:
+                try:
+                    content = self.get_precomputed(prefix)
+                except DatabaseError:
+                    pass
+            if content is not None:
+                break
+        if content is None:
+            results = []
+            if self.envelope:
+                results = self.prepare_envelope(results)
+            content = self.serialize_prepared(results)
+            degraded = 'empty'
+        else:
+            degraded = 'prefix'
+        response = HttpResponse(content, mimetype=self.get_mimetype())
+        response['X-Autocomplete-Degraded'] = degraded
+        return response
+
     def __call__(self, request):
         """
         Handle an autocomplete request.
@@ -130,8 +941,43 @@ class BaseAutocomplete(object):
             return HttpResponseNotAllowed(self.allowed_methods)
         if not self.is_authorized():
             return HttpResponseForbidden()
-        results = self.get_result_queryset()
-        return self.get_response(results)
+        return self.respond()
+
+    def respond(self):
+        """
+        Get the response for the current request, once it has been authorized.
+        """
+        keys = self.get_resolve_keys()
+        if keys:
+            try:
+                results = self.resolve(keys)
+            except (ValueError, ValidationError):
+                return HttpResponseBadRequest()
+            if self.envelope:
+                results = self.prepare_envelope(results, has_more=False)
+            response = HttpResponse(self.serialize_prepared(results), mimetype=self.get_mimetype())
+            return self.patch_cache_headers(response)
+        return self.patch_cache_headers(self.get_query_response())
+
+    def get_query_response(self):
+        """
+        Get the response object for the current query: the precomputed,
+        indexed or cached response if there is one, otherwise a search,
+        within the time budget if one is set.
+        """
+        content = self.get_precomputed()
+        if content is None:
+            content = self.get_indexed()
+        if content is None:
+            content = self.get_cached()
+        if content is not None:
+            return HttpResponse(content, mimetype=self.get_mimetype())
+        if self.get_time_budget() is not None:
+            return self.get_budgeted_response()
+        response = self.get_search_response()
+        if response.status_code == 200:
+            self.set_cached(response.content)
+        return response
 
     @classonlymethod
     def as_view(cls, **initkwargs):
@@ -185,7 +1031,47 @@ class ObjectAutocomplete(BaseAutocomplete):
         response_fields = self.get_response_fields()
         if not response_fields:
             raise ImproperlyConfigured("A list of response fields must be specified")
-        return list(results.values(*response_fields))
+        if self.result_order is None:
+            return list(results.values(*response_fields))
+        results = self.prepare_keyed_results(results)
+        return [result for key, result in self.order_results(results, operator.itemgetter(0))]
+
+    def prepare_keyed_results(self, results):
+        """
+        Get a list of (key, dictionary) pairs for the results.
+        """
+        response_fields = self.get_response_fields()
+        if not response_fields:
+            raise ImproperlyConfigured("A list of response fields must be specified")
+        key_field = self.get_key_field(results)
+        if key_field in response_fields:
+            return [(result[key_field], result) for result in results.values(*response_fields)]
+        keyed = []
+        for result in results.values(key_field, *response_fields):
+            keyed.append((result.pop(key_field), result))
+        return keyed
+
+    def get_plan_queryset(self, results):
+        if not self.get_response_fields():
+            return None
+        return results.values(*self.get_response_fields())
+
+    def get_plan_key(self):
+        return tuple(self.get_response_fields() or ())
+
+    def prepare_rows(self, rows):
+        response_fields = self.get_response_fields()
+        return [dict(zip(response_fields, row)) for row in rows]
+
+    def get_highlight_values(self, result):
+        """
+        Get the text values of the result's response fields that are searched.
+        """
+        search_fields = self.get_search_fields()
+        return dict(
+            (field, value) for field, value in result.items()
+            if field in search_fields and isinstance(value, basestring)
+        )
 
 
 class LabeledAutocomplete(BaseAutocomplete):
@@ -228,8 +1114,207 @@ class LabeledAutocomplete(BaseAutocomplete):
             raise ImproperlyConfigured(
                 "'label' must be either a string or a callable accepting one parameter"
             )
+        return self.order_results(results, operator.itemgetter(0))
+
+    def prepare_keyed_results(self, results):
+        """
+        Return the list of (key, (key, label)) pairs.
+        """
+        return [(result[0], result) for result in self.prepare_results(results)]
+
+    def can_compile(self):
+        """
+        Searches with labels generated by a callable cannot be compiled.
+        """
+        if not isinstance(self.label, basestring):
+            return False
+        return super(LabeledAutocomplete, self).can_compile()
+
+    def get_plan_queryset(self, results):
+        return results.values_list(self.get_key_field(results), self.get_label(results))
+
+    def get_plan_key(self):
+        return (self.key_field, self.label)
+
+    def prepare_rows(self, rows):
+        return rows
+
+    def get_highlight_values(self, result):
+        """
+        Get the result's label, keyed by the label field name, or ``'label'``
+        if labels are generated by a callable.
+        """
+        field = self.label if isinstance(self.label, basestring) else 'label'
+        if not isinstance(result[1], basestring):
+            return {}
+        return {field: result[1]}
+
+
+class FederatedAutocomplete(BaseAutocomplete):
+    """
+    Searches several autocompletes registered with the same site at once,
+    running their searches concurrently. Sources that do not finish within
+    ``timeout`` seconds, or that can only give a degraded response, are left
+    out of the response and listed as incomplete. At most ``max_in_flight`` searches of each source run at
+    once, and a source with that many searches still running is skipped.
+    """
+    def __init__(self, **kwargs):
+        self._load_config_values(kwargs,
+            sources=(),
+            timeout=1.0,
+            merge='grouped',
+            parallel=True,
+            max_in_flight=4
+        )
+        super(FederatedAutocomplete, self).__init__(**kwargs)
+
+    def get_sources(self):
+        """
+        Get the keys of the autocompletes to search.
+        """
+        if not self.sources:
+            raise ImproperlyConfigured("A list of sources must be specified")
+        if self.site is None:
+            raise ImproperlyConfigured("A federated autocomplete must be registered with a site")
+        return self.sources
+
+    def get_timeout(self):
+        """
+        Get the number of seconds to wait for the sources' results.
+        """
+        return self.timeout
+
+    def get_source(self, key):
+        """
+        Get the autocomplete registered with the site as ``key`` for the
+        current request.
+        """
+        autocomplete = self.site.get_autocomplete(key)
+        autocomplete.request = self.request
+        return autocomplete
+
+    def get_prefix(self, query):
+        """
+        Return the query unchanged, as the sources may differ in case
+        sensitivity.
+        """
+        return query
+
+    def get_cache_scope(self):
+        """
+        Unless ``cache_scope`` is set, cache results with the narrowest scope
+        of the sources: per user if any source's results are cached per user
+        or with a custom scope, per group if any are cached per group, and
+        globally otherwise.
+        """
+        if self.cache_scope is not None:
+            return self.cache_scope
+        scopes = [
+            self.site.get_autocomplete(key).get_cache_scope()
+            for key in self.get_sources()
+        ]
+        if [scope for scope in scopes if scope not in ('global', 'group')]:
+            return 'user'
+        if 'group' in scopes:
+            return 'group'
+        return 'global'
+
+    def search_source(self, autocomplete):
+        """
+        Get the prepared results of a source autocomplete, taken from its
+        precomputed, indexed or cached response when it has one and searched
+        within its time budget otherwise. Returns ``None`` if the source
+        gives an error or a degraded response.
+        """
+        response = autocomplete.get_query_response()
+        if response.status_code != 200 or response.has_header('X-Autocomplete-Degraded'):
+            return None
+        results = simplejson.loads(response.content)
+        if autocomplete.envelope:
+            results = results['results']
         return results
 
+    def get_result_queryset(self):
+        """
+        Search each source the requesting user is authorized to use. Returns
+        a dictionary of the prepared results of each source that finished in
+        time, and sets ``incomplete`` to the list of sources that did not.
+        """
+        self.incomplete = []
+        if not self.get_query_param():
+            return {}
+        sources = []
+        for key in self.get_sources():
+            autocomplete = self.get_source(key)
+            if autocomplete.is_authorized():
+                sources.append((key, autocomplete))
+        deadline = time.time() + self.get_timeout()
+        results = {}
+        if self.parallel:
+            threads = []
+            for key, autocomplete in sources:
+                # Searches that missed earlier deadlines keep running, each
+                # holding a thread and a connection, so a source that is
+                # still busy with them is skipped.
+                slots = _get_source_slots(self.get_qualified_name(), key, self.max_in_flight)
+                if not slots.acquire(False):
+                    continue
+                thread = threading.Thread(
+                    target=self._search_thread,
+                    args=(key, autocomplete, results, slots)
+                )
+                thread.setDaemon(True)
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                thread.join(max(deadline - time.time(), 0))
+        else:
+            for key, autocomplete in sources:
+                if time.time() >= deadline:
+                    break
+                results[key] = self.search_source(autocomplete)
+        # Copy the results, as late sources may still add to them.
+        results = dict(
+            (key, results[key]) for key, autocomplete in sources
+            if results.get(key) is not None
+        )
+        self.incomplete = [key for key, autocomplete in sources if key not in results]
+        return results
+
+    def _search_thread(self, key, autocomplete, results, slots):
+        try:
+            results[key] = self.search_source(autocomplete)
+        finally:
+            close_connection()
+            slots.release()
+
+    def prepare_results(self, results):
+        """
+        Merge the results of the sources. If ``merge`` is ``'grouped'``, the
+        results are listed by source, otherwise the sources' results are
+        interleaved by rank up to the limit.
+        """
+        sources = [key for key in self.get_sources() if key in results]
+        if self.merge == 'grouped':
+            merged = [{'key': key, 'results': results[key]} for key in sources]
+        else:
+            merged = []
+            for rank in range(max([len(results[key]) for key in sources] or [0])):
+                for key in sources:
+                    if rank < len(results[key]):
+                        merged.append({'key': key, 'result': results[key][rank]})
+            limit = self.get_limit()
+            if limit is not None:
+                merged = merged[:limit]
+        return {'results': merged, 'incomplete': self.incomplete}
+
+    def set_cached(self, content):
+        """
+        Cache the response content, unless some sources did not finish.
+        """
+        if not getattr(self, 'incomplete', None):
+            super(FederatedAutocomplete, self).set_cached(content)
+
 
 class AlreadyRegistered(Exception):
     pass
@@ -240,15 +1325,29 @@ class NotRegistered(Exception):
 class AutocompleteSite(object):
     """
     An autocomplete site is a registry of autocomplete handlers that dispatches
-    requests to their designated handlers.
+    requests to their designated handlers. The site's ``name`` qualifies the
+    names of its autocompletes in the keys of their cached and stored results.
     """
-    def __init__(self, **defaults):
+    selection_param = 'selected'
+    profiler = None
+
+    def __init__(self, name=None, **defaults):
+        if name is None:
+            name = _make_site_name(type(self))
+        self.name = name
         self._registry = {}
+        self._resolved = {}
+        self._discovered = True
+        self._discovering = False
+        self._discovery_lock = threading.RLock()
         self.defaults = defaults
 
     def register(self, key, autocomplete=None, **options):
         """
-        Register an autocomplete with the current site.
+        Register an autocomplete with the current site. The autocomplete class
+        may be given by its dotted import path, and the ``queryset`` option as
+        a callable returning the ``QuerySet``. Both are only resolved when the
+        autocomplete is first used.
         """
         if autocomplete is None:
             autocomplete = LabeledAutocomplete
@@ -265,6 +1364,78 @@ class AutocompleteSite(object):
         if not key in self._registry:
             raise NotRegistered("The key '%s' is not registered" % key)
         del self._registry[key]
+        self._resolved.pop(key, None)
+
+    def autodiscover(self):
+        """
+        Import the ``autocompletes`` module of each installed app the first
+        time the registry is used, letting the modules register autocompletes.
+        """
+        self._discovered = False
+
+    def _discover(self):
+        if self._discovered:
+            return
+        self._discovery_lock.acquire()
+        try:
+            # Modules being discovered may use the registry themselves.
+            if self._discovered or self._discovering:
+                return
+            self._discovering = True
+            from django.conf import settings
+            for app in settings.INSTALLED_APPS:
+                module = import_module(app)
+                registry = copy(self._registry)
+                try:
+                    import_module('%s.autocompletes' % app)
+                except:
+                    # Undo partial registration so a later retry does not
+                    # raise AlreadyRegistered.
+                    self._registry = registry
+                    if module_has_submodule(module, 'autocompletes'):
+                        raise
+            self._discovered = True
+        finally:
+            self._discovering = False
+            self._discovery_lock.release()
+
+    def get_keys(self):
+        """
+        Get the sorted list of registered keys.
+        """
+        self._discover()
+        return sorted(self._registry.keys())
+
+    def resolve(self, key):
+        """
+        Get the autocomplete class and options registered as ``key``, importing
+        the class if given by its dotted path and calling the ``queryset``
+        option if given as a factory.
+        """
+        autocomplete_class, options = self._registry[key]
+        if isinstance(autocomplete_class, basestring):
+            autocomplete_class = import_attribute(autocomplete_class)
+        queryset = options.get('queryset')
+        if callable(queryset):
+            options = copy(options)
+            options['queryset'] = queryset()
+        return autocomplete_class, options
+
+    def get_autocomplete(self, key):
+        """
+        Get an autocomplete handler instance for the given ``key``.
+        """
+        self._discover()
+        if not key in self._registry:
+            raise NotRegistered("The key '%s' is not registered" % key)
+        resolved = self._resolved.get(key)
+        if resolved is None:
+            resolved = self._resolved[key] = self.resolve(key)
+        autocomplete_class, options = resolved
+        options = copy(options)
+        options.setdefault('name', key)
+        options.setdefault('site', self)
+        return autocomplete_class(**options)
 
     def is_authorized(self, request):
         """
@@ -273,16 +1444,94 @@ class AutocompleteSite(object):
         """
         return True
 
+    def get_selection_counter(self):
+        """
+        Get the ``SelectionCounter`` to record selections with.
+        """
+        from fancy_autocomplete.popularity import counter
+        return counter
+
+    def select(self, request, key=None):
+        """
+        Record that the requesting user chose a result of the autocomplete
+        registered as ``key``, for use in ranking results by popularity.
+        """
+        self._discover()
+        if key not in self._registry:
+            raise Http404
+        if request.method != 'POST':
+            return HttpResponseNotAllowed(['POST'])
+        if not self.is_authorized(request):
+            return HttpResponseForbidden()
+        autocomplete = self.get_autocomplete(key)
+        autocomplete.request = request
+        if not autocomplete.is_authorized():
+            return HttpResponseForbidden()
+        query_param = autocomplete.get_query_param()
+        selected = request.POST.get(self.selection_param)
+        if not query_param or not selected:
+            return HttpResponseBadRequest()
+        queryset = autocomplete.get_queryset()
+        try:
+            selected = queryset.model._meta.pk.to_python(selected)
+            exists = queryset.filter(pk=selected).exists()
+        except (ValueError, ValidationError):
+            exists = False
+        if not exists:
+            return HttpResponseBadRequest()
+        self.get_selection_counter().record(
+            autocomplete.get_qualified_name(), query_param, selected
+        )
+        return HttpResponse(status=204)
+
+    def stream(self, request):
+        """
+        Serve an ``AutocompleteSession`` answering a stream of queries for any
+        of the site's autocompletes over a WebSocket, if the server provides
+        one as ``wsgi.websocket``, or else answer the batch of queries in the
+        body of a ``POST`` request.
+        """
+        if not self.is_authorized(request):
+            return HttpResponseForbidden()
+        from fancy_autocomplete.streaming import serve
+        return serve(self, request)
+
+    def profile_stats(self, request):
+        """
+        A view showing the profiling statistics of the site's ``profiler`` to
+        staff users, for the key given in the ``key`` parameter or for every
+        key, sorted by the ``sort`` parameter.
+        """
+        user = request.user
+        if not (user.is_active and user.is_staff):
+            return HttpResponseForbidden()
+        if self.profiler is None:
+            raise Http404
+        keys = request.GET.getlist('key') or self.profiler.get_keys()
+        sort = request.GET.get('sort', 'cumulative')
+        try:
+            reports = [self.profiler.report(key, sort) for key in keys]
+        except KeyError:
+            return HttpResponseBadRequest()
+        return HttpResponse('\n'.join(reports), mimetype='text/plain')
+
     def __call__(self, request, key=None):
         """
         Dispatch an autocomplete request to the appropriate autocomplete
         handler.
         """
+        self._discover()
         if key not in self._registry:
             raise Http404
         # Apply site auth
         if not self.is_authorized(request):
             return HttpResponseForbidden()
-        autocomplete_class, options = self._registry[key]
-        autocomplete = autocomplete_class(**options)
+        autocomplete = self.get_autocomplete(key)
+        profiler = self.profiler
+        if profiler is not None and profiler.should_profile():
+            return profiler.profile(key, autocomplete, request)
         return autocomplete(request)
+
+
+# The default site, used by ``fancy_autocomplete.autodiscover``.
+site = AutocompleteSite(name='autocomplete')
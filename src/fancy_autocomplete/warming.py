@@ -0,0 +1,112 @@
+"""
+Warming of the response cache of the autocompletes registered with a site.
+
+After a deploy or a cache flush every autocomplete query goes to the
+database until the cache fills up again. ``warm`` replays a corpus of common
+query prefixes through each caching autocomplete, so that their responses are
+cached before users ask for them.
+"""
+import Queue
+import threading
+
+from django.db import connections
+
+from fancy_autocomplete.precompute import get_queryset_prefixes
+from fancy_autocomplete.utils import make_request
+
+
+def read_corpus(path):
+    """
+    Read a corpus of query prefixes from a UTF-8 file with one per line.
+    """
+    corpus = open(path)
+    try:
+        lines = [line.decode('utf-8').strip() for line in corpus]
+    finally:
+        corpus.close()
+    return [line for line in lines if line]
+
+
+def get_tasks(site, keys=None, prefixes=None, length=2):
+    """
+    Get the list of ``(key, prefix)`` pairs to warm. Autocompletes that do not
+    cache their responses are skipped. If no ``prefixes`` are given, the
+    prefixes up to ``length`` of each autocomplete's search field values are
+    used.
+    """
+    if keys is None:
+        keys = site.get_keys()
+    tasks = []
+    for key in keys:
+        autocomplete = site.get_autocomplete(key)
+        if autocomplete.get_cache_timeout() is None:
+            continue
+        if prefixes is None:
+            key_prefixes = sorted(get_queryset_prefixes(autocomplete, length=length))
+        else:
+            key_prefixes = prefixes
+        tasks.extend((key, prefix) for prefix in key_prefixes)
+    return tasks
+
+
+def warm_one(site, key, prefix, user=None):
+    """
+    Request ``prefix`` from the autocomplete registered as ``key``, caching
+    its response. Returns the response status code.
+    """
+    autocomplete = site.get_autocomplete(key)
+    request = make_request(autocomplete.query_param, prefix, user)
+    return autocomplete(request).status_code
+
+
+def warm(site, tasks, workers=4, user=None):
+    """
+    Warm the cache for each ``(key, prefix)`` pair in ``tasks`` using up to
+    ``workers`` threads, making the requests as ``user``. Returns the number of
+    successful requests and a list of ``(key, prefix, error)`` failures.
+    """
+    if workers <= 1:
+        return _warm_tasks(site, iter(tasks), user)
+    queue = Queue.Queue()
+    for task in tasks:
+        queue.put(task)
+    results = []
+    def worker():
+        try:
+            results.append(_warm_tasks(site, _drain(queue), user))
+        finally:
+            for connection in connections.all():
+                connection.close()
+    threads = [threading.Thread(target=worker) for i in range(min(workers, len(tasks)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    count, failures = 0, []
+    for thread_count, thread_failures in results:
+        count += thread_count
+        failures.extend(thread_failures)
+    return count, failures
+
+
+def _drain(queue):
+    while True:
+        try:
+            yield queue.get_nowait()
+        except Queue.Empty:
+            return
+
+
+def _warm_tasks(site, tasks, user):
+    count, failures = 0, []
+    for key, prefix in tasks:
+        try:
+            status = warm_one(site, key, prefix, user)
+        except Exception as e:
+            failures.append((key, prefix, e))
+            continue
+        if status == 200:
+            count += 1
+        else:
+            failures.append((key, prefix, 'HTTP %d' % status))
+    return count, failures
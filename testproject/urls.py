@@ -13,7 +13,7 @@ autocompletes = AutocompleteSite()
 
 autocompletes.register(
     'user',
-    queryset = User.objects.filter(is_active=True, is_superuser=False),
+    queryset = lambda: User.objects.filter(is_active=True, is_superuser=False),
     search_fields = ('username', 'email', 'first_name', 'last_name'),
     limit = 5,
 )